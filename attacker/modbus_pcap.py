@@ -0,0 +1 @@
+../firewall/modbus_pcap.py
\ No newline at end of file
@@ -0,0 +1,425 @@
+#!/usr/bin/env python3
+"""
+Emulator of the ESP32 dam PLC (dam_esp32.ino), to run the gateway without the hardware.
+
+Every emulated PLC serves the register map of the sketch over Modbus/TCP:
+- coil 0: pump (0 = off, 1 = on)
+- coil 1: gate (0 = closed, 1 = open)
+- input register 0: water level in 0.01 cm, measured by the ultrasonic sensor
+Other addresses and tables answer ILLEGAL DATA ADDRESS, other functions ILLEGAL FUNCTION,
+as modbus-esp8266 does.
+
+The timing follows the sketch's loop() rather than a server answering at once:
+- delay(500), then mb.task() answers every request received meanwhile, one after the
+  other (--request-time each). A request therefore waits up to a whole loop for its
+  response, and a client sending the next request once answered waits a whole loop
+  for every request.
+- the pump relay and gate servo follow coils 0 and 1 after each mb.task()
+- pulseIn() takes the echo time of the sensor, and the rest of the loop (serial output)
+  --loop-time. When the echo is lost (--sensor-dropout), pulseIn() waits 1 s, returns 0
+  and the level reads 26 cm, which opens the gate as the sketch does
+- the level is then written to input register 0, and the automatic control (level above
+  2100: gate open, pump off; below 1700: gate closed, pump on) to coils 0 and 1
+- the library serves at most MAX_CLIENTS connections, further ones are closed
+
+The water moves as in the simulation (simulation/engine.py), 10 per 0.5 s with the pump
+on and -25 per 0.5 s with the gate open, but continuously in time, and the sensor adds
+gaussian noise of --sensor-noise cm.
+
+Hundreds of PLCs run in one process, each with its own address: with --stride address
+(the default) they listen on consecutive addresses from --host, which on Linux all of
+127.0.0.0/8 provides without configuration; with --stride port on consecutive ports.
+--tagmap writes a gateway tag map polling all of them.
+
+Only the standard library is needed.
+
+usage: plc_emulator.py [-h] [--host HOST] [--port PORT] [--count COUNT]
+                       [--stride {address,port}] [--level LEVEL] [--seed SEED]
+                       [--loop-delay LOOP_DELAY] [--loop-time LOOP_TIME]
+                       [--request-time REQUEST_TIME] [--sensor-noise SENSOR_NOISE]
+                       [--sensor-dropout SENSOR_DROPOUT] [--tagmap TAGMAP]
+                       [--report REPORT] [--log {critical,error,warning,info,debug}]
+
+Examples:
+    # the PLC of the lab, on the simulation VM's address
+    plc_emulator.py --host 192.168.75.5
+
+    # 200 PLCs on 127.0.1.1-127.0.1.200:5020, and a tag map for the gateway
+    plc_emulator.py --host 127.0.1.1 --port 5020 --count 200 --seed 1 --tagmap tags-200.json
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import ipaddress
+import json
+import logging
+import math
+import random
+import signal
+import statistics
+import struct
+import sys
+import time
+
+
+_logger = logging.getLogger(__file__)
+
+MODBUS_PORT = 502
+# connections served by modbus-esp8266 (MODBUSIP_MAX_CLIENTS)
+MAX_CLIENTS = 4
+
+# sketch timing: delay(500) per loop, the rest of the loop and the handling of one request
+LOOP_DELAY = 0.5
+LOOP_TIME = 0.003
+REQUEST_TIME = 0.0004
+# pulseIn() timeout when no echo comes back
+PULSE_TIMEOUT = 1.0
+
+# sensor: the sketch's SOUND_SPEED (cm/us), and the distance of the sensor to the bottom (cm)
+SOUND_SPEED = 0.034
+SENSOR_HEIGHT = 26.0
+SENSOR_NOISE = 0.1
+# least tolerance of the process model in the tag map (1/100 cm), as in gateway/tags.json.
+# The detector resynchronises on a reading, so it compares the difference of two noisy
+# readings: the tag map allows SENSOR_NOISE_TOLERANCE standard deviations of one reading.
+MODEL_TOLERANCE = 30
+SENSOR_NOISE_TOLERANCE = 5
+
+# water dynamics and control, as in simulation/engine.py (per 0.5 s)
+TICK = 0.5
+PUMP_RATE = 10
+GATE_RATE = 25
+LEVEL_HIGH = 2100
+LEVEL_LOW = 1700
+
+# Modbus exception codes
+ILLEGAL_FUNCTION = 1
+ILLEGAL_DATA_ADDRESS = 2
+ILLEGAL_DATA_VALUE = 3
+
+MBAP = struct.Struct(">HHHB")
+# function code -> (table, bits)
+READS = {1: ("coils", True), 2: ("discrete_inputs", True), 3: ("holding_registers", False), 4: ("input_registers", False)}
+
+
+class ModbusError(Exception):
+    """Exception response to a request."""
+
+    def __init__(self, code: int):
+        super().__init__(code)
+        self.code = code
+
+
+class Settings:
+    """Timing and sensor model shared by the PLCs."""
+
+    def __init__(self, args):
+        self.loop_delay = args.loop_delay
+        self.loop_time = args.loop_time
+        self.request_time = args.request_time
+        self.sensor_noise = args.sensor_noise
+        self.sensor_dropout = args.sensor_dropout
+
+
+class Connection(asyncio.Protocol):
+    """A Modbus/TCP client of a PLC, whose requests wait for the next mb.task()."""
+
+    def __init__(self, plc):
+        self.plc = plc
+        self.transport = None
+        self.received = b""
+        # (time received, transaction id, unit id, pdu)
+        self.requests = []
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if len(self.plc.connections) >= MAX_CLIENTS:
+            self.plc.refused += 1
+            transport.close()
+            return
+        self.plc.connections.append(self)
+
+    def data_received(self, data):
+        self.received += data
+        now = time.perf_counter()
+        while len(self.received) >= 8:
+            tid, protocol, length, unit = MBAP.unpack_from(self.received)
+            if protocol != 0 or not 2 <= length <= 254:
+                _logger.debug(f"{self.plc.name}: invalid Modbus/TCP header, closing")
+                self.transport.close()
+                return
+            if len(self.received) < 6 + length:
+                break
+            self.requests.append((now, tid, unit, self.received[7:6 + length]))
+            self.received = self.received[6 + length:]
+
+    def connection_lost(self, exc):
+        if self in self.plc.connections:
+            self.plc.connections.remove(self)
+
+    def send(self, received, response):
+        if not self.transport.is_closing():
+            self.transport.write(response)
+            self.plc.latencies.append(time.perf_counter() - received)
+
+
+class Plc:
+    """One emulated ESP32 running the dam sketch."""
+
+    def __init__(self, name: str, host: str, port: int, level: float, settings: Settings, rng: random.Random):
+        self.name = name
+        self.host = host
+        self.port = port
+        self.settings = settings
+        self.rng = rng
+        # Modbus registers of the sketch
+        self.tables = {"coils": [False, False], "discrete_inputs": [], "holding_registers": [], "input_registers": [0]}
+        # actuators, off / closed after setup(), and the true water level
+        self.pump = False
+        self.gate = False
+        self.level = level
+        self.updated = time.monotonic()
+        self.connections: list[Connection] = []
+        self.refused = 0
+        self.requests = 0
+        self.dropouts = 0
+        # response times of the requests since the last report
+        self.latencies = []
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        return await loop.create_server(lambda: Connection(self), self.host, self.port, reuse_address=True)
+
+    def flow(self):
+        """Move the water level to now, with the current actuators."""
+        now = time.monotonic()
+        rate = (PUMP_RATE * self.pump - GATE_RATE * self.gate) / TICK
+        self.level = min(max(self.level + rate * (now - self.updated), 0.0), SENSOR_HEIGHT * 100)
+        self.updated = now
+
+    def measure(self) -> tuple[int, float]:
+        """water_level as computed by the sketch, and the time pulseIn() took."""
+        if self.rng.random() < self.settings.sensor_dropout:
+            self.dropouts += 1
+            duration = 0.0
+            elapsed = PULSE_TIMEOUT
+        else:
+            distance = SENSOR_HEIGHT - self.level / 100 + self.rng.gauss(0.0, self.settings.sensor_noise)
+            # pulseIn() counts whole microseconds of the echo
+            duration = float(round(max(distance, 0.0) * 2 / SOUND_SPEED))
+            elapsed = duration * 1e-6
+        distance = duration * SOUND_SPEED / 2
+        return int(max(SENSOR_HEIGHT - distance, 0.0) * 100), elapsed
+
+    def task(self) -> float:
+        """mb.task(): answer the requests received, returns the time it took."""
+        loop = asyncio.get_running_loop()
+        elapsed = 0.0
+        for connection in list(self.connections):
+            requests, connection.requests = connection.requests, []
+            for received, tid, unit, pdu in requests:
+                response = self.respond(pdu)
+                elapsed += self.settings.request_time * self.rng.uniform(0.5, 1.5)
+                adu = MBAP.pack(tid, 0, len(response) + 1, unit) + response
+                loop.call_later(elapsed, connection.send, received, adu)
+                self.requests += 1
+        return elapsed
+
+    def respond(self, pdu: bytes) -> bytes:
+        """Response PDU to a request PDU."""
+        function = pdu[0]
+        try:
+            if function in READS:
+                table, bits = READS[function]
+                address, count = struct.unpack_from(">HH", pdu, 1)
+                if not 1 <= count <= (2000 if bits else 125):
+                    raise ModbusError(ILLEGAL_DATA_VALUE)
+                values = self.read(table, address, count)
+                if bits:
+                    data = bytearray((count + 7) // 8)
+                    for n, value in enumerate(values):
+                        data[n // 8] |= bool(value) << (n % 8)
+                    return bytes([function, len(data)]) + data
+                return bytes([function, 2 * count]) + struct.pack(f">{count}H", *values)
+            if function == 5:
+                address, value = struct.unpack_from(">HH", pdu, 1)
+                if value not in (0x0000, 0xFF00):
+                    raise ModbusError(ILLEGAL_DATA_VALUE)
+                self.write("coils", address, [value == 0xFF00])
+                return pdu[:5]
+            if function == 6:
+                address, value = struct.unpack_from(">HH", pdu, 1)
+                self.write("holding_registers", address, [value])
+                return pdu[:5]
+            if function == 15:
+                address, count, size = struct.unpack_from(">HHB", pdu, 1)
+                if not 1 <= count <= 1968 or size != (count + 7) // 8 or len(pdu) < 6 + size:
+                    raise ModbusError(ILLEGAL_DATA_VALUE)
+                self.write("coils", address, [bool(pdu[6 + n // 8] >> (n % 8) & 1) for n in range(count)])
+                return pdu[:5]
+            if function == 16:
+                address, count, size = struct.unpack_from(">HHB", pdu, 1)
+                if not 1 <= count <= 123 or size != 2 * count or len(pdu) < 6 + size:
+                    raise ModbusError(ILLEGAL_DATA_VALUE)
+                self.write("holding_registers", address, list(struct.unpack_from(f">{count}H", pdu, 6)))
+                return pdu[:5]
+            raise ModbusError(ILLEGAL_FUNCTION)
+        except struct.error:
+            code = ILLEGAL_DATA_VALUE
+        except ModbusError as exc:
+            code = exc.code
+        return bytes([function | 0x80, code])
+
+    def read(self, table: str, address: int, count: int) -> list:
+        values = self.tables[table]
+        if address + count > len(values):
+            raise ModbusError(ILLEGAL_DATA_ADDRESS)
+        return values[address:address + count]
+
+    def write(self, table: str, address: int, values: list):
+        registers = self.tables[table]
+        if address + len(values) > len(registers):
+            raise ModbusError(ILLEGAL_DATA_ADDRESS)
+        registers[address:address + len(values)] = values
+
+    async def run(self):
+        """The sketch's loop()."""
+        settings = self.settings
+        coils = self.tables["coils"]
+        # the PLCs were not switched on at the same time
+        await asyncio.sleep(self.rng.uniform(0.0, settings.loop_delay))
+        while True:
+            await asyncio.sleep(settings.loop_delay)
+            elapsed = self.task()
+            # the relay and servo follow the coils
+            self.flow()
+            if (self.pump, self.gate) != (coils[0], coils[1]):
+                _logger.debug(f"{self.name}: pump {'on' if coils[0] else 'off'}, gate {'open' if coils[1] else 'closed'}")
+            self.pump, self.gate = coils[0], coils[1]
+            level, pulse = self.measure()
+            work = settings.loop_time * self.rng.uniform(0.5, 1.5)
+            await asyncio.sleep(elapsed + pulse + work)
+            pump, gate = coils[0], coils[1]
+            if level > LEVEL_HIGH:
+                gate, pump = True, False
+            elif level < LEVEL_LOW:
+                gate, pump = False, True
+            self.tables["input_registers"][0] = level
+            coils[0], coils[1] = pump, gate
+
+
+def addresses(host: str, port: int, count: int, stride: str) -> list[tuple[str, int]]:
+    if stride == "port":
+        return [(host, port + n) for n in range(count)]
+    first = ipaddress.ip_address(host)
+    return [(str(first + n), port) for n in range(count)]
+
+
+def write_tagmap(path: str, plcs: list[Plc], sensor_noise: float = SENSOR_NOISE):
+    """Gateway tag map (see gateway/tagmap.py) polling every PLC like the lab's tags.json."""
+    tolerance = max(MODEL_TOLERANCE, math.ceil(round(SENSOR_NOISE_TOLERANCE * sensor_noise * 100, 6)))
+    devices = []
+    for n, plc in enumerate(plcs, 1):
+        devices.append({
+            "name": plc.name,
+            "host": plc.host,
+            "port": plc.port,
+            "unit": 1,
+            "server_id": 0 if len(plcs) == 1 else n,
+            "folder": plc.name,
+            "max_gap": 0,
+            "max_inflight": 1,
+            "connections": 1,
+            "poll_interval_min": 0.3,
+            "poll_interval_max": 1.2,
+            "tags": [
+                {"name": "pump", "table": "coil", "address": 0, "writable": True, "states": ["off", "on"], "max_interval": 10},
+                {"name": "gate", "table": "coil", "address": 1, "writable": True, "states": ["closed", "open"], "max_interval": 10},
+                {"name": "water_level", "table": "input_register", "address": 0, "type": "uint16", "max_interval": 10},
+            ],
+            "model": {"type": "dam", "tick": 0.5, "tolerance": tolerance, "level": "water_level", "pump": "pump", "gate": "gate"},
+        })
+    with open(path, "w") as file:
+        json.dump({"devices": devices}, file, indent=2)
+
+
+def report(plcs: list[Plc]):
+    latencies = sorted(latency for plc in plcs for latency in plc.latencies)
+    for plc in plcs:
+        plc.latencies.clear()
+    requests = sum(plc.requests for plc in plcs)
+    connections = sum(len(plc.connections) for plc in plcs)
+    refused = sum(plc.refused for plc in plcs)
+    text = f"### {len(plcs)} PLCs, {connections} connections ({refused} refused), {requests} requests"
+    if latencies:
+        p99 = latencies[min(len(latencies) - 1, int(0.99 * len(latencies)))]
+        text += f", response time mean {statistics.fmean(latencies) * 1000:.0f} ms, p99 {p99 * 1000:.0f} ms"
+    _logger.info(text)
+
+
+def setup_args(cmdline=None):
+    parser = argparse.ArgumentParser(prog="plc_emulator.py", description="Emulate ESP32 dam PLCs.")
+    parser.add_argument("--host", default="127.0.0.1", help="address of the first PLC (default 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=MODBUS_PORT, help=f"Modbus port of the first PLC (default {MODBUS_PORT})")
+    parser.add_argument("--count", type=int, default=1, help="number of PLCs (default 1)")
+    parser.add_argument("--stride", choices=("address", "port"), default="address", help="give the PLCs consecutive addresses or ports (default address)")
+    parser.add_argument("--level", type=float, default=1500, help="initial water level (default 1500)")
+    parser.add_argument("--seed", type=int, default=None, help="spread the initial levels reproducibly, and seed the timing and sensor noise")
+    parser.add_argument("--loop-delay", type=float, default=LOOP_DELAY, help=f"delay() of the loop in seconds (default {LOOP_DELAY})")
+    parser.add_argument("--loop-time", type=float, default=LOOP_TIME, help=f"mean time of the rest of the loop in seconds (default {LOOP_TIME})")
+    parser.add_argument("--request-time", type=float, default=REQUEST_TIME, help=f"mean time to handle a request in seconds (default {REQUEST_TIME})")
+    parser.add_argument("--sensor-noise", type=float, default=SENSOR_NOISE, help=f"standard deviation of the distance measured in cm (default {SENSOR_NOISE})")
+    parser.add_argument("--sensor-dropout", type=float, default=0.0, help="probability that a measurement gets no echo (default 0)")
+    parser.add_argument("--tagmap", default=None, help="write a gateway tag map of the PLCs to this file")
+    parser.add_argument("--report", type=float, default=10.0, help="seconds between statistics in the log, 0 for none (default 10)")
+    parser.add_argument("--log", choices=["critical", "error", "warning", "info", "debug"], default="info", help="log level (default info)")
+    return parser.parse_args(cmdline)
+
+
+async def run(args):
+    settings = Settings(args)
+    rng = random.Random(args.seed)
+    plcs = []
+    for n, (host, port) in enumerate(addresses(args.host, args.port, args.count, args.stride), 1):
+        level = args.level if args.seed is None else rng.uniform(LEVEL_LOW, LEVEL_HIGH)
+        name = "dam" if args.count == 1 else f"dam{n}"
+        plcs.append(Plc(name, host, port, level, settings, random.Random(rng.random())))
+    if args.tagmap:
+        write_tagmap(args.tagmap, plcs, args.sensor_noise)
+    servers = [await plc.start() for plc in plcs]
+    _logger.info(f"### Emulating {len(plcs)} PLCs on {plcs[0].host}:{plcs[0].port} to {plcs[-1].host}:{plcs[-1].port}")
+
+    task = asyncio.current_task()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, task.cancel)
+    loops = [asyncio.create_task(plc.run()) for plc in plcs]
+    try:
+        while True:
+            await asyncio.sleep(args.report or 3600)
+            if args.report:
+                report(plcs)
+    except asyncio.CancelledError:
+        pass
+    finally:
+        for running in loops:
+            running.cancel()
+        for server in servers:
+            server.close()
+        report(plcs)
+
+
+def main(cmdline=None):
+    args = setup_args(cmdline)
+    logging.basicConfig(level=args.log.upper(), format="%(asctime)s %(levelname)s %(message)s")
+    try:
+        asyncio.run(run(args))
+    except (OSError, ValueError) as exc:
+        print(f"plc_emulator.py: {exc}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
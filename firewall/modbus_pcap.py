@@ -0,0 +1,647 @@
+#!/usr/bin/env python3
+"""
+Offline analysis of Modbus/TCP traffic in pcap / pcapng captures.
+
+The capture is memory mapped and parsed in place, so multi-GB files are streamed
+without loading them: frames are sliced out of the mapping, and only Modbus payloads
+split across TCP segments are copied for reassembly. Each TCP flow to the Modbus port is
+reassembled in both directions and cut into ADUs (MBAP header + PDU). Requests and
+responses are matched by transaction id to report, per flow:
+- the function code mix and the exception responses
+- transaction latency percentiles per function code
+- mismatches between requests and responses: responses without a request, requests
+  without a response, wrong function code, unit id or byte count, and write responses
+  which do not echo the request (e.g. intercept.filter flipping a write in transit)
+- TCP segments seen twice with different payload, i.e. rewritten by a man in the middle
+  after the original was captured (e.g. spoofing.filter zeroing the water level)
+
+With --model, the pump / gate coils (0 / 1) and water level input register (0) read from
+each PLC are checked against the process model of the dam (detector.py, shared with the
+gateway), which catches values spoofed or replayed before the capture point as well.
+Writes seen in the capture are taken as commands.
+
+Only the standard library is needed. Captures can be taken with tcpdump, ettercap -w
+or the pfSense packet capture (Diagnostics > Packet Capture).
+
+usage: modbus_pcap.py [-h] [--port PORT] [--details DETAILS] [--model] [--tick TICK] [--json] pcap [pcap ...]
+
+Examples:
+    modbus_pcap.py baseline.pcap
+    modbus_pcap.py --details 50 --json spoofing.pcapng > spoofing.json
+    modbus_pcap.py --model --tick 0.05 fast.pcap
+"""
+from __future__ import annotations
+
+import argparse
+import ipaddress
+import json
+import mmap
+import struct
+import sys
+import time
+from array import array
+from collections import Counter, deque
+
+from detector import TICK, DamModel, Detector
+
+
+MODBUS_PORT = 502
+# out of order segments held per direction before the missing data is given up
+MAX_AHEAD = 64
+# bytes of each direction kept to compare retransmitted segments with
+HISTORY = 65536
+# ADU positions kept per direction to name the transaction of a rewritten segment
+ADU_HISTORY = 1024
+
+FUNCTIONS = {
+    1: "read_coils",
+    2: "read_discrete_inputs",
+    3: "read_holding_registers",
+    4: "read_input_registers",
+    5: "write_single_coil",
+    6: "write_single_register",
+    15: "write_multiple_coils",
+    16: "write_multiple_registers",
+    23: "read_write_multiple_registers",
+}
+
+# pcap link types
+LINK_NULL = 0
+LINK_ETHERNET = 1
+LINK_RAW = 101
+LINK_LINUX_SLL = 113
+LINK_IPV4 = 228
+LINK_IPV6 = 229
+LINK_LINUX_SLL2 = 276
+
+# precompiled headers: Ethernet source MAC and type, IPv4 fields up to the addresses, TCP up to the flags
+ETHERNET = struct.Struct(">6x6sH")
+IPV4 = struct.Struct(">BxHxxHxB2x4s4s")
+TCP = struct.Struct(">HHI4xBB")
+# MBAP header: transaction id, protocol id, length, unit id
+MBAP = struct.Struct(">HHHB")
+
+TCP_SYN = 0x02
+TCP_RST = 0x04
+SEQ_MOD = 1 << 32
+
+
+def function_name(code: int) -> str:
+    return FUNCTIONS.get(code & 0x7F, f"function_{code & 0x7F}")
+
+
+# --- capture files -------------------------------------------------------------------
+
+def read_pcap(buf):
+    """Yield (timestamp, link type, frame) of a classic pcap file, frames are memoryviews."""
+    magic = bytes(buf[:4])
+    if magic in (b"\xd4\xc3\xb2\xa1", b"\x4d\x3c\xb2\xa1"):
+        endian = "<"
+    elif magic in (b"\xa1\xb2\xc3\xd4", b"\xa1\xb2\x3c\x4d"):
+        endian = ">"
+    else:
+        raise ValueError("not a pcap file")
+    scale = 1e-9 if magic in (b"\x4d\x3c\xb2\xa1", b"\xa1\xb2\x3c\x4d") else 1e-6
+    linktype = struct.unpack_from(endian + "I", buf, 20)[0] & 0x0FFFFFFF
+    record = struct.Struct(endian + "IIII")
+    offset, size = 24, len(buf)
+    while offset + 16 <= size:
+        seconds, fraction, caplen, _ = record.unpack_from(buf, offset)
+        offset += 16
+        yield seconds + fraction * scale, linktype, buf[offset : offset + caplen]
+        offset += caplen
+
+
+def read_pcapng(buf):
+    """Yield (timestamp, link type, frame) of a pcapng file, frames are memoryviews."""
+    offset, size = 0, len(buf)
+    endian = "<"
+    interfaces = []
+    while offset + 12 <= size:
+        block_type = struct.unpack_from(endian + "I", buf, offset)[0]
+        if block_type == 0x0A0D0D0A:
+            # section header, which sets the byte order of the following blocks
+            endian = "<" if bytes(buf[offset + 8 : offset + 12]) == b"\x4d\x3c\x2b\x1a" else ">"
+            interfaces = []
+        length = struct.unpack_from(endian + "I", buf, offset + 4)[0]
+        if length < 12:
+            raise ValueError(f"corrupt pcapng block at {offset}")
+        body = offset + 8
+        if block_type == 1:
+            linktype = struct.unpack_from(endian + "H", buf, body)[0]
+            interfaces.append((linktype, interface_resolution(buf, body + 8, offset + length - 4, endian)))
+        elif block_type == 6:
+            interface, high, low, caplen = struct.unpack_from(endian + "IIII", buf, body)
+            linktype, resolution = interfaces[interface]
+            yield ((high << 32) | low) * resolution, linktype, buf[body + 20 : body + 20 + caplen]
+        elif block_type == 3 and interfaces:
+            # simple packet block, without timestamp
+            caplen = min(struct.unpack_from(endian + "I", buf, body)[0], length - 16)
+            yield 0.0, interfaces[0][0], buf[body + 4 : body + 4 + caplen]
+        offset += length
+
+
+def interface_resolution(buf, offset, end, endian) -> float:
+    """Seconds per timestamp unit from the options of an interface description block."""
+    while offset + 4 <= end:
+        code, length = struct.unpack_from(endian + "HH", buf, offset)
+        if code == 0:
+            break
+        if code == 9 and length == 1:
+            value = buf[offset + 4]
+            return 2.0 ** -(value & 0x7F) if value & 0x80 else 10.0 ** -value
+        offset += 4 + (length + 3) // 4 * 4
+    return 1e-6
+
+
+def read_capture(buf):
+    if bytes(buf[:4]) == b"\x0a\x0d\x0d\x0a":
+        return read_pcapng(buf)
+    return read_pcap(buf)
+
+
+# --- packets -------------------------------------------------------------------------
+
+def decode(linktype, frame):
+    """Return (src ip, dst ip, src port, dst port, seq, flags, payload, src mac) of a TCP frame, or None."""
+    mac = None
+    if linktype == LINK_ETHERNET:
+        if len(frame) < 14:
+            return None
+        mac, ethertype = ETHERNET.unpack_from(frame)
+        offset = 14
+        while ethertype in (0x8100, 0x88A8) and len(frame) >= offset + 4:
+            ethertype = (frame[offset + 2] << 8) | frame[offset + 3]
+            offset += 4
+    elif linktype == LINK_LINUX_SLL:
+        ethertype, offset = (frame[14] << 8) | frame[15], 16
+    elif linktype == LINK_LINUX_SLL2:
+        ethertype, offset = (frame[0] << 8) | frame[1], 20
+    elif linktype == LINK_NULL:
+        family = struct.unpack_from("<I", frame)[0]
+        ethertype, offset = (0x0800 if family == 2 else 0x86DD), 4
+    elif linktype in (LINK_RAW, LINK_IPV4, LINK_IPV6):
+        ethertype, offset = (0x0800 if frame[0] >> 4 == 4 else 0x86DD), 0
+    else:
+        return None
+
+    if ethertype == 0x0800:
+        if len(frame) < offset + 20:
+            return None
+        version, length, fragment, protocol, src, dst = IPV4.unpack_from(frame, offset)
+        # skip fragments, Modbus ADUs are far smaller than an MTU
+        if protocol != 6 or fragment & 0x3FFF:
+            return None
+        end = offset + length
+        offset += (version & 0x0F) * 4
+    elif ethertype == 0x86DD:
+        if len(frame) < offset + 40 or frame[offset + 6] != 6:
+            return None
+        end = offset + 40 + struct.unpack_from(">H", frame, offset + 4)[0]
+        src, dst = bytes(frame[offset + 8 : offset + 24]), bytes(frame[offset + 24 : offset + 40])
+        offset += 40
+    else:
+        return None
+
+    # the IP length trims Ethernet padding, the capture length truncated frames
+    end = min(end, len(frame))
+    if end < offset + 20:
+        return None
+    sport, dport, seq, header, flags = TCP.unpack_from(frame, offset)
+    payload = frame[offset + (header >> 4) * 4 : end]
+    return src, dst, sport, dport, seq, flags, payload, mac
+
+
+# --- reassembly ----------------------------------------------------------------------
+
+class Stream:
+    """One direction of a TCP connection, reassembled in sequence order."""
+
+    def __init__(self):
+        self.next = None
+        # bytes delivered so far, the stream offset of self.next
+        self.offset = 0
+        self.ahead: dict[int, bytes] = {}
+        self.history = bytearray()
+        self.retransmits = 0
+        self.gaps = 0
+        # (start, end, transaction id, function code) of recent ADUs
+        self.adus = deque(maxlen=ADU_HISTORY)
+        # ADU bytes not complete yet
+        self.buffer = bytearray()
+
+    def _diff(self, seq) -> int:
+        diff = (seq - self.next) % SEQ_MOD
+        return diff - SEQ_MOD if diff >= SEQ_MOD // 2 else diff
+
+    def feed(self, seq, flags, payload, rewrites) -> list:
+        """Return (stream offset, data) of the new in-order data of a segment.
+
+        Retransmitted data which differs from the data delivered before is added to rewrites.
+        """
+        if flags & TCP_SYN:
+            self.next = (seq + 1) % SEQ_MOD
+            return []
+        if not payload:
+            return []
+        if self.next is None:
+            # the capture started within the connection
+            self.next = seq
+        diff = self._diff(seq)
+        if diff < 0:
+            overlap = min(-diff, len(payload))
+            self.compare(self.offset + diff, payload[:overlap], rewrites)
+            payload = payload[overlap:]
+            if not payload:
+                self.retransmits += 1
+                return []
+            diff = 0
+        if diff > 0:
+            self.ahead[seq] = bytes(payload)
+            if len(self.ahead) > MAX_AHEAD:
+                self.skip_gap()
+            else:
+                return []
+            data = []
+        else:
+            data = [(self.offset, payload)]
+            self.advance(payload)
+        data.extend(self.drain())
+        return data
+
+    def drain(self) -> list:
+        """Return (stream offset, data) of the held segments which continue the stream."""
+        data = []
+        progress = True
+        while self.ahead and progress:
+            progress = False
+            for seq in list(self.ahead):
+                diff = self._diff(seq)
+                if diff > 0:
+                    continue
+                segment = self.ahead.pop(seq)[-diff:]
+                if segment:
+                    data.append((self.offset, segment))
+                    self.advance(segment)
+                progress = True
+        return data
+
+    def skip_gap(self):
+        """Give up on data missing from the capture, continuing with the held segments."""
+        first = min(self.ahead, key=self._diff)
+        gap = self._diff(first)
+        self.gaps += 1
+        self.next = first
+        self.offset += gap
+        self.history.clear()
+        self.buffer.clear()
+
+    def advance(self, data):
+        self.next = (self.next + len(data)) % SEQ_MOD
+        self.offset += len(data)
+        self.history += data
+        if len(self.history) > 2 * HISTORY:
+            del self.history[: len(self.history) - HISTORY]
+
+    def compare(self, offset, data, rewrites):
+        """Compare a retransmitted range with the data delivered before."""
+        start = self.offset - len(self.history)
+        if offset < start:
+            data = data[start - offset :]
+            offset = start
+        original = self.history[offset - start : offset - start + len(data)]
+        if original == data:
+            return
+        position = next(n for n in range(len(original)) if original[n] != data[n])
+        rewrites.append((offset + position, bytes(original), bytes(data), offset))
+
+    def adu_at(self, offset):
+        for start, end, tid, function in reversed(self.adus):
+            if start <= offset < end:
+                return tid, function
+        return None, None
+
+
+# --- analysis ------------------------------------------------------------------------
+
+class Flow:
+    """A Modbus/TCP connection between a client and a server."""
+
+    def __init__(self, client, server, details, models=None, tick=TICK):
+        self.client = client
+        self.server = server
+        self.details = details
+        # (server, unit) -> Detector shared by all flows to the server, None without --model
+        self.models = models
+        self.tick = tick
+        self.streams = {"request": Stream(), "response": Stream()}
+        # transaction id -> (time, unit, request pdu)
+        self.pending: dict[int, tuple] = {}
+        self.requests = Counter()
+        self.responses = Counter()
+        self.exceptions = Counter()
+        self.latencies: dict[int, array] = {}
+        self.anomalies = Counter()
+        self.examples: list[dict] = []
+        self.first = self.last = None
+        self.macs = {"request": set(), "response": set()}
+
+    def anomaly(self, kind, ts, **info):
+        self.anomalies[kind] += 1
+        if len(self.examples) < self.details:
+            self.examples.append({"time": round(ts, 6), "kind": kind, **info})
+
+    def packet(self, ts, direction, seq, flags, payload, mac):
+        if self.first is None:
+            self.first = ts
+        self.last = ts
+        if mac is not None:
+            self.macs[direction].add(mac)
+        stream = self.streams[direction]
+        if flags & TCP_RST:
+            stream.buffer.clear()
+        rewrites = []
+        gaps = stream.gaps
+        for start, data in stream.feed(seq, flags, payload, rewrites):
+            self.parse(ts, direction, stream, start, data)
+        if stream.gaps != gaps:
+            self.anomaly("capture_gap", ts, direction=direction)
+        for offset, original, rewritten, _ in rewrites:
+            tid, function = stream.adu_at(offset)
+            self.anomaly(
+                "rewritten_in_transit", ts, direction=direction, transaction=tid,
+                function=function_name(function) if function is not None else None,
+                original=original.hex(" "), rewritten=rewritten.hex(" "),
+                mac=mac.hex(":") if mac else None,
+            )
+
+    def parse(self, ts, direction, stream, start, data):
+        """Cut the stream data into ADUs, start is the stream offset of data."""
+        buffer = stream.buffer
+        base = start - len(buffer)
+        view = None
+        if buffer:
+            buffer += data
+            data = view = memoryview(buffer)
+        offset = 0
+        size = len(data)
+        while size - offset >= 8:
+            tid, protocol, length, unit = MBAP.unpack_from(data, offset)
+            if protocol != 0 or not 2 <= length <= 254:
+                # not at an ADU boundary, e.g. after a gap: drop until the next segment
+                self.anomaly("invalid_adu", ts, direction=direction, data=bytes(data[offset : offset + 8]).hex(" "))
+                offset = size
+                break
+            end = offset + 6 + length
+            if end > size:
+                break
+            pdu = bytes(data[offset + 7 : end])
+            stream.adus.append((base + offset, base + end, tid, pdu[0]))
+            if direction == "request":
+                self.request(ts, tid, unit, pdu)
+            else:
+                self.response(ts, tid, unit, pdu)
+            offset = end
+        rest = bytes(data[offset:]) if offset < size else b""
+        if view is not None:
+            view.release()
+        buffer[:] = rest
+
+    def request(self, ts, tid, unit, pdu):
+        function = pdu[0]
+        self.requests[function] += 1
+        if tid in self.pending:
+            self.anomaly("duplicate_transaction", ts, transaction=tid, function=function_name(function))
+        self.pending[tid] = (ts, unit, pdu)
+
+    def response(self, ts, tid, unit, pdu):
+        function = pdu[0]
+        self.responses[function & 0x7F] += 1
+        request = self.pending.pop(tid, None)
+        if request is None:
+            self.anomaly("response_without_request", ts, transaction=tid, function=function_name(function))
+            return
+        sent, request_unit, request_pdu = request
+        requested = request_pdu[0]
+        latencies = self.latencies.get(requested)
+        if latencies is None:
+            latencies = self.latencies[requested] = array("d")
+        latencies.append(ts - sent)
+
+        def mismatch(kind, **details):
+            self.anomaly(kind, ts, transaction=tid, function=function_name(requested), **details)
+
+        if function & 0x7F != requested:
+            mismatch("function_mismatch", response=function_name(function))
+            return
+        if unit != request_unit:
+            mismatch("unit_mismatch", request_unit=request_unit, response_unit=unit)
+        if function & 0x80:
+            self.exceptions[requested] += 1
+            return
+        if requested <= 4 and len(request_pdu) >= 5 and len(pdu) >= 2:
+            quantity = (request_pdu[3] << 8) | request_pdu[4]
+            expected = (quantity + 7) // 8 if requested <= 2 else 2 * quantity
+            if pdu[1] != expected or len(pdu) != 2 + expected:
+                mismatch("length_mismatch", expected=expected, byte_count=pdu[1])
+                return
+        elif requested in (5, 6) and pdu != request_pdu:
+            mismatch("echo_mismatch", request=request_pdu.hex(" "), response=pdu.hex(" "))
+            return
+        elif requested in (15, 16) and pdu[:5] != request_pdu[:5]:
+            mismatch("echo_mismatch", request=request_pdu[:5].hex(" "), response=pdu[:5].hex(" "))
+            return
+        if self.models is not None and requested in (1, 4, 5, 15):
+            self.check_model(ts, unit, request_pdu, pdu)
+
+    def check_model(self, ts, unit, request_pdu, pdu):
+        """Pass the dam points of a well-formed response to the unit's detector."""
+        if len(request_pdu) < 5:
+            return
+        function = request_pdu[0]
+        start, quantity = struct.unpack_from(">HH", request_pdu, 1)
+        detector = self.models.get((self.server, unit))
+        if detector is None:
+            detector = self.models[(self.server, unit)] = Detector(f"{self.server}/{unit}", DamModel(self.tick))
+
+        def bit(data, index):
+            return bool(data[index >> 3] >> (index & 7) & 1)
+
+        if function == 5:
+            if start <= 1:
+                detector.command(("pump", "gate")[start], quantity == 0xFF00, ts)
+            return
+        if function == 15:
+            for address in range(start, min(start + quantity, 2)):
+                if len(request_pdu) > 6 + ((address - start) >> 3):
+                    detector.command(("pump", "gate")[address], bit(request_pdu[6:], address - start), ts)
+            return
+        if function == 1 and start <= 1 and start + quantity >= 1:
+            points = {name: bit(pdu[2:], address - start)
+                      for address, name in enumerate(("pump", "gate")) if start <= address < start + quantity}
+        elif function == 4 and start == 0 and quantity >= 1:
+            points = {"level": (pdu[2] << 8) | pdu[3]}
+        else:
+            return
+        for alert in detector.observe(ts, **points):
+            self.anomaly(alert.kind, ts, unit=unit, detail=alert.message)
+
+    def finish(self):
+        for tid, (ts, _, pdu) in sorted(self.pending.items(), key=lambda item: item[1][0]):
+            self.anomaly("request_without_response", ts, transaction=tid, function=function_name(pdu[0]))
+        self.pending.clear()
+
+    def report(self) -> dict:
+        report = {
+            "client": self.client,
+            "server": self.server,
+            "first": self.first,
+            "last": self.last,
+            "requests": dict(sorted((function_name(k), v) for k, v in self.requests.items())),
+            "responses": sum(self.responses.values()),
+            "exceptions": dict(sorted((function_name(k), v) for k, v in self.exceptions.items())),
+            "retransmits": sum(stream.retransmits for stream in self.streams.values()),
+            "latency_ms": {function_name(k): percentiles(v) for k, v in sorted(self.latencies.items())},
+            "anomalies": dict(self.anomalies),
+            "examples": self.examples,
+        }
+        # frames of one direction from several MACs hint at a man in the middle
+        if self.macs["request"] or self.macs["response"]:
+            report["macs"] = {direction: sorted(mac.hex(":") for mac in macs) for direction, macs in self.macs.items()}
+        return report
+
+
+def percentiles(latencies) -> dict:
+    values = sorted(latencies)
+    count = len(values)
+
+    def at(fraction):
+        return round(values[min(count - 1, int(fraction * count))] * 1000, 3)
+
+    return {"count": count, "p50": at(0.5), "p95": at(0.95), "p99": at(0.99), "max": round(values[-1] * 1000, 3)}
+
+
+def endpoint(ip: bytes, port: int) -> str:
+    address = ipaddress.ip_address(ip)
+    return f"[{address}]:{port}" if address.version == 6 else f"{address}:{port}"
+
+
+def read_flows(paths, port, new_flow) -> tuple[dict, int, int, int]:
+    """Feed the Modbus/TCP packets of captures to flows made by new_flow(client, server).
+
+    Returns the flows by (client ip, port, server ip, port), the number of packets,
+    of Modbus/TCP packets and of bytes read.
+    """
+    flows: dict[tuple, Flow] = {}
+    packets = modbus_packets = size = 0
+    for path in paths:
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            size += len(mapped)
+            buf = memoryview(mapped)
+            frames = read_capture(buf)
+            try:
+                for ts, linktype, frame in frames:
+                    packets += 1
+                    packet = decode(linktype, frame)
+                    if packet is None:
+                        continue
+                    src, dst, sport, dport, seq, flags, payload, mac = packet
+                    if dport == port:
+                        key, direction = (src, sport, dst, dport), "request"
+                    elif sport == port:
+                        key, direction = (dst, dport, src, sport), "response"
+                    else:
+                        continue
+                    modbus_packets += 1
+                    flow = flows.get(key)
+                    if flow is None:
+                        flow = flows[key] = new_flow(endpoint(key[0], key[1]), endpoint(key[2], key[3]))
+                    flow.packet(ts, direction, seq, flags, payload, mac)
+            finally:
+                # the mapping can only be closed once no view of it is left
+                frames.close()
+                frame = packet = payload = None
+                buf.release()
+    for flow in flows.values():
+        flow.finish()
+    return flows, packets, modbus_packets, size
+
+
+def analyse(paths, port=MODBUS_PORT, details=20, tick=None) -> dict:
+    """Analyse captures, returns the report. With a tick, the PLC values are checked against the dam model."""
+    models = {} if tick else None
+    started = time.perf_counter()
+    flows, packets, modbus_packets, size = read_flows(
+        paths, port, lambda client, server: Flow(client, server, details, models, tick)
+    )
+    elapsed = time.perf_counter() - started
+
+    anomalies = Counter()
+    functions = Counter()
+    for flow in flows.values():
+        anomalies.update(flow.anomalies)
+        functions.update(flow.requests)
+    return {
+        "files": list(paths),
+        "packets": packets,
+        "modbus_packets": modbus_packets,
+        "bytes": size,
+        "seconds": round(elapsed, 3),
+        "mb_per_second": round(size / elapsed / 1e6, 1) if elapsed else None,
+        "flows": len(flows),
+        "requests": dict(sorted((function_name(k), v) for k, v in functions.items())),
+        "anomalies": dict(anomalies),
+        "connections": [flow.report() for flow in sorted(flows.values(), key=lambda flow: flow.first)],
+    }
+
+
+def print_report(report):
+    print(
+        f"{report['packets']} packets, {report['modbus_packets']} Modbus/TCP, {report['flows']} flows, "
+        f"{report['bytes'] / 1e6:.1f} MB in {report['seconds']} s ({report['mb_per_second']} MB/s)"
+    )
+    print("requests: " + (", ".join(f"{k} {v}" for k, v in report["requests"].items()) or "none"))
+    print("anomalies: " + (", ".join(f"{k} {v}" for k, v in report["anomalies"].items()) or "none"))
+    for flow in report["connections"]:
+        print(f"\n{flow['client']} -> {flow['server']}: {sum(flow['requests'].values())} requests, "
+              f"{flow['responses']} responses, {flow['retransmits']} retransmits")
+        for name, latency in flow["latency_ms"].items():
+            exceptions = flow["exceptions"].get(name, 0)
+            print(f"  {name:<30} n={latency['count']:<8} p50 {latency['p50']:>8.3f} ms  p95 {latency['p95']:>8.3f} ms"
+                  f"  p99 {latency['p99']:>8.3f} ms  max {latency['max']:>8.3f} ms  exceptions {exceptions}")
+        if "macs" in flow:
+            print("  MACs: " + "; ".join(f"{k} {', '.join(v)}" for k, v in flow["macs"].items()))
+        for kind, count in flow["anomalies"].items():
+            print(f"  {kind}: {count}")
+        for example in flow["examples"]:
+            info = ", ".join(f"{k}={v}" for k, v in example.items() if k not in ("time", "kind") and v is not None)
+            print(f"    {example['time']:.6f} {example['kind']}: {info}")
+
+
+def setup_args(cmdline=None):
+    parser = argparse.ArgumentParser(prog="modbus_pcap.py", description="Analyse Modbus/TCP traffic in pcap files.")
+    parser.add_argument("pcap", nargs="+", help="pcap or pcapng files, read in order as one capture")
+    parser.add_argument("--port", type=int, default=MODBUS_PORT, help="Modbus server port (default 502)")
+    parser.add_argument("--details", type=int, default=20, help="anomalies listed per flow (default 20)")
+    parser.add_argument("--model", action="store_true", help="check the values read from each PLC against the dam model")
+    parser.add_argument("--tick", type=float, default=TICK, help=f"simulation seconds per tick for --model (default {TICK})")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    return parser.parse_args(cmdline)
+
+
+def main(cmdline=None):
+    args = setup_args(cmdline)
+    try:
+        report = analyse(args.pcap, args.port, args.details, args.tick if args.model else None)
+    except (OSError, ValueError) as exc:
+        print(f"modbus_pcap.py: {exc}", file=sys.stderr)
+        return 1
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,576 @@
+#!/usr/bin/env python3
+"""
+Inline Modbus/TCP filtering proxy, applying the Snort rules of custom.rules in software.
+
+The proxy listens for Modbus clients and forwards every connection to one upstream
+server (a PLC, or the gateway). Requests are cut into ADUs (MBAP header + PDU) and
+checked against the rules; responses are forwarded as they are. It only needs Python 3,
+so filtering can run on any Linux host in front of the PLC, without pfSense / Snort.
+
+Rules are read in the Snort syntax custom.rules uses:
+
+    drop tcp !192.168.60.10 any -> any 502 (msg:"..."; modbus_func:read_coils; sid:1;)
+
+- actions: pass, drop, sdrop (drop without logging), reject (drop and close the client's
+  connection), alert / log (forward and log)
+- addresses: any, IPs, CIDR networks, [lists], ! negation and $VARIABLES (--var)
+- ports: any, numbers, ranges (1:1024), [lists] and ! negation
+- options: msg, sid, modbus_func (name or number), modbus_unit, and modbus_addr:N or
+  modbus_addr:N-M, an extension of this proxy which matches requests touching the
+  address range. Rules with other options (content, flow, ...) are skipped with a warning.
+
+As in Snort, a matching pass rule wins over drop / reject, which win over alert, and
+traffic no rule matches is forwarded (--default drop turns this into an allowlist of
+pass rules). The destination of a rule is matched against the upstream server.
+
+The rules are compiled once per client address into a table keyed by unit id and
+function code, whose entries hold the verdict and, if any rule names addresses, the
+address ranges. A request costs two set lookups, one dict lookup and, with address
+rules only, a scan of the few ranges of its entry.
+
+Data is received into preallocated buffers (asyncio.BufferedProtocol) and runs of
+allowed ADUs are written to the other side as memoryview slices of the same buffer, so
+the payload is not copied on its way through. A buffer is only reused once the other
+side's transport has sent everything, since asyncio keeps the slices it could not send.
+
+usage: modbus_proxy.py [-h] [--listen LISTEN] [--rules RULES] [--var NAME=VALUE]
+                       [--default {pass,drop}] [--log {critical,error,warning,info,debug}]
+                       upstream
+
+Examples:
+    # in front of the PLC, with the rules of the pfSense firewall
+    modbus_proxy.py --listen 0.0.0.0:502 --rules custom.rules 192.168.75.5:502
+
+    # only the SCADA VM may talk to the simulation
+    modbus_proxy.py --listen 127.0.0.1:5021 --default drop --rules scada.rules 127.0.0.1:5020
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import ipaddress
+import logging
+import re
+import signal
+import socket
+import struct
+import sys
+from collections import Counter
+from pathlib import Path
+
+
+_logger = logging.getLogger(__file__)
+
+MODBUS_PORT = 502
+RULES = Path(__file__).with_name("custom.rules")
+# receive buffer per direction of a connection
+BUFFER_SIZE = 65536
+# MBAP header (7 bytes) + function code + at most 252 bytes of data
+MAX_ADU = 260
+# client addresses whose compiled rule tables are kept
+MAX_TABLES = 4096
+
+# Snort's Modbus function names
+FUNCTIONS = {
+    "read_coils": 1,
+    "read_discrete_inputs": 2,
+    "read_holding_registers": 3,
+    "read_input_registers": 4,
+    "write_single_coil": 5,
+    "write_single_register": 6,
+    "read_exception_status": 7,
+    "diagnostics": 8,
+    "get_comm_event_counter": 11,
+    "get_comm_event_log": 12,
+    "write_multiple_coils": 15,
+    "write_multiple_registers": 16,
+    "report_slave_id": 17,
+    "read_file_record": 20,
+    "write_file_record": 21,
+    "mask_write_register": 22,
+    "read_write_multiple_registers": 23,
+    "read_fifo_queue": 24,
+    "encapsulated_interface_transport": 43,
+}
+FUNCTION_NAMES = {code: name for name, code in FUNCTIONS.items()}
+
+# precedence of the actions when several rules match, as Snort orders them
+ACTIONS = {"pass": 3, "reject": 2, "drop": 2, "sdrop": 2, "alert": 1, "log": 1}
+FORWARDED = ("pass", "alert", "log")
+# options which do not change what a rule matches
+IGNORED_OPTIONS = ("msg", "sid", "rev", "gid", "classtype", "priority", "metadata", "reference")
+
+MBAP = struct.Struct(">HHHB")
+# request fields with addresses after the function code: (address, count) pairs or single addresses
+ADDRESS_FIELDS = {
+    1: struct.Struct(">HH"),
+    2: struct.Struct(">HH"),
+    3: struct.Struct(">HH"),
+    4: struct.Struct(">HH"),
+    5: struct.Struct(">H"),
+    6: struct.Struct(">H"),
+    15: struct.Struct(">HH"),
+    16: struct.Struct(">HH"),
+    22: struct.Struct(">H"),
+    23: struct.Struct(">HHHH"),
+}
+
+# unit / function of a table entry for the units and functions no rule names
+ANY = -1
+
+RULE = re.compile(r"^(\w+)\s+(\w+)\s+(\S+)\s+(\S+)\s+(->|<>)\s+(\S+)\s+(\S+)\s*\((.*)\)$")
+OPTION = re.compile(r'\s*([\w.]+)\s*(?::\s*("(?:[^"\\]|\\.)*"|[^;]*?))?\s*;')
+
+
+def function_name(code: int) -> str:
+    return FUNCTION_NAMES.get(code, f"function_{code}")
+
+
+def split_list(spec: str) -> list[str]:
+    if spec.startswith("[") and spec.endswith("]"):
+        return [item for item in spec[1:-1].split(",") if item]
+    return [spec]
+
+
+class AddressSet:
+    """Snort address specification, matched against ipaddress addresses."""
+
+    def __init__(self, spec: str, variables: dict):
+        self.spec = spec
+        self.include = []
+        self.exclude = []
+        self._add(spec, variables, False)
+
+    def _add(self, spec, variables, negated):
+        for item in split_list(spec):
+            if item.startswith("!"):
+                self._add(item[1:], variables, not negated)
+            elif item.startswith("$"):
+                if item[1:] not in variables:
+                    raise ValueError(f"undefined variable {item}, use --var {item[1:]}=...")
+                self._add(variables[item[1:]], variables, negated)
+            elif item != "any":
+                (self.exclude if negated else self.include).append(ipaddress.ip_network(item, strict=False))
+            elif negated:
+                raise ValueError("!any matches no address")
+
+    def match(self, address) -> bool:
+        if self.include and not any(address in network for network in self.include):
+            return False
+        return not any(address in network for network in self.exclude)
+
+
+class PortSet:
+    """Snort port specification."""
+
+    def __init__(self, spec: str):
+        self.spec = spec
+        self.include = []
+        self.exclude = []
+        negated = spec.startswith("!")
+        for item in split_list(spec[1:] if negated else spec):
+            item_negated = negated != item.startswith("!")
+            item = item.lstrip("!")
+            if item == "any":
+                continue
+            low, _, high = item.partition(":")
+            bounds = (int(low or 0), int(high or 65535) if _ else int(low))
+            (self.exclude if item_negated else self.include).append(bounds)
+
+    @property
+    def any(self) -> bool:
+        return not self.include and not self.exclude
+
+    def match(self, port: int) -> bool:
+        if self.include and not any(low <= port <= high for low, high in self.include):
+            return False
+        return not any(low <= port <= high for low, high in self.exclude)
+
+
+class Rule:
+    """One rule of the rules file."""
+
+    def __init__(self, action, src, src_ports, bidirectional, dst, dst_ports, options, line):
+        self.action = action
+        self.priority = ACTIONS[action]
+        self.forward = action in FORWARDED
+        self.src = src
+        self.src_ports = src_ports
+        self.bidirectional = bidirectional
+        self.dst = dst
+        self.dst_ports = dst_ports
+        self.line = line
+        self.msg = options.get("msg", "").strip('"')
+        self.sid = int(options.get("sid", 0))
+        self.functions = None
+        self.units = None
+        self.addresses = None
+        if "modbus_func" in options:
+            value = options["modbus_func"]
+            self.functions = frozenset([int(value) if value.isdigit() else FUNCTIONS[value]])
+        if "modbus_unit" in options:
+            self.units = frozenset([int(options["modbus_unit"])])
+        if "modbus_addr" in options:
+            low, _, high = options["modbus_addr"].partition("-")
+            self.addresses = (int(low), int(high or low))
+
+    def applies(self, client, client_port, server, server_port) -> bool:
+        """Whether the rule matches requests from client to server."""
+        if (self.src.match(client) and self.src_ports.match(client_port)
+                and self.dst.match(server) and self.dst_ports.match(server_port)):
+            return True
+        return self.bidirectional and (
+            self.src.match(server) and self.src_ports.match(server_port)
+            and self.dst.match(client) and self.dst_ports.match(client_port)
+        )
+
+    def __str__(self):
+        return f'{self.action} sid {self.sid} "{self.msg}"'
+
+
+def parse_rules(text: str, variables: dict | None = None) -> list[Rule]:
+    """Parse the Modbus rules of a Snort rules file."""
+    variables = variables or {}
+    rules = []
+    for number, line in enumerate(text.replace("\\\n", " ").splitlines(), 1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        match = RULE.match(line)
+        if not match:
+            raise ValueError(f"line {number}: not a rule: {line}")
+        action, protocol, src, src_ports, direction, dst, dst_ports, body = match.groups()
+        if action not in ACTIONS:
+            _logger.warning(f"line {number}: action {action} not supported, rule skipped")
+            continue
+        if protocol not in ("tcp", "ip"):
+            continue
+        options = {}
+        for key, value in OPTION.findall(body + ";"):
+            options[key] = value.strip()
+        unsupported = [key for key in options if key not in IGNORED_OPTIONS and not key.startswith("modbus_")]
+        unsupported += [key for key in options if key.startswith("modbus_") and key not in ("modbus_func", "modbus_unit", "modbus_addr")]
+        if unsupported:
+            _logger.warning(f"line {number}: option {', '.join(unsupported)} not supported, rule skipped")
+            continue
+        try:
+            rules.append(Rule(
+                action, AddressSet(src, variables), PortSet(src_ports), direction == "<>",
+                AddressSet(dst, variables), PortSet(dst_ports), options, number,
+            ))
+        except (KeyError, ValueError) as exc:
+            raise ValueError(f"line {number}: {exc}") from None
+    return rules
+
+
+class Entry:
+    """Rules of one unit id and function code, the verdict without and with addresses."""
+
+    def __init__(self, rules):
+        self.rule = max((rule for rule in rules if rule.addresses is None), key=lambda rule: rule.priority, default=None)
+        # address rules which can override the verdict, by start address
+        self.ranges = sorted(
+            (rule.addresses[0], rule.addresses[1], rule)
+            for rule in rules
+            if rule.addresses is not None and (self.rule is None or rule.priority > self.rule.priority)
+        )
+
+    def match(self, ranges) -> Rule | None:
+        """The winning rule for a request touching the (first, last) address ranges."""
+        best = self.rule
+        last = max(high for _, high in ranges)
+        for start, end, rule in self.ranges:
+            if start > last:
+                break
+            if (best is None or rule.priority > best.priority) and any(start <= high and low <= end for low, high in ranges):
+                best = rule
+        return best
+
+
+class RuleTable:
+    """The rules applying to one client and the upstream server, by unit id and function code."""
+
+    def __init__(self, rules):
+        self.units = {unit for rule in rules if rule.units for unit in rule.units}
+        self.functions = {code for rule in rules if rule.functions for code in rule.functions}
+        self.entries = {}
+        for unit in self.units | {ANY}:
+            for function in self.functions | {ANY}:
+                self.entries[unit, function] = Entry([
+                    rule for rule in rules
+                    if (rule.units is None or unit in rule.units) and (rule.functions is None or function in rule.functions)
+                ])
+
+    def entry(self, unit: int, function: int) -> Entry:
+        return self.entries[unit if unit in self.units else ANY, function if function in self.functions else ANY]
+
+
+def request_ranges(view, pos: int, length: int, function: int):
+    """(first, last) address ranges of the request ADU at pos, None if it is too short."""
+    fields = ADDRESS_FIELDS.get(function)
+    if fields is None:
+        return ()
+    if length - 2 < fields.size:
+        return None
+    values = fields.unpack_from(view, pos + 8)
+    if function == 23:
+        return ((values[0], values[0] + max(values[1], 1) - 1), (values[2], values[2] + max(values[3], 1) - 1))
+    if len(values) == 2:
+        return ((values[0], values[0] + max(values[1], 1) - 1),)
+    return ((values[0], values[0]),)
+
+
+class Side(asyncio.BufferedProtocol):
+    """One end of a proxied connection, passing what it receives on to the other end."""
+
+    def __init__(self, connection, filtered: bool):
+        self.connection = connection
+        self.filtered = filtered
+        self.transport = None
+        self.peer: Side | None = None
+        self.buffer = memoryview(bytearray(BUFFER_SIZE))
+        # received data not yet passed on, e.g. the start of an ADU
+        self.start = 0
+        self.end = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def get_buffer(self, sizehint):
+        if len(self.buffer) - self.end < MAX_ADU:
+            self.renew()
+        return self.buffer[self.end:]
+
+    def renew(self):
+        """Move the data not passed on yet to the front, of a new buffer if the peer still sends from this one."""
+        leftover = bytes(self.buffer[self.start:self.end])
+        if self.peer.transport.get_write_buffer_size():
+            self.buffer = memoryview(bytearray(BUFFER_SIZE))
+        self.buffer[:len(leftover)] = leftover
+        self.start, self.end = 0, len(leftover)
+
+    def buffer_updated(self, nbytes):
+        self.end += nbytes
+        if self.connection.closed:
+            return
+        if self.filtered:
+            self.start = self.connection.filter(self.buffer, self.start, self.end)
+        else:
+            self.peer.transport.write(self.buffer[self.start:self.end])
+            self.start = self.end
+        if self.start == self.end and not self.peer.transport.get_write_buffer_size():
+            self.start = self.end = 0
+
+    def pause_writing(self):
+        # the peer sends faster than this side's transport can take
+        self.peer.transport.pause_reading()
+
+    def resume_writing(self):
+        self.peer.transport.resume_reading()
+
+    def connection_lost(self, exc):
+        self.connection.close()
+
+
+class ClientSide(Side):
+    """The client end, which opens the upstream connection once accepted."""
+
+    def connection_made(self, transport):
+        super().connection_made(transport)
+        self.connection.accepted(transport)
+
+
+class Connection:
+    """A client connection and its upstream connection."""
+
+    def __init__(self, proxy):
+        self.proxy = proxy
+        self.client = ClientSide(self, filtered=True)
+        self.server = Side(self, filtered=False)
+        self.client.peer, self.server.peer = self.server, self.client
+        self.name = "?"
+        self.table = None
+        self.counts = Counter()
+        # sids already logged for this connection
+        self.logged = set()
+        self.closed = False
+        self.opening = None
+
+    def accepted(self, transport):
+        host, port = transport.get_extra_info("peername")[:2]
+        self.name = f"{host}:{port}"
+        self.table = self.proxy.table(ipaddress.ip_address(host), port)
+        transport.pause_reading()
+        self.opening = asyncio.create_task(self.open(transport))
+
+    async def open(self, transport):
+        proxy = self.proxy
+        try:
+            await asyncio.get_running_loop().create_connection(lambda: self.server, proxy.upstream_host, proxy.upstream_port)
+        except OSError as exc:
+            _logger.warning(f"{self.name}: cannot connect to {proxy.upstream_host}:{proxy.upstream_port}: {exc}")
+            transport.abort()
+            return
+        if self.closed:
+            # the client went away while connecting
+            self.server.transport.close()
+            return
+        transport.resume_reading()
+
+    def filter(self, view, start: int, end: int) -> int:
+        """Forward the allowed complete ADUs from start to end, returns the position of the first incomplete one."""
+        pos = run = start
+        write = self.server.transport.write
+        while end - pos >= 8:
+            _, protocol, length, unit = MBAP.unpack_from(view, pos)
+            if protocol != 0 or not 2 <= length <= MAX_ADU - 6:
+                _logger.warning(f"{self.name}: invalid Modbus/TCP header, closing")
+                self.counts["invalid"] += 1
+                self.close()
+                return end
+            size = 6 + length
+            if end - pos < size:
+                break
+            function = view[pos + 7]
+            entry = self.table.entry(unit, function)
+            rule = entry.rule
+            if entry.ranges:
+                ranges = request_ranges(view, pos, length, function)
+                rule = self.proxy.malformed if ranges is None else entry.match(ranges) if ranges else rule
+            if rule is None:
+                rule = self.proxy.default
+            if rule is not None and rule.action != "pass":
+                self.report(rule, unit, function, view, pos, length)
+            if rule is None or rule.forward:
+                self.counts["forwarded"] += 1
+                pos += size
+                continue
+            # pass on the allowed requests before this one
+            if run < pos:
+                write(view[run:pos])
+            pos += size
+            run = pos
+            self.counts["dropped"] += 1
+            if rule.action == "reject":
+                self.counts["rejected"] += 1
+                self.client.transport.abort()
+                self.close()
+                return end
+        if run < pos:
+            write(view[run:pos])
+        return pos
+
+    def report(self, rule, unit, function, view, pos, length):
+        self.proxy.hits[rule.sid] += 1
+        if rule.action == "sdrop":
+            return
+        ranges = request_ranges(view, pos, length, function)
+        where = f" address {ranges[0][0]}" if ranges else ""
+        message = f"{self.name}: {rule}, unit {unit} {function_name(function)}{where}"
+        if rule.sid in self.logged:
+            _logger.debug(message)
+        else:
+            self.logged.add(rule.sid)
+            _logger.warning(message + " (further matches of this connection are counted only)")
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        for side in (self.client, self.server):
+            if side.transport:
+                side.transport.close()
+        self.proxy.counts.update(self.counts)
+        if self.counts["dropped"]:
+            _logger.info(f"{self.name}: closed, {self.counts['forwarded']} requests forwarded, {self.counts['dropped']} dropped")
+
+
+class Proxy:
+    """Modbus/TCP proxy filtering the requests to one upstream server."""
+
+    def __init__(self, rules, upstream_host: str, upstream_port: int = MODBUS_PORT, default: str = "pass"):
+        self.rules = rules
+        self.upstream_host = upstream_host
+        self.upstream_port = upstream_port
+        self.upstream = ipaddress.ip_address(socket.getaddrinfo(upstream_host, upstream_port, proto=socket.IPPROTO_TCP)[0][4][0])
+        self.default = None if default == "pass" else self.pseudo_rule(default, "no rule allows the request")
+        # requests which are too short to check their addresses against the rules
+        self.malformed = self.pseudo_rule("drop", "malformed request")
+        # tables are per client address, and port if a rule names source ports
+        self.by_port = any(not rule.src_ports.any for rule in rules)
+        self.tables = {}
+        self.counts = Counter()
+        self.hits = Counter()
+
+    @staticmethod
+    def pseudo_rule(action, msg):
+        return Rule(action, None, None, False, None, None, {"msg": msg}, 0)
+
+    def table(self, client, port: int) -> RuleTable:
+        key = (client, port) if self.by_port else client
+        table = self.tables.get(key)
+        if table is None:
+            if len(self.tables) >= MAX_TABLES:
+                self.tables.clear()
+            rules = [rule for rule in self.rules if rule.applies(client, port, self.upstream, self.upstream_port)]
+            table = self.tables[key] = RuleTable(rules)
+        return table
+
+    def protocol(self):
+        return Connection(self).client
+
+    async def serve(self, host: str, port: int):
+        server = await asyncio.get_running_loop().create_server(self.protocol, host or None, port, reuse_address=True)
+        _logger.info(f"### Filtering Modbus/TCP on {host or '*'}:{port} to {self.upstream_host}:{self.upstream_port}, {len(self.rules)} rules")
+        async with server:
+            await server.serve_forever()
+
+
+def host_port(value: str, default_port: int = MODBUS_PORT) -> tuple[str, int]:
+    host, colon, port = value.rpartition(":")
+    return (host, int(port)) if colon else (value, default_port)
+
+
+def setup_args(cmdline=None):
+    parser = argparse.ArgumentParser(prog="modbus_proxy.py", description="Filter Modbus/TCP requests by Snort rules.")
+    parser.add_argument("upstream", help="server to forward to, host[:port] (default port 502)")
+    parser.add_argument("--listen", default=f"0.0.0.0:{MODBUS_PORT}", help=f"address to listen on (default 0.0.0.0:{MODBUS_PORT})")
+    parser.add_argument("--rules", type=Path, default=RULES, help="Snort rules file (default custom.rules)")
+    parser.add_argument("--var", action="append", default=[], metavar="NAME=VALUE", help="define a rule variable, e.g. HOME_NET=192.168.60.0/24")
+    parser.add_argument("--default", choices=("pass", "drop"), default="pass", help="requests no rule matches (default pass, as Snort)")
+    parser.add_argument("--log", choices=["critical", "error", "warning", "info", "debug"], default="info", help="log level (default info)")
+    return parser.parse_args(cmdline)
+
+
+async def run(proxy, host, port):
+    loop = asyncio.get_running_loop()
+    task = asyncio.current_task()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, task.cancel)
+    try:
+        await proxy.serve(host, port)
+    except asyncio.CancelledError:
+        pass
+    finally:
+        counts = ", ".join(f"{key} {value}" for key, value in sorted(proxy.counts.items())) or "no requests"
+        _logger.info(f"### Stopping, {counts}; matches by sid: {dict(sorted(proxy.hits.items()))}")
+
+
+def main(cmdline=None):
+    args = setup_args(cmdline)
+    logging.basicConfig(level=args.log.upper(), format="%(asctime)s %(levelname)s %(message)s")
+    try:
+        variables = dict(item.split("=", 1) for item in args.var)
+        rules = parse_rules(args.rules.read_text(), variables)
+        upstream_host, upstream_port = host_port(args.upstream)
+        listen_host, listen_port = host_port(args.listen)
+        proxy = Proxy(rules, upstream_host, upstream_port, args.default)
+    except (OSError, ValueError) as exc:
+        print(f"modbus_proxy.py: {exc}", file=sys.stderr)
+        return 1
+    asyncio.run(run(proxy, listen_host, listen_port))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
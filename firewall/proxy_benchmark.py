@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+"""
+Benchmark of modbus_proxy.py: latency it adds per request, and the throughput it sustains.
+
+A stub Modbus server (answering reads with fixed registers and echoing writes) and the
+proxy are started as subprocesses on loopback. The proxy filters with custom.rules, with
+the SCADA address replaced by 127.0.0.1 and port 502 by the stub's port, so requests from
+127.0.0.1 are allowed and those from 127.0.0.2 are dropped.
+
+- latency: one connection sends read holding registers requests one at a time, directly
+  to the stub and through the proxy. The difference of the percentiles is the latency
+  the proxy adds.
+- throughput: --connections connections keep --window requests each in flight for
+  --duration seconds, directly and through the proxy.
+- filtering: a request from 127.0.0.2 must go unanswered, one from 127.0.0.1 answered.
+
+Only the standard library is needed. Both client and servers share the CPUs of the
+host, so compare the direct and proxied figures of the same run.
+
+usage: proxy_benchmark.py [-h] [--requests REQUESTS] [--connections CONNECTIONS]
+                          [--window WINDOW] [--duration DURATION] [--port PORT] [--json]
+
+Examples:
+    proxy_benchmark.py
+    proxy_benchmark.py --connections 8 --window 16 --duration 10 --json > proxy.json
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import socket
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+
+HERE = Path(__file__).resolve().parent
+SCADA = "192.168.60.10"
+# requests are read holding registers 0-9 of unit 1
+REQUEST = struct.Struct(">HHHBBHH")
+MBAP = struct.Struct(">HHHB")
+
+
+async def stub_connection(reader, writer):
+    """Answer the requests of one connection, pipelined requests included."""
+    registers = bytes(range(250))
+    try:
+        while True:
+            header = await reader.readexactly(7)
+            tid, _, length, unit = MBAP.unpack(header)
+            pdu = await reader.readexactly(length - 1)
+            function = pdu[0]
+            if function in (1, 2, 3, 4):
+                count = struct.unpack_from(">H", pdu, 3)[0]
+                size = count * 2 if function in (3, 4) else (count + 7) // 8
+                body = bytes([function, size]) + registers[:size]
+            elif function in (5, 6, 15, 16):
+                body = pdu[:5]
+            else:
+                body = bytes([function | 0x80, 1])
+            writer.write(MBAP.pack(tid, 0, len(body) + 1, unit) + body)
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def stub(port):
+    server = await asyncio.start_server(stub_connection, "127.0.0.1", port, reuse_address=True)
+    async with server:
+        await server.serve_forever()
+
+
+def request(tid: int, function: int = 3) -> bytes:
+    return REQUEST.pack(tid, 0, 6, 1, function, 0, 10)
+
+
+def receive_adu(sock) -> bytes:
+    data = b""
+    while len(data) < 7 or len(data) < 6 + MBAP.unpack_from(data)[2]:
+        chunk = sock.recv(4096)
+        if not chunk:
+            raise ConnectionError("connection closed")
+        data += chunk
+    return data
+
+
+def connect(port: int, source: str = "127.0.0.1", timeout: float = 5.0):
+    sock = socket.socket()
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.settimeout(timeout)
+    sock.bind((source, 0))
+    sock.connect(("127.0.0.1", port))
+    return sock
+
+
+def wait_for(port: int, timeout: float = 10.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            connect(port).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def percentiles(samples) -> dict:
+    samples = sorted(samples)
+    pick = lambda q: round(samples[min(len(samples) - 1, int(q * len(samples)))] * 1e6, 1)
+    return {"count": len(samples), "mean_us": round(statistics.fmean(samples) * 1e6, 1), "p50_us": pick(0.5), "p99_us": pick(0.99)}
+
+
+def latency(port: int, requests: int) -> dict:
+    """Round trip times of requests sent one at a time."""
+    samples = []
+    with connect(port) as sock:
+        for tid in range(requests):
+            start = time.perf_counter()
+            sock.sendall(request(tid & 0xFFFF))
+            receive_adu(sock)
+            samples.append(time.perf_counter() - start)
+    # the first requests warm up the connection
+    return percentiles(samples[min(100, requests // 10):])
+
+
+async def pipeline(port: int, window: int, deadline: float) -> int:
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    tid = answered = 0
+    for tid in range(window):
+        writer.write(request(tid))
+    while time.perf_counter() < deadline:
+        header = await reader.readexactly(7)
+        await reader.readexactly(MBAP.unpack(header)[2] - 1)
+        answered += 1
+        tid = (tid + 1) & 0xFFFF
+        writer.write(request(tid))
+    writer.close()
+    return answered
+
+
+def throughput(port: int, connections: int, window: int, duration: float) -> dict:
+    """Responses per second with connections x window requests in flight."""
+    async def run():
+        deadline = time.perf_counter() + duration
+        return sum(await asyncio.gather(*(pipeline(port, window, deadline) for _ in range(connections))))
+    start = time.perf_counter()
+    answered = asyncio.run(run())
+    return {"requests": answered, "requests_per_s": round(answered / (time.perf_counter() - start))}
+
+
+def filtered(port: int, source: str) -> bool:
+    """Whether a read from the source address goes unanswered."""
+    with connect(port, source, timeout=1.0) as sock:
+        sock.sendall(request(1))
+        try:
+            receive_adu(sock)
+        except (socket.timeout, ConnectionError):
+            return True
+    return False
+
+
+def benchmark(args) -> dict:
+    stub_port, proxy_port = args.port, args.port + 1
+    rules = (HERE / "custom.rules").read_text().replace(SCADA, "127.0.0.1").replace(" 502 ", f" {stub_port} ")
+    processes = []
+    with tempfile.NamedTemporaryFile("w", suffix=".rules") as file:
+        file.write(rules)
+        file.flush()
+        try:
+            processes.append(subprocess.Popen([sys.executable, __file__, "--stub", "--port", str(stub_port)]))
+            processes.append(subprocess.Popen([
+                sys.executable, str(HERE / "modbus_proxy.py"), "--log", "error", "--rules", file.name,
+                "--listen", f"127.0.0.1:{proxy_port}", f"127.0.0.1:{stub_port}",
+            ]))
+            wait_for(stub_port)
+            wait_for(proxy_port)
+            result = {
+                "latency": {"direct": latency(stub_port, args.requests), "proxy": latency(proxy_port, args.requests)},
+                "throughput": {
+                    "direct": throughput(stub_port, args.connections, args.window, args.duration),
+                    "proxy": throughput(proxy_port, args.connections, args.window, args.duration),
+                },
+                "filtering": {
+                    "allowed_source_answered": not filtered(proxy_port, "127.0.0.1"),
+                    "other_source_dropped": filtered(proxy_port, "127.0.0.2"),
+                },
+            }
+        finally:
+            for process in processes:
+                process.terminate()
+                process.wait()
+    direct, proxy = result["latency"]["direct"], result["latency"]["proxy"]
+    result["latency"]["added_us"] = {key: round(proxy[key] - direct[key], 1) for key in ("mean_us", "p50_us", "p99_us")}
+    return result
+
+
+def print_result(result):
+    added = result["latency"]["added_us"]
+    for path in ("direct", "proxy"):
+        lat, rate = result["latency"][path], result["throughput"][path]
+        print(f"{path:7} latency mean {lat['mean_us']:8.1f} us  p50 {lat['p50_us']:8.1f} us  p99 {lat['p99_us']:8.1f} us"
+              f"   throughput {rate['requests_per_s']:7d} requests/s")
+    print(f"added   latency mean {added['mean_us']:8.1f} us  p50 {added['p50_us']:8.1f} us  p99 {added['p99_us']:8.1f} us")
+    print(f"filtering: {result['filtering']}")
+
+
+def setup_args(cmdline=None):
+    parser = argparse.ArgumentParser(prog="proxy_benchmark.py", description="Benchmark modbus_proxy.py on loopback.")
+    parser.add_argument("--requests", type=int, default=5000, help="sequential requests of the latency test (default 5000)")
+    parser.add_argument("--connections", type=int, default=4, help="connections of the throughput test (default 4)")
+    parser.add_argument("--window", type=int, default=8, help="requests in flight per connection (default 8)")
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds of each throughput test (default 5)")
+    parser.add_argument("--port", type=int, default=15020, help="port of the stub server, the proxy listens on the next one (default 15020)")
+    parser.add_argument("--json", action="store_true", help="print the result as JSON")
+    parser.add_argument("--stub", action="store_true", help=argparse.SUPPRESS)
+    return parser.parse_args(cmdline)
+
+
+def main(cmdline=None):
+    args = setup_args(cmdline)
+    if args.stub:
+        try:
+            asyncio.run(stub(args.port))
+        except KeyboardInterrupt:
+            pass
+        return 0
+    try:
+        result = benchmark(args)
+    except (OSError, ValueError) as exc:
+        print(f"proxy_benchmark.py: {exc}", file=sys.stderr)
+        return 1
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print_result(result)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
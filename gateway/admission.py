@@ -0,0 +1,271 @@
+"""
+Admission control for the gateway's Modbus server.
+
+pymodbus answers every request as soon as it arrives, on the loop which also polls the
+PLCs, so a single client flooding port 502 (e.g. inject.py in a loop) takes time from the
+poll cycle and from every other client. GatewayModbusServer admits requests per client
+(IP address) instead:
+- a token bucket of RATE requests per second with bursts of BURST, shared by all the
+  connections of a client, delays the requests beyond the rate
+- every connection queues at most QUEUE_SIZE requests. While its queue is full the
+  gateway neither decodes further requests nor reads from the connection, so TCP flow
+  control holds the client back
+- a client has at most MAX_CONNECTIONS connections, further ones are closed
+
+A client is forgotten, with its metrics, once its last connection is closed and its
+token bucket is full again, so reconnecting does not reset the rate limit.
+
+A flood therefore fills the queue of the offending client only, and costs the gateway at
+most RATE requests per second of work.
+
+Reads of the same device, function, address and count are answered from one encoded
+response (a snapshot) while the datablock has not changed, i.e. until the next poll of
+the PLC or client write. Many SCADA / HMI clients polling the same registers cost one
+datastore read per poll cycle.
+
+pymodbus' request handler decodes one request per received chunk, answers it later from
+its last_pdu, and drops the data received meanwhile when it sends, so pipelined requests
+were lost. AdmissionHandler keeps the received data until every request is queued.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from collections import Counter
+
+from pymodbus.constants import ExcCodes
+from pymodbus.exceptions import ModbusIOException, NoSuchIdException
+from pymodbus.pdu import ExceptionResponse
+from pymodbus.server import ModbusTcpServer
+from pymodbus.server.requesthandler import ServerRequestHandler
+from pymodbus.transaction import TransactionManager
+
+
+_logger = logging.getLogger(__file__)
+
+# requests per second and burst of a client
+RATE = 50.0
+BURST = 100
+# requests queued per connection, and connections per client
+QUEUE_SIZE = 32
+MAX_CONNECTIONS = 8
+# rate and burst of particular clients by IP address, e.g. {"192.168.65.20": (200.0, 400)}
+CLIENT_RATES = {}
+# encoded read responses kept, the cache is emptied when full
+MAX_SNAPSHOTS = 1024
+
+# reads answered from snapshots: coils, discrete inputs, holding and input registers
+READ_FUNCTION_CODES = (0x01, 0x02, 0x03, 0x04)
+
+
+class TokenBucket:
+    """Rate limit allowing bursts, which schedules requests rather than refusing them."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def take(self) -> float:
+        """Take a token, returns the seconds to wait until it is available."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        # the balance goes negative while requests wait, so they are spaced out at the rate
+        self.tokens -= 1
+        return max(0.0, -self.tokens / self.rate)
+
+    def refill_time(self) -> float:
+        """Seconds until the bucket is full again."""
+        tokens = self.tokens + (time.monotonic() - self.updated) * self.rate
+        return max(0.0, (self.burst - tokens) / self.rate)
+
+
+class Client:
+    """Admission state and statistics of one client address."""
+
+    def __init__(self, host: str):
+        self.host = host
+        rate, burst = CLIENT_RATES.get(host, (RATE, BURST))
+        self.bucket = TokenBucket(rate, burst)
+        self.connections = 0
+        self.refused = 0
+        # requests by result: served, snapshot, and throttled of those
+        self.counts = Counter()
+
+
+class AdmissionHandler(ServerRequestHandler):
+    """Request handler of one client connection, serving its queue at the client's rate."""
+
+    def __init__(self, owner, trace_packet, trace_pdu, trace_connect):
+        super().__init__(owner, trace_packet, trace_pdu, trace_connect)
+        self.client = None
+        # (request, time it was queued)
+        self.queue = asyncio.Queue(QUEUE_SIZE)
+        self.worker = None
+        # data received and not yet decoded, pymodbus empties its receive buffer on every send
+        self.received = b""
+        self.paused = False
+
+    def callback_connected(self) -> None:
+        super().callback_connected()
+        peer = self.transport.get_extra_info("peername")
+        self.client = self.server.client(peer[0] if peer else "")
+        if self.client.connections >= MAX_CONNECTIONS:
+            self.client.refused += 1
+            _logger.warning(f"Modbus client {self.client.host} exceeds {MAX_CONNECTIONS} connections, closing")
+            self.client = None
+            self.close()
+            return
+        self.client.connections += 1
+        self.worker = asyncio.create_task(self.serve())
+
+    def callback_disconnected(self, exc: Exception | None) -> None:
+        super().callback_disconnected(exc)
+        self.release()
+
+    def close(self, reconnect: bool = False) -> None:
+        # closing the connection from this side, e.g. at shutdown, does not call callback_disconnected
+        super().close(reconnect)
+        self.release()
+
+    def release(self):
+        if self.worker:
+            self.worker.cancel()
+            self.worker = None
+        if self.client:
+            self.client.connections -= 1
+            if not self.client.connections:
+                self.server.idle(self.client)
+            self.client = None
+
+    def callback_data(self, data: bytes, addr: tuple | None = None) -> int:
+        if self.worker is not None:
+            self.received += data
+            self.decode()
+        return len(data)
+
+    def decode(self):
+        """Queue the complete requests received, as many as the queue takes."""
+        used = 0
+        while used < len(self.received):
+            if self.queue.full():
+                # the rest waits until the queue drains
+                if not self.paused:
+                    self.paused = True
+                    self.transport.pause_reading()
+                break
+            try:
+                length = TransactionManager.callback_data(self, self.received[used:])
+            except ModbusIOException:
+                response = ExceptionResponse(40, exception_code=ExcCodes.ILLEGAL_FUNCTION)
+                self.server_send(response, 0)
+                used = len(self.received)
+                break
+            used += length
+            if not self.last_pdu:
+                break
+            self.queue.put_nowait((self.last_pdu, time.perf_counter()))
+        self.received = self.received[used:]
+
+    async def serve(self):
+        """Answer the queued requests, at the client's rate."""
+        client = self.client
+        while True:
+            request, received = await self.queue.get()
+            wait = client.bucket.take()
+            if wait:
+                if not client.counts["throttled"]:
+                    _logger.warning(f"Modbus client {client.host} exceeds its rate limit of {client.bucket.rate:g} requests/s")
+                client.counts["throttled"] += 1
+                await asyncio.sleep(wait)
+            await self.answer(request)
+            self.server.metrics.observe("gateway_server_request_seconds", time.perf_counter() - received, client=client.host)
+            if self.paused and self.queue.qsize() <= QUEUE_SIZE // 2:
+                self.paused = False
+                self.decode()
+                if not self.paused:
+                    self.transport.resume_reading()
+
+    async def answer(self, request):
+        """Answer a request from a snapshot or the datastore, as ServerRequestHandler does."""
+        try:
+            context = self.server.context[request.dev_id]
+            key = version = None
+            if request.function_code in READ_FUNCTION_CODES:
+                block = context.store[context.decode(request.function_code)]
+                version = getattr(block, "version", None)
+                key = (request.dev_id, request.function_code, request.address, request.count)
+                snapshot = self.server.snapshots.get(key)
+                if snapshot and snapshot[0] is block and snapshot[1] == version:
+                    self.client.counts["snapshot"] += 1
+                    self.low_level_send(self.framer.encode(snapshot[2], request.dev_id, request.transaction_id))
+                    return
+            response = await request.update_datastore(context)
+            if version is not None and not isinstance(response, ExceptionResponse):
+                self.server.snapshot(key, block, version, response)
+        except NoSuchIdException:
+            if self.server.ignore_missing_devices:
+                return
+            _logger.debug(f"Modbus request for unknown device id {request.dev_id}")
+            response = ExceptionResponse(request.function_code, ExcCodes.GATEWAY_NO_RESPONSE)
+        except Exception as exc:  # pylint: disable=broad-except
+            _logger.error(f"Modbus request failed: {exc}")
+            response = ExceptionResponse(request.function_code, ExcCodes.DEVICE_FAILURE)
+        self.client.counts["served"] += 1
+        self.reply(request, response)
+
+    def reply(self, request, response):
+        response.transaction_id = request.transaction_id
+        response.dev_id = request.dev_id
+        self.server_send(response, None)
+
+
+class GatewayModbusServer(ModbusTcpServer):
+    """Modbus TCP server admitting the requests of every client separately."""
+
+    def __init__(self, context, metrics, **kwargs):
+        super().__init__(context, **kwargs)
+        self.metrics = metrics
+        self.clients: dict[str, Client] = {}
+        # (device id, function code, address, count) -> (datablock, version, encoded response)
+        self.snapshots = {}
+
+    def callback_new_connection(self):
+        return AdmissionHandler(self, self.trace_packet, self.trace_pdu, self.trace_connect)
+
+    def client(self, host: str) -> Client:
+        if host not in self.clients:
+            self.clients[host] = Client(host)
+        return self.clients[host]
+
+    def idle(self, client: Client):
+        """Forget a client without connections once its token bucket is full again."""
+        asyncio.get_running_loop().call_later(client.bucket.refill_time(), self.forget, client)
+
+    def forget(self, client: Client):
+        if client.connections or self.clients.get(client.host) is not client:
+            return
+        if client.bucket.refill_time() > 0:
+            # it connected and spent tokens meanwhile
+            self.idle(client)
+            return
+        del self.clients[client.host]
+        self.metrics.forget(client=client.host)
+
+    def snapshot(self, key, block, version, response):
+        if len(self.snapshots) >= MAX_SNAPSHOTS:
+            self.snapshots.clear()
+        payload = response.function_code.to_bytes(1, "big") + response.encode()
+        self.snapshots[key] = (block, version, payload)
+
+    def collect(self):
+        """Metrics collector of the clients."""
+        for client in self.clients.values():
+            labels = {"client": client.host}
+            yield "gateway_server_connections", labels, client.connections
+            yield "gateway_server_refused_connections_total", labels, client.refused
+            for result, count in client.counts.items():
+                yield "gateway_server_requests_total", {**labels, "result": result}, count
@@ -0,0 +1 @@
+../simulation/datablock.py
\ No newline at end of file
@@ -0,0 +1,222 @@
+"""
+Streaming anomaly detection against the process model of the dam.
+
+The simulation (simulation/engine.py) steps the dam once per tick, 0.5 s by default:
+- pump on: water level +10 per tick, gate open: water level -25 per tick
+- water level > 2100: gate opens, pump turns off
+- water level < 1700: gate closes, pump turns on
+
+Observations of the dam are checked against every state the model can have reached
+since the previous observation. An observation is a full gateway poll, or a single
+coil / register response seen on the network, so any of its points may be missing.
+The detector keeps the few model states consistent with everything observed so far
+(hypotheses), each with the number of ticks it assumes since an anchor time, and
+advances them by the number of ticks which fit in the time elapsed since the anchor.
+Counting from an anchor rather than from the previous observation catches values which
+stop moving, however often they are observed. Commands written through the gateway add
+hypotheses with the commanded coil.
+
+An observation which no hypothesis explains raises an alert, e.g.
+- the water level jumping to 0, or moving against the pump / gate state (spoofing.filter)
+- the pump or gate changing without a command (coils inverted in transit, or written
+  to the PLC directly as inject.py does)
+- values replayed from an earlier cycle, which do not fit the current phase
+and the detector then resynchronises on the observed values. Observations older than
+the previous one are reported as replayed and ignored.
+
+Memory per device is bounded by MAX_HYPOTHESES states, and the statistics are
+exponentially weighted over WINDOW seconds, so no history is kept.
+"""
+from __future__ import annotations
+
+import math
+from collections import Counter, namedtuple
+
+
+# model defaults, as in simulation/engine.py and clock.py
+TICK = 0.5
+PUMP_RATE = 10
+GATE_RATE = 25
+LEVEL_HIGH = 2100
+LEVEL_LOW = 1700
+LEVEL_MAX = 65535
+
+# ticks the model is advanced beyond the time elapsed, for jitter of the poll and tick times
+JITTER = 0.2
+# longest gap between observations which is checked, longer gaps resynchronise
+MAX_TICKS = 64
+# ticks after which the anchor moves to the latest observation, so clock drift does not add up
+ANCHOR_TICKS = 32
+MAX_HYPOTHESES = 16
+# seconds over which statistics are averaged
+WINDOW = 60.0
+
+POINTS = ("level", "pump", "gate")
+
+Alert = namedtuple("Alert", "kind message")
+
+
+class DamModel:
+    """Dynamics of one reservoir, stepped on (level, pump, gate) tuples."""
+
+    def __init__(self, tick=TICK, tolerance=0, pump_rate=PUMP_RATE, gate_rate=GATE_RATE,
+                 high=LEVEL_HIGH, low=LEVEL_LOW):
+        if tick <= 0 or tolerance < 0:
+            raise ValueError("model tick must be positive and tolerance not negative")
+        self.tick = tick
+        self.tolerance = tolerance
+        self.pump_rate = pump_rate
+        self.gate_rate = gate_rate
+        self.high = high
+        self.low = low
+
+    def step(self, state: tuple) -> tuple:
+        level, pump, gate = state
+        level += self.pump_rate * pump - self.gate_rate * gate
+        high = level > self.high
+        low = level < self.low
+        pump = (pump and not high) or low
+        gate = (gate or high) and not low
+        return min(max(level, 0), LEVEL_MAX), pump, gate
+
+
+class Detector:
+    """Checks the observations of one reservoir against its model."""
+
+    def __init__(self, name: str, model: DamModel, window: float = WINDOW):
+        self.name = name
+        self.model = model
+        self.window = window
+        # (level, pump, gate, ticks since the anchor)
+        self.hypotheses: set[tuple] = set()
+        self.anchor = None
+        self.last_time = None
+        self.observations = 0
+        self.alerts = Counter()
+        # exponentially weighted share of observations raising an alert, and level residual
+        self.alert_rate = 0.0
+        self.residual = 0.0
+
+    @classmethod
+    def from_config(cls, name: str, config: dict):
+        """Build the detector of a tag map "model" entry."""
+        config = dict(config)
+        if config.pop("type", "dam") != "dam":
+            raise ValueError(f"device {name}: unknown process model")
+        for point in POINTS:
+            config.pop(point, None)
+        return cls(name, DamModel(**config))
+
+    def command(self, point: str, value: bool, time: float | None = None):
+        """A command was written to a coil at time, which the next observations may show."""
+        index = POINTS.index(point)
+        first = last = None
+        if time is not None and self.anchor is not None:
+            ticks = (max(time, self.last_time) - self.anchor) / self.model.tick
+            first = max(0, math.floor(ticks - JITTER))
+            last = math.ceil(ticks + JITTER)
+        variants = set()
+        for hypothesis in self.hypotheses:
+            # the command takes effect on the states the hypothesis can have reached by then
+            state = hypothesis[:3]
+            start = hypothesis[3] if first is None else max(hypothesis[3], first)
+            for _ in range(hypothesis[3], start):
+                state = self.model.step(state)
+            for n in range(start, (start if last is None else last) + 1):
+                changed = list(state)
+                changed[index] = bool(value)
+                variants.add((*changed, n))
+                state = self.model.step(state)
+        self._keep(self.hypotheses | variants)
+
+    def _keep(self, states):
+        if len(states) > MAX_HYPOTHESES:
+            # deterministic choice, the hypotheses are only a bound on the search
+            states = sorted(states)[:MAX_HYPOTHESES]
+        self.hypotheses = set(states)
+
+    def _matches(self, state, observed) -> bool:
+        level, pump, gate = observed
+        return (
+            (level is None or abs(state[0] - level) <= self.model.tolerance)
+            and (pump is None or state[1] == pump)
+            and (gate is None or state[2] == gate)
+        )
+
+    def _resync(self, time, observed):
+        """Take the observed points as the truth, completing missing points from the hypotheses."""
+        level, pump, gate = observed
+        if level is None:
+            states = {(h[0], h[1] if pump is None else pump, h[2] if gate is None else gate, 0) for h in self.hypotheses}
+        else:
+            pumps = (False, True) if pump is None else (pump,)
+            gates = (False, True) if gate is None else (gate,)
+            states = {(level, p, g, 0) for p in pumps for g in gates}
+        self.anchor = time
+        self._keep(states)
+
+    def observe(self, time: float, level=None, pump=None, gate=None) -> list[Alert]:
+        """Check an observation made at time (seconds), returns the alerts it raises."""
+        observed = (level, None if pump is None else bool(pump), None if gate is None else bool(gate))
+        if self.last_time is not None and time < self.last_time:
+            return self._alert([Alert("replayed", f"observation {self.last_time - time:.3f}s older than the previous one")], 0.0)
+
+        elapsed = 0.0 if self.last_time is None else time - self.last_time
+        self.observations += 1
+        self.last_time = time
+        if not self.hypotheses or elapsed / self.model.tick > MAX_TICKS:
+            if level is not None or self.hypotheses:
+                self._resync(time, observed)
+            return []
+
+        ticks = (time - self.anchor) / self.model.tick
+        first = max(0, math.floor(ticks - JITTER))
+        last = math.ceil(ticks + JITTER)
+        candidates = set()
+        residual = None
+        for hypothesis in self.hypotheses:
+            state = hypothesis[:3]
+            for n in range(hypothesis[3], last + 1):
+                if n >= first:
+                    if level is not None:
+                        distance = abs(state[0] - level)
+                        residual = distance if residual is None else min(residual, distance)
+                    if self._matches(state, observed):
+                        candidates.add((state[0] if level is None else level, state[1], state[2], n))
+                if n < last:
+                    state = self.model.step(state)
+
+        if not candidates:
+            message = self._describe(observed, first, last)
+            self._resync(time, observed)
+            return self._alert([Alert("impossible_transition", message)], elapsed, residual)
+
+        if first > ANCHOR_TICKS:
+            # the ticks up to this observation are settled, count on from here
+            self.anchor = time
+            candidates = {(h[0], h[1], h[2], 0) for h in candidates}
+        self._keep(candidates)
+        return self._alert([], elapsed, residual)
+
+    def _describe(self, observed, first, last) -> str:
+        """Describe an observation and the states the model expected instead."""
+        expected = set()
+        for hypothesis in self.hypotheses:
+            state = hypothesis[:3]
+            for n in range(hypothesis[3], last + 1):
+                if n >= first:
+                    expected.add(state)
+                state = self.model.step(state)
+        seen = ", ".join(f"{point} {value}" for point, value in zip(POINTS, observed) if value is not None)
+        states = "; ".join(f"level {s[0]}, pump {s[1]}, gate {s[2]}" for s in sorted(expected)[:4])
+        return f"observed {seen}, expected {states}"
+
+    def _alert(self, alerts, elapsed, residual=None):
+        """Count alerts and update the windowed statistics."""
+        weight = 1 - math.exp(-elapsed / self.window)
+        self.alert_rate += weight * ((1.0 if alerts else 0.0) - self.alert_rate)
+        if residual is not None:
+            self.residual += weight * (residual - self.residual)
+        for alert in alerts:
+            self.alerts[alert.kind] += 1
+        return alerts
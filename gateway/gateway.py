@@ -1,37 +1,75 @@
 import asyncio
+import dataclasses
+import gc
 import logging
-import datetime
+import os
 from pathlib import Path
+import signal
 import socket
+import threading
 
 from asyncua import Server, ua
+from asyncua import __version__ as asyncua_version
+from asyncua.common.callback import CallbackType
+from asyncua.server import standard_address_space
+from asyncua.server.internal_server import InternalServer
+from asyncua.server.internal_session import InternalSession
 import pymodbus.client as modbusClient
 from pymodbus import ModbusDeviceIdentification
 from pymodbus import __version__ as pymodbus_version
-from pymodbus.server import StartAsyncTcpServer
 from pymodbus.datastore import (
     ModbusDeviceContext,
-    ModbusSequentialDataBlock,
     ModbusServerContext,
 )
 
 from asyncua.server.users import UserRole, User
 from asyncua.crypto.cert_gen import setup_self_signed_certificate
+from asyncua.crypto.permission_rules import SimpleRoleRuleset
+from asyncua.crypto.uacrypto import check_certificate, load_certificate
+from cryptography.hazmat.primitives import serialization
 from cryptography.x509.oid import ExtendedKeyUsageOID
 
+from admission import GatewayModbusServer
+from historian import HISTORY_DIR, Historian
+from metrics import Diagnostics, Metrics
+from plcio import PlcPool
+from publisher import Publisher
+from recorder import DUMP_MINUTES, FlightRecorder
+from sync import HookedDataBlock, SyncEngine
+from tagmap import TABLES, WRITABLE_TABLES, load_tagmap
+
 
 _logger = logging.getLogger(__file__)
 logging.getLogger('asyncua').setLevel("ERROR")
 
 ENABLE_SECURITY = True
+TAG_MAP = "tags.json"
+# record every polled sample and serve it through OPC UA HistoryRead
+ENABLE_HISTORY = True
+# record every PLC transaction, client command and alert in a ring buffer, dumped on
+# SIGUSR1, after an alert or through OPC UA (see recorder.py)
+ENABLE_RECORDER = True
+# DEBUG logging and asyncio debug mode, which slow down the gateway considerably
+DEBUG = False
+# standard OPC UA address space, built on the first start and loaded from here on later starts
+ADDRESS_SPACE_CACHE = Path("cache") / f"address-space-{asyncua_version}.pickle"
+# run the OPC UA server on an event loop in its own thread, so encrypting the messages of
+# many client sessions does not hold up the PLC polls
+OPCUA_THREAD = True
+# fastest publishing interval in ms granted to OPC UA subscriptions, faster requests are
+# revised to it, and the interval of particular users by user name
+MIN_PUBLISHING_INTERVAL = 100.0
+PUBLISHING_INTERVALS = {
+    'fuxa': 250.0,
+}
 
 
-def setup_modbus_client(description: str | None =None, cmdline: str | None = None) -> modbusClient.ModbusBaseClient:
+def setup_modbus_client(tagmap) -> modbusClient.ModbusBaseClient:
     """Run modbus client setup."""
     client: modbusClient.ModbusBaseClient | None = None
     client = modbusClient.AsyncModbusTcpClient(
-        '192.168.75.5',
-        port='502', 
+        tagmap.host,
+        port=tagmap.port,
         framer='socket',
         timeout=10,
         retries=3,
@@ -39,20 +77,31 @@ def setup_modbus_client(description: str | None =None, cmdline: str | None = Non
         reconnect_delay_max=10,
     )
 
-    _logger.info("### Setup modbus client with PLC.")
+    _logger.info(f"### Setup modbus client with PLC {tagmap.name}.")
 
     return client
 
 
-def setup_modbus_server():
-    """Run modbus server setup."""
-    device_context = ModbusDeviceContext(
-        di=ModbusSequentialDataBlock(0x00, [0] * 100),
-        co=ModbusSequentialDataBlock(0x00, [0] * 100),
-        hr=ModbusSequentialDataBlock(0x00, [0] * 100),
-        ir=ModbusSequentialDataBlock(0x00, [0] * 100))
-    
-    context = ModbusServerContext(devices=device_context, single=True)
+def setup_modbus_server(tagmaps, metrics):
+    """Run modbus server setup, with admission control of the clients (see admission.py)."""
+    devices = {}
+    for tagmap in tagmaps:
+        # size each table to cover the tag map, with at least 100 addresses
+        size = {table: 100 for table in TABLES}
+        for tag in tagmap.tags:
+            size[tag.table] = max(size[tag.table], tag.address + tag.count)
+
+        devices[tagmap.server_id] = ModbusDeviceContext(
+            di=HookedDataBlock(0x00, [0] * size["discrete_input"], bits=True),
+            co=HookedDataBlock(0x00, [0] * size["coil"], bits=True),
+            hr=HookedDataBlock(0x00, [0] * size["holding_register"]),
+            ir=HookedDataBlock(0x00, [0] * size["input_register"]))
+
+    # a single PLC answers on every device id, as before
+    if len(devices) == 1:
+        context = ModbusServerContext(devices=next(iter(devices.values())), single=True)
+    else:
+        context = ModbusServerContext(devices=devices, single=False)
     identity = ModbusDeviceIdentification(
         info_name={
             "VendorName": "Pymodbus",
@@ -65,14 +114,15 @@ def setup_modbus_server():
     )
 
     address = ('', '502')
-    server_task = asyncio.create_task(
-        StartAsyncTcpServer(
-            context=context,
-            identity=identity,
-            address=address,
-            framer="socket" 
-        )
+    server = GatewayModbusServer(
+        context,
+        metrics,
+        identity=identity,
+        address=address,
+        framer="socket",
     )
+    metrics.collect(server.collect)
+    server_task = asyncio.create_task(server.serve_forever())
     _logger.info("### Setup modbus gateway server.")
     return context, server_task
 
@@ -85,10 +135,102 @@ users_db =  {
 class UserManager:
     def get_user(self, iserver, username=None, password=None, certificate=None):
         if username in users_db and password == users_db[username]:
-            return User(role=UserRole.User)
+            return User(role=UserRole.User, name=username)
         return None
 
 
+class GatewayRuleset(SimpleRoleRuleset):
+    """Role based permissions which also let users modify their subscriptions.
+
+    Clients modify a subscription e.g. to accept the publishing interval revised by GatewaySession.
+    """
+
+    def __init__(self):
+        super().__init__()
+        modify = ua.NodeId(ua.ObjectIds.ModifySubscriptionRequest_Encoding_DefaultBinary)
+        self._permission_dict[UserRole.User].add(modify)
+        self._permission_dict[UserRole.Admin].add(modify)
+
+
+class GatewaySession(InternalSession):
+    """Session revising the publishing interval of its subscriptions to its user's fastest."""
+
+    async def create_subscription(self, params, callback, request_callback=None):
+        name = self.user.name if self.user else None
+        fastest = PUBLISHING_INTERVALS.get(name, MIN_PUBLISHING_INTERVAL)
+        if params.RequestedPublishingInterval < fastest:
+            params.RequestedPublishingInterval = fastest
+        return await super().create_subscription(params, callback, request_callback)
+
+
+class GatewayInternalServer(InternalServer):
+    """OPC UA server loading the standard address space from a snapshot.
+
+    Building the ~6000 standard nodes takes seconds, unpickling them a fraction of it.
+    The snapshot is taken right after the standard nodes are built, before any method
+    callbacks are bound, and is named after the asyncua version which built it. Equal
+    node ids, names and attribute values are shared between the nodes first, which
+    halves the objects to unpickle.
+    """
+
+    def create_session(self, name, user=User(role=UserRole.Anonymous), external=False):
+        return GatewaySession(self, self.aspace, self.subscription_service, name, user=user, external=external)
+
+    async def load_standard_address_space(self, shelf_file: Path | None = None):
+        if shelf_file is None:
+            return await super().load_standard_address_space()
+        # in a worker thread, so the PLC connections and Modbus server start meanwhile
+        if shelf_file.is_file():
+            try:
+                await asyncio.to_thread(self.load_snapshot, shelf_file)
+                return
+            except Exception as exc:
+                _logger.warning(f"Rebuilding the OPC UA address space, {shelf_file} is unusable: {exc}")
+        await asyncio.to_thread(self.build_snapshot, shelf_file)
+        _logger.info(f"### Cached the OPC UA address space in {shelf_file}")
+
+    def build_snapshot(self, path: Path):
+        standard_address_space.fill_address_space(self.node_mgt_service)
+        self.share_values()
+        path.parent.mkdir(exist_ok=True)
+        temp_path = path.with_suffix(".tmp")
+        self.aspace.dump(temp_path)
+        os.replace(temp_path, path)
+
+    def share_values(self):
+        """Replace equal frozen values in the nodes by a single instance."""
+        memo = {}
+        for node in self.aspace._nodes.values():
+            node.nodeid = _shared(node.nodeid, memo)
+            for attribute in node.attributes.values():
+                attribute.value = _shared(attribute.value, memo)
+            for reference in node.references:
+                for field in dataclasses.fields(reference):
+                    object.__setattr__(reference, field.name, _shared(getattr(reference, field.name), memo))
+
+    def load_snapshot(self, path: Path):
+        # the snapshot is a large graph of small objects, which would trigger many collections
+        gc.disable()
+        try:
+            self.aspace.load(path)
+        finally:
+            gc.enable()
+
+
+def _shared(value, memo):
+    """The first instance seen of a frozen dataclass value, e.g. a NodeId or DataValue."""
+    if not (dataclasses.is_dataclass(value) and value.__dataclass_params__.frozen):
+        return value
+    fields = [_shared(getattr(value, field.name), memo) for field in dataclasses.fields(value)]
+    # shared fields compare by identity, so e.g. node ids differing only in encoding stay apart
+    key = (type(value), *(id(f) if dataclasses.is_dataclass(f) else (type(f), f) for f in fields))
+    try:
+        return memo.setdefault(key, value)
+    except TypeError:
+        # holds a list, e.g. an array value
+        return value
+
+
 async def setup_security():
     """Setup certificates for OPC UA security."""
     # create certificates directory if it doesn't exist
@@ -100,42 +242,118 @@ async def setup_security():
     server_private_key = CERTIFICATES_DIR / "server-private-key.pem"
     
     # initialise server with users
-    server = Server(user_manager=UserManager())
-    await server.init()
+    server = Server(GatewayInternalServer(user_manager=UserManager()))
+    await server.init(ADDRESS_SPACE_CACHE)
     server.set_endpoint("opc.tcp://0.0.0.0:4840/")
-    server.set_security_policy([ua.SecurityPolicyType.Basic256Sha256_SignAndEncrypt, ua.SecurityPolicyType.NoSecurity])
+    server.set_security_policy(
+        [ua.SecurityPolicyType.Basic256Sha256_SignAndEncrypt, ua.SecurityPolicyType.NoSecurity],
+        permission_ruleset=GatewayRuleset(),
+    )
 
     # get hostname for certificate
     host_name = socket.gethostname()
     server_app_uri = f"gateway@{host_name}"
 
-    # generate server certificate if it doesn't exist or is expired
-    await setup_self_signed_certificate(
-        server_private_key,
-        server_cert,
-        server_app_uri,
-        host_name,
-        [ExtendedKeyUsageOID.CLIENT_AUTH, ExtendedKeyUsageOID.SERVER_AUTH],
-        {
-            "countryName": "SG",
-            "stateOrProvinceName": "SG",
-            "localityName": "Singapore",
-            "organizationName": "Foo Bar Inc",
-            "commonName": host_name,
-        },
-    )
+    # reuse the server certificate, generating it only if it doesn't exist or is expired
+    credentials = await load_credentials(server_cert, server_private_key, server_app_uri, host_name)
+    if credentials is None:
+        await setup_self_signed_certificate(
+            server_private_key,
+            server_cert,
+            server_app_uri,
+            host_name,
+            [ExtendedKeyUsageOID.CLIENT_AUTH, ExtendedKeyUsageOID.SERVER_AUTH],
+            {
+                "countryName": "SG",
+                "stateOrProvinceName": "SG",
+                "localityName": "Singapore",
+                "organizationName": "Foo Bar Inc",
+                "commonName": host_name,
+            },
+        )
+        _logger.info(f"Server certificate created at: {server_cert}")
+        _logger.info(f"Server private key created at: {server_private_key}")
+        credentials = await load_credentials(server_cert, server_private_key, server_app_uri, host_name)
 
     # load server certificate and private key
-    await server.load_certificate(str(server_cert))
-    await server.load_private_key(str(server_private_key))
-    
-    _logger.info(f"Server certificate created at: {server_cert}")
-    _logger.info(f"Server private key created at: {server_private_key}")
-    
+    server.iserver.certificate, server.iserver.private_key = credentials
+
     return server
 
 
-async def setup_opcua_server():
+async def load_credentials(cert_path, key_path, app_uri, host_name):
+    """Parse the server certificate and private key once, None if they must be generated."""
+    if not (cert_path.is_file() and key_path.is_file()):
+        return None
+    cert = await load_certificate(cert_path)
+    if check_certificate(cert, app_uri, host_name):
+        return None
+    # the key was generated by the gateway itself, so instead of the costly RSA key checks
+    # it is only checked to be the one certified
+    key = serialization.load_pem_private_key(
+        key_path.read_bytes(), password=None, unsafe_skip_rsa_key_validation=True
+    )
+    if cert.public_key() != key.public_key():
+        _logger.warning(f"{key_path} does not match {cert_path}, generating both")
+        key_path.unlink()
+        return None
+    return cert, key
+
+
+class ServerLoop:
+    """Event loop of the OPC UA server, in a thread of its own or the gateway's loop.
+
+    Only the ValueCaches of the publishers are shared with the sync engines. Client
+    writes are passed back to the gateway's loop, where the engines run.
+    """
+
+    def __init__(self, threaded: bool):
+        self.loop = asyncio.new_event_loop() if threaded else None
+        self.thread = None
+        self.gateway_loop = None
+
+    def start(self):
+        self.gateway_loop = asyncio.get_running_loop()
+        if self.loop:
+            self.thread = threading.Thread(target=self.loop.run_forever, name="opcua", daemon=True)
+            self.thread.start()
+
+    async def run(self, coro):
+        """Run a coroutine on the server's loop and return its result."""
+        if self.loop is None:
+            return await coro
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, self.loop))
+
+    def to_gateway(self, callback):
+        """Wrap a server callback to run on the gateway's loop."""
+        if self.loop is None:
+            return callback
+
+        def forward(*args):
+            self.gateway_loop.call_soon_threadsafe(callback, *args)
+        return forward
+
+    async def on_gateway(self, coro):
+        """Run a coroutine on the gateway's loop from the server's loop and return its result."""
+        if self.loop is None:
+            return await coro
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, self.gateway_loop))
+
+    def stop(self):
+        if self.thread:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.loop.close()
+
+
+def node_args(idx, nodeid, name):
+    """Node id and browse name arguments, with a fixed node id if the tag map gives one."""
+    if nodeid:
+        return nodeid, ua.QualifiedName(name, idx)
+    return idx, name
+
+
+async def setup_opcua_server(tagmaps):
     '''Run OPC UA server setup.'''
 
     if ENABLE_SECURITY:
@@ -143,8 +361,8 @@ async def setup_opcua_server():
         server = await setup_security()
     else:
         # setup our server without any security
-        server = Server()
-        await server.init()
+        server = Server(GatewayInternalServer())
+        await server.init(ADDRESS_SPACE_CACHE)
         server.set_endpoint("opc.tcp://0.0.0.0:4840/")
         server.set_security_policy([ua.SecurityPolicyType.NoSecurity])
 
@@ -152,106 +370,118 @@ async def setup_opcua_server():
     uri = "http://examples.freeopcua.github.io"
     idx = await server.register_namespace(uri)
 
-    # create objects and variables
-    myobj = await server.nodes.objects.add_object(idx, "modbus")
-    pump = await myobj.add_variable(idx, "pump", False)
-    gate = await myobj.add_variable(idx, "gate", False)
-    waterlevel = await myobj.add_variable(idx, "water_level", ua.Variant(0, ua.VariantType.UInt16))
-
-    # Set variables to be writable by clients
-    await pump.set_writable()
-    await gate.set_writable()
+    # create one object per device and its variables from the tag map
+    nodes = {}
+    for tagmap in tagmaps:
+        myobj = await server.nodes.objects.add_object(*node_args(idx, tagmap.folder_node, tagmap.folder))
+        nodes[tagmap.name] = {}
+        for tag in tagmap.tags:
+            node = await myobj.add_variable(
+                *node_args(idx, tag.node, tag.name), ua.Variant(tag.initial_value, tag.variant_type)
+            )
+            nodes[tagmap.name][tag.name] = node
+
+            # Set variables to be writable by clients
+            if tag.writable:
+                await node.set_writable()
     _logger.info("### Setup OPC UA server.")
 
-    return server, pump, gate, waterlevel
+    return server, idx, nodes
 
 
-async def main():
-    # setup opc ua server
-    server, pump, gate, waterlevel = await setup_opcua_server()
-    
-    # setup modbus client to interact with PLC
-    client = setup_modbus_client()
+async def add_recorder_method(server, idx, flight_recorder, server_loop):
+    """Method diagnostics/dump_flight_recorder(minutes) returning the path of the dump."""
+    obj = await server.nodes.objects.get_child(f"{idx}:diagnostics")
+
+    async def dump(parent, minutes):
+        minutes = minutes.Value if minutes.Value and minutes.Value > 0 else DUMP_MINUTES
+        try:
+            path = await server_loop.on_gateway(flight_recorder.dump(minutes, "OPC UA"))
+        except OSError as exc:
+            _logger.error(f"Failed to dump the flight recorder: {exc}")
+            raise ua.UaStatusCodeError(ua.StatusCodes.BadResourceUnavailable)
+        return [ua.Variant(str(path.resolve()), ua.VariantType.String)]
 
-    # setup and run modbus gateway server
-    mb_context, modbus_server_task = setup_modbus_server()
+    await obj.add_method(idx, "dump_flight_recorder", dump, [ua.VariantType.Double], [ua.VariantType.String])
+
+
+async def main():
+    tagmaps = load_tagmap(TAG_MAP)
+    flight_recorder = FlightRecorder([tagmap.name for tagmap in tagmaps]) if ENABLE_RECORDER else None
+    channels = [flight_recorder.channel(tagmap.name) if flight_recorder else None for tagmap in tagmaps]
+
+    # the Modbus side does not depend on OPC UA, so the PLC connections and the modbus
+    # gateway server start while the OPC UA address space loads
+    plcs = []
+    for tagmap, channel in zip(tagmaps, channels):
+        # setup modbus client to interact with each PLC, with pipelined requests
+        client = setup_modbus_client(tagmap)
+        plcs.append(PlcPool(client, tagmap.connections, tagmap.max_inflight, channel))
+    connecting = asyncio.gather(*(plc.connect() for plc in plcs))
+    # client writes made before the sync engines are hooked up are held by the datablocks
+    metrics = Metrics()
+    mb_context, modbus_server_task = setup_modbus_server(tagmaps, metrics)
+
+    # setup opc ua server, on its own loop
+    server_loop = ServerLoop(OPCUA_THREAD)
+    server_loop.start()
+    server, idx, nodes = await server_loop.run(setup_opcua_server(tagmaps))
+    diagnostics = await server_loop.run(Diagnostics.create(server, idx, [tagmap.name for tagmap in tagmaps], metrics))
+    historian = None
+    if ENABLE_HISTORY:
+        historian = Historian(HISTORY_DIR, tagmaps, nodes)
+        await server_loop.run(historian.attach(server))
+    if flight_recorder:
+        await server_loop.run(add_recorder_method(server, idx, flight_recorder, server_loop))
+
+    engines = []
+    for tagmap, plc, channel in zip(tagmaps, plcs, channels):
+        # route client writes from both protocols straight into the device's sync engine
+        publisher = Publisher(server, tagmap, nodes[tagmap.name])
+        engine = SyncEngine(plc, mb_context, tagmap, publisher, metrics, historian, channel)
+        metrics.collect(engine.collect)
+        server.subscribe_server_callback(CallbackType.PostWrite, server_loop.to_gateway(engine.on_opcua_write))
+        for table in WRITABLE_TABLES:
+            mb_context[engine.device_id].store[TABLES[table][1]].hook(engine.on_modbus_write(table))
+        engines.append(engine)
+
+    # stop cleanly on SIGTERM (systemctl stop), so the historian writes its buffered samples.
+    # Only the first signal cancels, a repeated one (e.g. to the process and its group) would
+    # interrupt the shutdown of the OPC UA server.
+    main_task = asyncio.current_task()
+
+    def stop():
+        if not main_task.cancelling():
+            main_task.cancel()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop)
+    if flight_recorder:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, flight_recorder.request_dump, "SIGUSR1")
 
     try:
-        await client.connect()
-        assert client.connected
-        await server.start()
-
-        last_pump_val = 0
-        last_gate_val = 0
-
-        device_id = 0x00
-        r_coil = 0x1
-        w_coil = 0xf
-        rw_ir = 0x4
-
-        while True:
-            await asyncio.sleep(0.3)
-
-            # get values from PLC
-            rr = await client.read_coils(0, count=2)
-            pump_mb, gate_mb = rr.bits[0], rr.bits[1]
-
-            rr = await client.read_input_registers(0, count=1)
-            waterlevel_mb = rr.registers[0]
-
-
-            # check for changes from OPC UA client
-            new_pump_opc = await pump.get_value()
-            new_gate_opc = await gate.get_value()
-            
-            # check for changes from Modbus gateway server
-            new_pump_mb, new_gate_mb = mb_context[device_id].getValues(r_coil, 0, 2)
-
-
-            # write to PLC if there is a change (priority: OPC UA > Modbus gateway > PLC)
-            if (last_pump_val != new_pump_opc): # OPC UA client changed pump value                
-                pump_mb = True if new_pump_opc else False
-                await client.write_coil(0,new_pump_opc)
-                _logger.info(f"OPC UA client changed pump to: {pump_mb!s}")
-            
-            elif (last_pump_val != new_pump_mb): # Modbus gateway client changed pump value
-                pump_mb = True if new_pump_mb else False
-                await client.write_coil(0,new_pump_mb)
-                _logger.info(f"Modbus client changed pump to: {pump_mb!s}")
-
-            if (last_gate_val != new_gate_opc): # OPC UA client changed gate value
-                gate_mb = True if new_gate_opc else False
-                await client.write_coil(1,new_gate_opc)
-                _logger.info(f"OPC UA client changed gate to: {gate_mb!s}")
-            
-            elif (last_gate_val != new_gate_mb): # Modbus gateway client changed gate value
-                gate_mb = True if new_gate_mb else False
-                await client.write_coil(1,new_gate_mb)
-                _logger.info(f"Modbus client changed gate to: {gate_mb!s}")
-
-
-            # writes values to OPC
-            await pump.write_value(pump_mb)
-            await gate.write_value(gate_mb)
-            await waterlevel.write_value(waterlevel_mb, ua.VariantType.UInt16)
-
-            # save the last value
-            last_pump_val = pump_mb
-            last_gate_val = gate_mb
-
-            # update modbus gateway server with new values
-            mb_context[device_id].setValues(w_coil, 0, [pump_mb,gate_mb])
-            mb_context[device_id].setValues(rw_ir, 0, [waterlevel_mb])
-
-            txt = f"{str(datetime.datetime.now())[:-3]} - pump: {"on" if pump_mb else "off"}, gate: {"open" if gate_mb else "closed"}, water level: {waterlevel_mb!s}"
-            print(txt)
-            
+        await server_loop.run(server.start())
+        await connecting
+
+        # each PLC is synchronised independently of the others
+        await asyncio.gather(
+            *(engine.run() for engine in engines),
+            *(server_loop.run(engine.publisher.run()) for engine in engines),
+            metrics.serve(),
+            metrics.monitor_loop_lag(),
+            diagnostics.run(),
+            server_loop.run(diagnostics.cache.run(server)),
+            *([historian.run()] if historian else []),
+        )
+
+    except asyncio.CancelledError:
+        _logger.info("### Stopping gateway")
     finally:
-        client.close()
-        await server.stop()
+        for engine in engines:
+            engine.client.close()
+        await server_loop.run(server.stop())
+        server_loop.stop()
         modbus_server_task.cancel()
 
 
 if __name__ == "__main__":
-    logging.basicConfig(level=logging.DEBUG)
-    asyncio.run(main(), debug=True)
+    logging.basicConfig(level=logging.DEBUG if DEBUG else logging.INFO)
+    asyncio.run(main(), debug=DEBUG)
@@ -0,0 +1,484 @@
+"""
+Embedded historian of the gateway tag values.
+
+Every value reported by a PLC poll (see report.py) is appended to a series per tag:
+
+    history/<device>/<tag>.dat   compressed chunks, append only
+    history/<device>/<tag>.idx   one record per chunk: time range, position, summary
+
+A chunk holds the samples of up to CHUNK_SAMPLES polls as two columns:
+- times in ms since the Unix epoch, delta-of-delta encoded (near 0 for a steady poll rate)
+- values delta encoded (bools and integers) or XOR of consecutive float64 bit patterns
+each zlib compressed. Samples are buffered in memory and written as a chunk when it is
+full or every FLUSH_INTERVAL, so the disk sees one append per tag and interval.
+
+The index records the count, first, last, minimum, maximum and sum of every chunk.
+Reads map the files with mmap, find chunks by binary search of the index and decode
+only the chunks they need. Downsampled reads use the summaries of chunks lying in a
+single interval without decoding them.
+
+OPC UA clients read the history of the tag variables with HistoryRead:
+- ReadRawModifiedDetails: the raw samples of a time range
+- ReadProcessedDetails: Average, Minimum, Maximum, Count, Start or End per ProcessingInterval
+"""
+from __future__ import annotations
+
+import asyncio
+import bisect
+import itertools
+import logging
+import mmap
+import os
+import struct
+import zlib
+from array import array
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+from asyncua import ua
+from asyncua.common.utils import Buffer
+from asyncua.server.history import HistoryManager, HistoryStorageInterface
+
+
+_logger = logging.getLogger(__file__)
+
+HISTORY_DIR = "history"
+CHUNK_SAMPLES = 4096
+# seconds between writes of the buffered samples, at most this much is lost on power failure
+FLUSH_INTERVAL = 60.0
+# most values returned by one HistoryRead, the client continues with the continuation point
+MAX_RESPONSE_VALUES = 10000
+
+# first ms, last ms, offset, times size, values size, count, first, last, minimum, maximum, sum
+RECORD = struct.Struct("<qqQIIIddddd")
+
+AGGREGATES = {
+    ua.ObjectIds.AggregateFunction_Average: "average",
+    ua.ObjectIds.AggregateFunction_Minimum: "minimum",
+    ua.ObjectIds.AggregateFunction_Maximum: "maximum",
+    ua.ObjectIds.AggregateFunction_Count: "count",
+    ua.ObjectIds.AggregateFunction_Start: "start",
+    ua.ObjectIds.AggregateFunction_End: "end",
+}
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def to_ms(timestamp: datetime | None) -> int | None:
+    """Milliseconds since the Unix epoch, None for a missing OPC UA time."""
+    if timestamp is None or timestamp <= ua.get_win_epoch():
+        return None
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return (timestamp - EPOCH) // timedelta(milliseconds=1)
+
+
+def from_ms(ms: int) -> datetime:
+    return EPOCH + timedelta(milliseconds=ms)
+
+
+def _delta(values: array) -> array:
+    out = array("q", values)
+    for n in range(len(out) - 1, 0, -1):
+        out[n] -= out[n - 1]
+    return out
+
+
+def _undelta(values: array) -> array:
+    return array("q", itertools.accumulate(values))
+
+
+def encode_times(times: array) -> bytes:
+    return zlib.compress(_delta(_delta(times)).tobytes())
+
+
+def decode_times(data) -> array:
+    deltas = array("q")
+    deltas.frombytes(zlib.decompress(data))
+    return _undelta(_undelta(deltas))
+
+
+def encode_values(values: array) -> bytes:
+    if values.typecode == "d":
+        bits = array("q")
+        bits.frombytes(values.tobytes())
+        xor = array("q", bits)
+        for n in range(1, len(bits)):
+            xor[n] = bits[n] ^ bits[n - 1]
+        return zlib.compress(xor.tobytes())
+    return zlib.compress(_delta(values).tobytes())
+
+
+def decode_values(data, typecode: str) -> array:
+    raw = array("q")
+    raw.frombytes(zlib.decompress(data))
+    if typecode == "d":
+        bits = array("q", itertools.accumulate(raw, lambda a, b: a ^ b))
+        values = array("d")
+        values.frombytes(bits.tobytes())
+        return values
+    return _undelta(raw)
+
+
+class Stats:
+    """Aggregates of the samples of one processing interval."""
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.minimum = None
+        self.maximum = None
+        self.start = None
+        self.end = None
+
+    def add(self, value):
+        if self.count == 0:
+            self.start = self.minimum = self.maximum = value
+        else:
+            self.minimum = min(self.minimum, value)
+            self.maximum = max(self.maximum, value)
+        self.end = value
+        self.count += 1
+        self.sum += value
+
+    def merge(self, record):
+        """Add the summary of a whole chunk."""
+        _, _, _, _, _, count, first, last, minimum, maximum, total = record
+        if self.count == 0:
+            self.start, self.minimum, self.maximum = first, minimum, maximum
+        else:
+            self.minimum = min(self.minimum, minimum)
+            self.maximum = max(self.maximum, maximum)
+        self.end = last
+        self.count += count
+        self.sum += total
+
+    def value(self, aggregate: str):
+        if aggregate == "average":
+            return self.sum / self.count
+        return getattr(self, aggregate)
+
+
+class Series:
+    """The on-disk history of one tag."""
+
+    def __init__(self, path: Path, tag):
+        self.tag = tag
+        self.typecode = "d" if tag.variant_type in (ua.VariantType.Double, ua.VariantType.Float) else "q"
+        self.dat_path = path.with_suffix(".dat")
+        self.idx_path = path.with_suffix(".idx")
+        self.records = self.load_index()
+        self.ends = [record[1] for record in self.records]
+        self.dat = open(self.dat_path, "a+b")
+        self.idx = open(self.idx_path, "ab")
+        self.map = None
+
+        # samples not written yet
+        self.times = array("q")
+        self.values = array(self.typecode)
+        self.last_time = self.records[-1][1] if self.records else None
+
+    def load_index(self) -> list[tuple]:
+        """Read the index, dropping anything a crash left half written."""
+        self.dat_path.touch()
+        self.idx_path.touch()
+        data = self.idx_path.read_bytes()
+        whole = len(data) - len(data) % RECORD.size
+        records = list(RECORD.iter_unpack(data[:whole]))
+        end = records[-1][2] + records[-1][3] + records[-1][4] if records else 0
+        if whole != len(data):
+            os.truncate(self.idx_path, whole)
+        if self.dat_path.stat().st_size != end:
+            os.truncate(self.dat_path, end)
+        return records
+
+    def append(self, time_ms: int, value):
+        # times must increase for the index to be searchable, e.g. after the clock was set back
+        if self.last_time is not None and time_ms <= self.last_time:
+            return
+        self.last_time = time_ms
+        self.times.append(time_ms)
+        self.values.append(value)
+        if len(self.times) >= CHUNK_SAMPLES:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered samples as one chunk."""
+        if not self.times:
+            return
+        times = encode_times(self.times)
+        values = encode_values(self.values)
+        offset = self.records[-1][2] + self.records[-1][3] + self.records[-1][4] if self.records else 0
+        record = (
+            self.times[0], self.times[-1], offset, len(times), len(values), len(self.times),
+            self.values[0], self.values[-1], min(self.values), max(self.values), float(sum(self.values)),
+        )
+        # data before index, so an interrupted write leaves no record pointing at missing data
+        self.dat.write(times + values)
+        self.dat.flush()
+        self.idx.write(RECORD.pack(*record))
+        self.idx.flush()
+        self.records.append(record)
+        self.ends.append(record[1])
+        self.times = array("q")
+        self.values = array(self.typecode)
+
+    def chunk(self, record) -> tuple[array, array]:
+        """Decode the times and values of a chunk."""
+        offset, times_size, values_size = record[2:5]
+        end = offset + times_size + values_size
+        if self.map is None or len(self.map) < end:
+            if self.map is not None:
+                self.map.close()
+            self.map = mmap.mmap(self.dat.fileno(), 0, access=mmap.ACCESS_READ)
+        data = memoryview(self.map)
+        try:
+            return (
+                decode_times(data[offset : offset + times_size]),
+                decode_values(data[offset + times_size : end], self.typecode),
+            )
+        finally:
+            data.release()
+
+    def chunks(self, start: int | None, end: int | None, reverse: bool = False):
+        """Yield (record, times, values) of the chunks overlapping [start, end], buffered samples last.
+
+        times and values are decoded lazily, only when called.
+        """
+        first = 0 if start is None else bisect.bisect_left(self.ends, start)
+        selected = []
+        for record in self.records[first:]:
+            if end is not None and record[0] > end:
+                break
+            selected.append(record)
+        items = [(record, lambda record=record: self.chunk(record)) for record in selected]
+        if self.times and (end is None or self.times[0] <= end):
+            items.append((None, lambda: (self.times, self.values)))
+        return reversed(items) if reverse else items
+
+    def read(self, start: int | None, end: int | None, limit: int, reverse: bool = False) -> list[tuple]:
+        """Return up to limit (time, value) samples within [start, end], newest first if reverse."""
+        samples = []
+        for _, load in self.chunks(start, end, reverse):
+            times, values = load()
+            lo = 0 if start is None else bisect.bisect_left(times, start)
+            hi = len(times) if end is None else bisect.bisect_right(times, end)
+            indices = range(hi - 1, lo - 1, -1) if reverse else range(lo, hi)
+            for n in indices:
+                samples.append((times[n], values[n]))
+                if len(samples) >= limit:
+                    return samples
+        return samples
+
+    def aggregate(self, start: int, end: int, interval: int) -> dict[int, Stats]:
+        """Aggregate the samples in [start, end) per interval, keyed by interval number."""
+        stats: dict[int, Stats] = {}
+        for record, load in self.chunks(start, end - 1):
+            if record is not None and record[0] >= start and record[1] < end:
+                first, last = (record[0] - start) // interval, (record[1] - start) // interval
+                if first == last:
+                    stats.setdefault(first, Stats()).merge(record)
+                    continue
+            times, values = load()
+            for n in range(bisect.bisect_left(times, start), bisect.bisect_left(times, end)):
+                stats.setdefault((times[n] - start) // interval, Stats()).add(values[n])
+        return stats
+
+    def variant(self, value, variant_type=None) -> ua.Variant:
+        variant_type = variant_type or self.tag.variant_type
+        if variant_type == ua.VariantType.Boolean:
+            value = bool(value)
+        elif variant_type not in (ua.VariantType.Double, ua.VariantType.Float):
+            value = int(value)
+        return ua.Variant(value, variant_type)
+
+    def close(self):
+        self.flush()
+        if self.map is not None:
+            self.map.close()
+        self.dat.close()
+        self.idx.close()
+
+
+class Historian(HistoryStorageInterface):
+    """History storage of the OPC UA server, fed with the values reported by the gateway."""
+
+    def __init__(self, path, tagmaps, nodes, max_history_data_response_size=MAX_RESPONSE_VALUES):
+        super().__init__(max_history_data_response_size)
+        self.path = Path(path)
+        self.tagmaps = tagmaps
+        self.nodes = nodes
+        # device name -> tag name -> series, OPC UA node id -> series
+        self.series: dict[str, dict[str, Series]] = {}
+        self.by_node: dict[ua.NodeId, Series] = {}
+        # loop recording the samples, which also answers the reads
+        self.loop = None
+
+    async def init(self):
+        for tagmap in self.tagmaps:
+            folder = self.path / tagmap.name
+            folder.mkdir(parents=True, exist_ok=True)
+            self.series[tagmap.name] = {}
+            for tag in tagmap.tags:
+                series = Series(folder / tag.name, tag)
+                self.series[tagmap.name][tag.name] = series
+                self.by_node[self.nodes[tagmap.name][tag.name].nodeid] = series
+        _logger.info(f"### Historian storing {len(self.by_node)} tags in {self.path}")
+
+    async def attach(self, server):
+        """Serve the history of the tag variables through the OPC UA server."""
+        await self.init()
+        manager = HistorianManager(server.iserver)
+        manager.set_storage(self)
+        server.iserver.history_manager = manager
+        for tagmap in self.tagmaps:
+            for tag in tagmap.tags:
+                node = self.nodes[tagmap.name][tag.name]
+                await node.set_attr_bit(ua.AttributeIds.AccessLevel, ua.AccessLevel.HistoryRead)
+                await node.set_attr_bit(ua.AttributeIds.UserAccessLevel, ua.AccessLevel.HistoryRead)
+                await node.write_attribute(ua.AttributeIds.Historizing, ua.DataValue(ua.Variant(True, ua.VariantType.Boolean)))
+
+    def record(self, device: str, values: dict, timestamp: datetime):
+        """Append one poll of a device."""
+        time_ms = to_ms(timestamp)
+        for name, series in self.series[device].items():
+            value = values.get(name)
+            if value is not None:
+                series.append(time_ms, value)
+
+    def flush(self):
+        for device in self.series.values():
+            for series in device.values():
+                series.flush()
+
+    async def run(self, interval: float = FLUSH_INTERVAL):
+        """Write the buffered samples every interval."""
+        self.loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(interval)
+            self.flush()
+
+    async def new_historized_node(self, node_id, period, count=0):
+        # the tags are historized by the gateway itself, see record()
+        pass
+
+    async def save_node_value(self, node_id, datavalue):
+        pass
+
+    async def read_node_history(self, node_id, start, end, nb_values):
+        series = self.by_node.get(node_id)
+        if series is None:
+            return [], None
+        start, end = to_ms(start), to_ms(end)
+        # newest first if the start is missing or after the end, as the spec asks
+        if start is None:
+            reverse, low, high = True, None, end
+        elif end is not None and start > end:
+            reverse, low, high = True, end, start
+        else:
+            reverse, low, high = False, start, end
+        limit = min(nb_values or self.max_history_data_response_size, self.max_history_data_response_size)
+
+        samples = series.read(low, high, limit + 1, reverse)
+        cont = None
+        if len(samples) > limit:
+            cont = from_ms(samples[limit][0])
+            samples = samples[:limit]
+        return [
+            ua.DataValue(series.variant(value), SourceTimestamp=from_ms(time), ServerTimestamp=from_ms(time))
+            for time, value in samples
+        ], cont
+
+    def read_processed(self, node_id, aggregate_id, start, end, interval_ms):
+        """Return the DataValues of an aggregate and the continuation time, or a bad status."""
+        series = self.by_node.get(node_id)
+        if series is None:
+            return ua.StatusCodes.BadNodeIdUnknown, None
+        aggregate = AGGREGATES.get(aggregate_id.Identifier if aggregate_id.NamespaceIndex == 0 else None)
+        if aggregate is None:
+            return ua.StatusCodes.BadAggregateNotSupported, None
+        start, end = to_ms(start), to_ms(end)
+        if start is None or end is None or end <= start:
+            return ua.StatusCodes.BadInvalidTimestampArgument, None
+
+        interval = max(1, int(interval_ms)) if interval_ms else end - start
+        cont = None
+        if (end - start + interval - 1) // interval > self.max_history_data_response_size:
+            cont = from_ms(start + interval * self.max_history_data_response_size)
+            end = start + interval * self.max_history_data_response_size
+
+        if aggregate == "count":
+            variant_type = ua.VariantType.Int32
+        elif aggregate == "average":
+            variant_type = ua.VariantType.Double
+        else:
+            variant_type = None
+        stats = series.aggregate(start, end, interval)
+        results = []
+        for n, time in enumerate(range(start, end, interval)):
+            timestamp = from_ms(time)
+            if n not in stats:
+                results.append(ua.DataValue(StatusCode_=ua.StatusCode(ua.StatusCodes.BadNoData), SourceTimestamp=timestamp))
+                continue
+            value = series.variant(stats[n].value(aggregate), variant_type)
+            results.append(ua.DataValue(value, SourceTimestamp=timestamp, ServerTimestamp=timestamp))
+        return results, cont
+
+    async def new_historized_event(self, source_id, evtypes, period, count=0):
+        pass
+
+    async def save_event(self, event):
+        pass
+
+    async def read_event_history(self, source_id, start, end, nb_values, evfilter):
+        return [], None
+
+    async def stop(self):
+        for device in self.series.values():
+            for series in device.values():
+                series.close()
+        self.series.clear()
+        self.by_node.clear()
+
+
+class HistorianManager(HistoryManager):
+    """History manager which also answers processed (downsampled) reads.
+
+    Reads are answered on the loop recording the samples, so a server running on a loop
+    of its own never sees a series half way through a flush.
+    """
+
+    async def read_history(self, params):
+        loop = self.storage.loop
+        if loop is not None and loop is not asyncio.get_running_loop():
+            return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(self.read_history(params), loop))
+        details = params.HistoryReadDetails
+        if not isinstance(details, ua.ReadProcessedDetails):
+            return await super().read_history(params)
+
+        results = []
+        for n, rv in enumerate(params.NodesToRead):
+            result = ua.HistoryReadResult()
+            # one aggregate per node, or the same aggregate for all
+            aggregates = details.AggregateType
+            if not aggregates:
+                result.StatusCode = ua.StatusCode(ua.StatusCodes.BadAggregateListMismatch)
+                results.append(result)
+                continue
+            aggregate = aggregates[n] if len(aggregates) == len(params.NodesToRead) else aggregates[0]
+            start = details.StartTime
+            if rv.ContinuationPoint:
+                start = ua.ua_binary.Primitives.DateTime.unpack(Buffer(rv.ContinuationPoint))
+
+            values, cont = self.storage.read_processed(
+                rv.NodeId, aggregate, start, details.EndTime, details.ProcessingInterval
+            )
+            if not isinstance(values, list):
+                result.StatusCode = ua.StatusCode(values)
+            else:
+                result.HistoryData = ua.HistoryData()
+                result.HistoryData.DataValues = values
+                if cont:
+                    result.ContinuationPoint = ua.ua_binary.Primitives.DateTime.pack(cont)
+            results.append(result)
+        return results
@@ -0,0 +1,279 @@
+"""
+Metrics of the gateway hot path.
+
+Counters, gauges and histograms recorded by the sync engines, exposed in the
+Prometheus text format on a local HTTP endpoint:
+
+    curl http://127.0.0.1:9108/metrics
+
+and as variables of an OPC UA "diagnostics" object, refreshed every second.
+Values which already live elsewhere (e.g. PLC connection counts, queue depths)
+are read by collectors when the metrics are rendered.
+"""
+from __future__ import annotations
+
+import asyncio
+import bisect
+import contextlib
+import logging
+import time
+
+from asyncua import ua
+
+from publisher import ValueCache
+
+
+_logger = logging.getLogger(__file__)
+
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9108
+DIAGNOSTICS_INTERVAL = 1.0
+LOOP_LAG_INTERVAL = 0.5
+
+# histogram bucket upper bounds in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# name -> (type, help)
+METRICS = {
+    "gateway_poll_seconds": ("histogram", "Duration of a PLC poll cycle: read, publish and mirror"),
+    "gateway_polls_total": ("counter", "PLC poll cycles by result"),
+    "gateway_modbus_request_seconds": ("histogram", "Latency of Modbus requests to the PLC"),
+    "gateway_modbus_errors_total": ("counter", "Failed Modbus requests to the PLC"),
+    "gateway_opcua_write_seconds": ("histogram", "Latency of bulk OPC UA value writes"),
+    "gateway_commands_total": ("counter", "Client commands by source and result: ok, error, coalesced into a later command or unchanged"),
+    "gateway_write_conflicts_total": ("counter", "Writes to a tag by OPC UA and Modbus clients in quick succession, by the source which won"),
+    "gateway_reported_values_total": ("counter", "Polled values passed on by reason: change or heartbeat, or suppressed"),
+    "gateway_anomalies_total": ("counter", "Polled values contradicting the process model, by kind"),
+    "gateway_anomaly_rate": ("gauge", "Share of polls raising an anomaly, averaged over a minute"),
+    "gateway_command_queue": ("gauge", "Client commands waiting to be written to the PLC"),
+    "gateway_plc_online": ("gauge", "1 while the PLC answers polls"),
+    "gateway_plc_reconnects_total": ("counter", "Reconnections to the PLC after a lost connection"),
+    "gateway_plc_connect_failures_total": ("counter", "Failed connection attempts to the PLC"),
+    "gateway_server_requests_total": ("counter", "Requests of Modbus clients to the gateway by result: served, snapshot (served from a cached read), and throttled (delayed by the rate limit)"),
+    "gateway_server_request_seconds": ("histogram", "Time from queueing a Modbus client request to answering it, including the wait for admission"),
+    "gateway_server_connections": ("gauge", "Open connections of a Modbus client to the gateway"),
+    "gateway_server_refused_connections_total": ("counter", "Connections of a Modbus client closed for exceeding the connection limit"),
+    "gateway_event_loop_lag_seconds": ("histogram", "Delay of the event loop in running a timer"),
+}
+
+
+class Histogram:
+    """Bucketed distribution of observed values, with the last value."""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.last = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        self.last = value
+
+
+def _labels(labels: dict, extra: str = "") -> str:
+    items = [f'{key}="{value}"' for key, value in labels.items()]
+    if extra:
+        items.append(extra)
+    return "{" + ",".join(items) + "}" if items else ""
+
+
+class Metrics:
+    """Registry of the gateway metrics."""
+
+    def __init__(self):
+        # metric name -> label values -> number or Histogram
+        self.values: dict[str, dict[tuple, object]] = {name: {} for name in METRICS}
+        self.collectors = []
+
+    def _key(self, name, labels):
+        if name not in METRICS:
+            raise KeyError(f"unknown metric {name}")
+        return tuple(labels.items())
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = self._key(name, labels)
+        self.values[name][key] = self.values[name].get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        self.values[name][self._key(name, labels)] = value
+
+    def observe(self, name: str, value: float, **labels):
+        key = self._key(name, labels)
+        histogram = self.values[name].get(key)
+        if histogram is None:
+            histogram = self.values[name][key] = Histogram()
+        histogram.observe(value)
+
+    def forget(self, **labels):
+        """Drop the series of every metric with these labels, e.g. of a client gone."""
+        wanted = set(labels.items())
+        for series in self.values.values():
+            for key in [key for key in series if wanted <= set(key)]:
+                del series[key]
+
+    def get(self, name: str, **labels):
+        """Return the value of a metric, a Histogram for histograms."""
+        return self.values[name].get(self._key(name, labels))
+
+    @contextlib.contextmanager
+    def time(self, name: str, **labels):
+        """Observe the duration of a block."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def collect(self, collector):
+        """Register a function returning (name, labels, value) tuples, called on every render and diagnostics refresh."""
+        self.collectors.append(collector)
+
+    def run_collectors(self):
+        """Set the metrics read by the collectors."""
+        for collector in self.collectors:
+            for name, labels, value in collector():
+                self.set(name, value, **labels)
+
+    def render(self) -> str:
+        """Return all metrics in the Prometheus text format."""
+        self.run_collectors()
+        lines = []
+        for name, (kind, text) in METRICS.items():
+            series = self.values[name]
+            if not series:
+                continue
+            lines.append(f"# HELP {name} {text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for key, value in series.items():
+                labels = dict(key)
+                if kind != "histogram":
+                    lines.append(f"{name}{_labels(labels)} {value}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(value.buckets + (float("inf"),), value.counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f'{name}_bucket{_labels(labels, f"le=\"{le}\"")} {cumulative}')
+                lines.append(f"{name}_sum{_labels(labels)} {value.sum}")
+                lines.append(f"{name}_count{_labels(labels)} {value.count}")
+        return "\n".join(lines) + "\n"
+
+    async def monitor_loop_lag(self, interval: float = LOOP_LAG_INTERVAL):
+        """Measure how late the event loop runs a timer."""
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(interval)
+            self.observe("gateway_event_loop_lag_seconds", max(0.0, loop.time() - start - interval))
+
+    async def handle_http(self, reader, writer):
+        """Answer one HTTP request for /metrics."""
+        try:
+            request = await asyncio.wait_for(reader.readline(), 5)
+            # skip the headers
+            while (await asyncio.wait_for(reader.readline(), 5)) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] in ("/", "/metrics"):
+                status, body = "200 OK", self.render().encode()
+            else:
+                status, body = "404 Not Found", b"not found\n"
+            writer.write(
+                f"HTTP/1.0 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host: str = METRICS_HOST, port: int = METRICS_PORT):
+        """Serve the metrics over HTTP until cancelled."""
+        server = await asyncio.start_server(self.handle_http, host, port)
+        _logger.info(f"### Serving metrics on http://{host}:{port}/metrics")
+        async with server:
+            await server.serve_forever()
+
+
+class Diagnostics:
+    """OPC UA object mirroring the main metrics of every device."""
+
+    VARIABLES = {
+        "online": ua.VariantType.Boolean,
+        "cycle_time_ms": ua.VariantType.Double,
+        "polls": ua.VariantType.Double,
+        "poll_errors": ua.VariantType.Double,
+        "reconnects": ua.VariantType.Double,
+        "write_conflicts": ua.VariantType.Double,
+        "command_queue": ua.VariantType.Double,
+    }
+
+    def __init__(self, server, metrics, nodes, loop_lag_node):
+        self.server = server
+        self.metrics = metrics
+        self.nodes = nodes
+        self.loop_lag_node = loop_lag_node
+        self.cache = ValueCache()
+
+    @classmethod
+    async def create(cls, server, idx, devices, metrics):
+        obj = await server.nodes.objects.add_object(idx, "diagnostics")
+        loop_lag_node = await obj.add_variable(idx, "loop_lag_ms", ua.Variant(0.0, ua.VariantType.Double))
+        nodes = {}
+        for device in devices:
+            folder = await obj.add_object(idx, device)
+            for name, variant_type in cls.VARIABLES.items():
+                initial = False if variant_type == ua.VariantType.Boolean else 0.0
+                nodes[device, name] = await folder.add_variable(idx, name, ua.Variant(initial, variant_type))
+        return cls(server, metrics, nodes, loop_lag_node)
+
+    def device_values(self, device: str) -> dict:
+        metrics = self.metrics
+        conflicts = metrics.values["gateway_write_conflicts_total"]
+        return {
+            "online": bool(metrics.get("gateway_plc_online", device=device)),
+            "cycle_time_ms": _last(metrics.get("gateway_poll_seconds", device=device)) * 1000,
+            "polls": metrics.get("gateway_polls_total", device=device, result="ok") or 0,
+            "poll_errors": metrics.get("gateway_polls_total", device=device, result="error") or 0,
+            "reconnects": metrics.get("gateway_plc_reconnects_total", device=device) or 0,
+            "write_conflicts": sum(count for key, count in conflicts.items() if dict(key)["device"] == device),
+            "command_queue": metrics.get("gateway_command_queue", device=device) or 0,
+        }
+
+    async def run(self, interval: float = DIAGNOSTICS_INTERVAL):
+        """Refresh the diagnostics variables with one bulk write per interval.
+
+        The values are written by cache.run(), on the OPC UA server's loop.
+        """
+        while True:
+            await asyncio.sleep(interval)
+            self.metrics.run_collectors()
+
+            loop_lag = _last(self.metrics.get("gateway_event_loop_lag_seconds")) * 1000
+            values = [(self.loop_lag_node, ua.Variant(loop_lag, ua.VariantType.Double))]
+            device_values = {}
+            for (device, name), node in self.nodes.items():
+                if device not in device_values:
+                    device_values[device] = self.device_values(device)
+                variant_type = self.VARIABLES[name]
+                value = device_values[device][name]
+                value = bool(value) if variant_type == ua.VariantType.Boolean else float(value)
+                values.append((node, ua.Variant(value, variant_type)))
+
+            to_write = []
+            for node, variant in values:
+                wv = ua.WriteValue()
+                wv.NodeId = node.nodeid
+                wv.AttributeId = ua.AttributeIds.Value
+                wv.Value = ua.DataValue(variant)
+                to_write.append(wv)
+            self.cache.put(to_write)
+
+
+def _last(histogram) -> float:
+    return histogram.last if histogram else 0.0
@@ -0,0 +1,263 @@
+"""
+Pipelined Modbus/TCP request scheduler towards the PLC.
+
+pymodbus' client executes one transaction at a time (a single lock and response future),
+so a poll costs the sum of all request latencies. PlcIO takes the connection settings of the
+AsyncModbusTcpClient from setup_modbus_client() and keeps up to max_inflight requests on the
+wire at once, matching responses to requests by transaction id.
+
+Requests wait in a priority queue: writes are sent before queued reads, so operator commands
+are not delayed behind background polling. The client's timeout counts from the time a request
+is sent, and a request not answered in time is sent again up to the client's retries times.
+PlcIO offers the same request methods as the pymodbus client (read_coils, write_coil, ...),
+which all return awaitables.
+"""
+from __future__ import annotations
+
+import asyncio
+import heapq
+import itertools
+import logging
+
+from pymodbus.client.mixin import ModbusClientMixin
+from pymodbus.exceptions import ConnectionException, ModbusIOException
+from pymodbus.framer import FramerSocket
+from pymodbus.pdu import DecodePDU, ModbusPDU
+
+import recorder
+
+
+_logger = logging.getLogger(__file__)
+
+# the pymodbus server of the simulation handles one outstanding request per connection,
+# so pipelining is enabled per PLC in the tag map
+MAX_INFLIGHT = 1
+
+# function codes sent ahead of reads
+WRITE_FUNCTION_CODES = (0x05, 0x06, 0x0F, 0x10)
+
+
+class PlcIO(ModbusClientMixin, asyncio.Protocol):
+    """Pipelined request scheduler sharing the settings of a pymodbus TCP client."""
+
+    def __init__(self, client, max_inflight: int = MAX_INFLIGHT, channel=None):
+        ModbusClientMixin.__init__(self)
+        params = client.comm_params
+        self.host = params.host
+        self.port = int(params.port)
+        # each request is answered within timeout once on the wire, or sent again up to retries times
+        self.timeout = params.timeout_connect
+        self.retries = client.ctx.retries
+        self.reconnect_delay = params.reconnect_delay or 1
+        self.reconnect_delay_max = params.reconnect_delay_max or 10
+        self.max_inflight = max_inflight
+        # flight recorder channel of the PLC, or None
+        self.channel = channel
+
+        self.framer = FramerSocket(DecodePDU(False))
+        self.transport: asyncio.Transport | None = None
+        self.recv_buffer = b""
+        self.connect_lock = asyncio.Lock()
+        # after a failed connection attempt, requests fail fast until retry_at
+        self.retry_at = 0.0
+        self.retry_delay = self.reconnect_delay
+        # connection statistics, for the metrics
+        self.connects = 0
+        self.connect_failures = 0
+
+        # heap of (priority, sequence, request, future) waiting for a free slot
+        self.pending: list = []
+        self.sequence = itertools.count()
+        # transaction id -> future of the requests on the wire
+        self.inflight: dict[int, asyncio.Future] = {}
+        self.next_tid = 0
+
+    @property
+    def connected(self) -> bool:
+        return self.transport is not None
+
+    async def connect(self) -> bool:
+        """Connect to the PLC, returns False if the connection failed."""
+        loop = asyncio.get_running_loop()
+        try:
+            await asyncio.wait_for(loop.create_connection(lambda: self, self.host, self.port), self.timeout)
+        except (OSError, asyncio.TimeoutError) as exc:
+            _logger.warning(f"Failed to connect to PLC {self.host}:{self.port}: {exc}")
+            self.connect_failures += 1
+            if self.channel:
+                self.channel.text(recorder.CONNECTION, "connect failed", f"{self.host}:{self.port}", exc)
+            return False
+        return True
+
+    async def reconnect(self) -> bool:
+        """Reconnect unless the last attempt failed within the reconnect delay."""
+        async with self.connect_lock:
+            loop = asyncio.get_running_loop()
+            if self.connected or loop.time() < self.retry_at:
+                return self.connected
+            if await self.connect():
+                self.retry_delay = self.reconnect_delay
+                return True
+            self.retry_at = loop.time() + self.retry_delay
+            self.retry_delay = min(self.retry_delay * 2, self.reconnect_delay_max)
+            return False
+
+    def close(self):
+        if self.transport:
+            self.transport.close()
+
+    # asyncio.Protocol callbacks
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.recv_buffer = b""
+        self.connects += 1
+        _logger.info(f"### Connected to PLC {self.host}:{self.port}")
+        if self.channel:
+            self.channel.text(recorder.CONNECTION, "connected", f"{self.host}:{self.port}", transport.get_extra_info("sockname"))
+        self.dispatch()
+
+    def connection_lost(self, exc):
+        self.transport = None
+        _logger.warning(f"Connection to PLC {self.host}:{self.port} lost: {exc}")
+        if self.channel:
+            self.channel.text(recorder.CONNECTION, "lost", f"{self.host}:{self.port}", exc)
+        for future in self.inflight.values():
+            if not future.done():
+                future.set_exception(ConnectionException("Connection to PLC lost"))
+        self.inflight.clear()
+        # queued requests would wait for the next connection without a timeout
+        for _, _, _, future in self.pending:
+            if not future.done():
+                future.set_exception(ConnectionException("Connection to PLC lost"))
+        self.pending.clear()
+
+    def data_received(self, data):
+        self.recv_buffer += data
+        while self.recv_buffer:
+            used_len, pdu = self.framer.handleFrame(self.recv_buffer, 0, 0)
+            if not used_len:
+                break
+            if self.channel:
+                self.channel.record(recorder.RESPONSE, self.recv_buffer[:used_len])
+            self.recv_buffer = self.recv_buffer[used_len:]
+            if pdu is None:
+                continue
+            future = self.inflight.pop(pdu.transaction_id, None)
+            if future is None:
+                _logger.warning(f"Received response with unknown transaction id {pdu.transaction_id}, ignoring")
+            elif not future.done():
+                future.set_result(pdu)
+        self.dispatch()
+
+    # scheduling
+
+    def execute(self, no_response_expected: bool, request: ModbusPDU):
+        """Queue a request, returns an awaitable of the response."""
+        return self.submit(request)
+
+    async def submit(self, request: ModbusPDU) -> ModbusPDU:
+        if not self.connected and not await self.reconnect():
+            raise ConnectionException(f"Not connected to PLC {self.host}:{self.port}")
+
+        loop = asyncio.get_running_loop()
+        priority = 0 if request.function_code in WRITE_FUNCTION_CODES else 1
+        for attempt in range(self.retries + 1):
+            future = loop.create_future()
+            heapq.heappush(self.pending, (priority, next(self.sequence), request, future))
+            self.dispatch()
+            try:
+                return await future
+            except asyncio.TimeoutError:
+                _logger.warning(f"No response from PLC {self.host}:{self.port} to transaction {request.transaction_id}, "
+                                f"attempt {attempt + 1} of {self.retries + 1}")
+                if self.channel:
+                    self.channel.text(recorder.CONNECTION, "timeout", f"transaction {request.transaction_id}", f"function {request.function_code}")
+            if not self.connected:
+                break
+        raise ModbusIOException(
+            "No response received from PLC",
+            function_code=request.function_code,
+        )
+
+    def dispatch(self):
+        """Send queued requests while there are free in-flight slots."""
+        while self.transport and self.pending and len(self.inflight) < self.max_inflight:
+            _, _, request, future = heapq.heappop(self.pending)
+            if future.done():
+                continue
+            request.transaction_id = self.next_transaction_id()
+            self.inflight[request.transaction_id] = future
+            frame = self.framer.buildFrame(request)
+            if self.channel:
+                self.channel.record(recorder.REQUEST, frame)
+            self.transport.write(frame)
+            # the timeout starts on the wire, not while the request waits for a slot
+            timer = asyncio.get_running_loop().call_later(self.timeout, self.expire, request.transaction_id, future)
+            future.add_done_callback(lambda future, timer=timer: self.done(future, timer))
+
+    def done(self, future: asyncio.Future, timer: asyncio.TimerHandle):
+        timer.cancel()
+        if future.cancelled():
+            # the caller gave up, e.g. a poll cancelled on shutdown
+            for tid, inflight in list(self.inflight.items()):
+                if inflight is future:
+                    del self.inflight[tid]
+            self.dispatch()
+
+    def expire(self, tid: int, future: asyncio.Future):
+        """Fail a request not answered within the timeout, freeing its slot."""
+        if self.inflight.get(tid) is future:
+            del self.inflight[tid]
+        if not future.done():
+            future.set_exception(asyncio.TimeoutError())
+        self.dispatch()
+
+    def next_transaction_id(self) -> int:
+        self.next_tid = self.next_tid % 65000 + 1
+        while self.next_tid in self.inflight:
+            self.next_tid = self.next_tid % 65000 + 1
+        return self.next_tid
+
+    @property
+    def load(self) -> int:
+        return len(self.inflight) + len(self.pending)
+
+
+class PlcPool(ModbusClientMixin):
+    """A pool of pipelined connections to one PLC.
+
+    Reads go to the least loaded connection. Writes always use the first connection,
+    so successive writes reach the PLC in the order they were made.
+    """
+
+    def __init__(self, client, connections: int = 1, max_inflight: int = MAX_INFLIGHT, channel=None):
+        ModbusClientMixin.__init__(self)
+        self.lanes = [PlcIO(client, max_inflight, channel) for _ in range(max(connections, 1))]
+
+    @property
+    def connected(self) -> bool:
+        return any(lane.connected for lane in self.lanes)
+
+    @property
+    def reconnects(self) -> int:
+        return sum(max(lane.connects - 1, 0) for lane in self.lanes)
+
+    @property
+    def connect_failures(self) -> int:
+        return sum(lane.connect_failures for lane in self.lanes)
+
+    async def connect(self) -> bool:
+        results = await asyncio.gather(*(lane.connect() for lane in self.lanes))
+        return any(results)
+
+    def close(self):
+        for lane in self.lanes:
+            lane.close()
+
+    def execute(self, no_response_expected: bool, request: ModbusPDU):
+        if request.function_code in WRITE_FUNCTION_CODES:
+            lane = self.lanes[0]
+        else:
+            lane = min(self.lanes, key=lambda lane: (not lane.connected, lane.load))
+        return lane.submit(request)
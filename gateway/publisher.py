@@ -0,0 +1,147 @@
+"""
+Publication of PLC values to the OPC UA address space.
+
+The values reported by a poll (see report.py) are handed to the OPC UA server through
+a ValueCache and written with a single bulk write to the server's attribute service.
+Each value carries the PLC read time as its source timestamp.
+
+The OPC UA server may run on an event loop of its own, in another thread (see
+gateway.py). The cache is the only state the sync engines and the server share.
+Its deques are appended to and popped from without a lock, as both are atomic.
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+from datetime import datetime, timezone
+
+from asyncua import ua
+
+
+_logger = logging.getLogger(__file__)
+
+# seconds for which values are gathered into one write after the first one arrives, 0 writes at once
+BATCH_INTERVAL = 0.0
+# results of bulk writes kept for take_results()
+MAX_RESULTS = 1000
+
+
+class ValueCache:
+    """Values waiting to be written to OPC UA variables, the latest one per node.
+
+    put() may be called from any thread, run() writes the values on the server's loop.
+    """
+
+    def __init__(self, batch_interval: float = BATCH_INTERVAL):
+        self.batch_interval = batch_interval
+        # lists of WriteValues, and (seconds, failed node ids) of every bulk write
+        self.updates = deque()
+        self.results = deque(maxlen=MAX_RESULTS)
+        self.loop = None
+        self.ready = None
+        # True while run() has been woken up and not yet taken the updates
+        self.scheduled = False
+
+    def put(self, to_write: list):
+        self.updates.append(to_write)
+        if self.scheduled or self.loop is None:
+            return
+        self.scheduled = True
+        try:
+            same_loop = asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            same_loop = False
+        if same_loop:
+            self.ready.set()
+        else:
+            self.loop.call_soon_threadsafe(self.ready.set)
+
+    def take_results(self) -> list[tuple]:
+        """Return the (seconds, failed node ids) of the writes done since the last call."""
+        results = []
+        while self.results:
+            results.append(self.results.popleft())
+        return results
+
+    async def run(self, server):
+        """Write the values put in the cache until cancelled."""
+        self.ready = asyncio.Event()
+        # values put before the loop was known
+        self.ready.set()
+        self.loop = asyncio.get_running_loop()
+        while True:
+            await self.ready.wait()
+            if self.batch_interval:
+                await asyncio.sleep(self.batch_interval)
+            self.ready.clear()
+            # cleared before taking the updates, so a later put() wakes us up again
+            self.scheduled = False
+            latest = {}
+            while self.updates:
+                for wv in self.updates.popleft():
+                    latest[wv.NodeId] = wv
+            if not latest:
+                continue
+
+            params = ua.WriteParameters()
+            params.NodesToWrite = list(latest.values())
+            start = time.perf_counter()
+            results = await server.iserver.attribute_service.write(params)
+            failed = []
+            for wv, status in zip(params.NodesToWrite, results):
+                if not status.is_good():
+                    _logger.warning(f"Failed to publish {wv.NodeId}: {status}")
+                    failed.append(wv.NodeId)
+            self.results.append((time.perf_counter() - start, failed))
+
+
+class Publisher:
+    """Publisher for the OPC UA variables of the tag map."""
+
+    def __init__(self, server, tagmap, nodes, batch_interval: float = BATCH_INTERVAL):
+        self.server = server
+        self.tagmap = tagmap
+        self.nodes = nodes
+        self.names = {nodes[tag.name].nodeid: tag.name for tag in tagmap.tags}
+        self.cache = ValueCache(batch_interval)
+
+    def publish_status(self, status):
+        """Mark every node of the device with a status code, e.g. while the PLC is offline."""
+        to_write = []
+        for tag in self.tagmap.tags:
+            wv = ua.WriteValue()
+            wv.NodeId = self.nodes[tag.name].nodeid
+            wv.AttributeId = ua.AttributeIds.Value
+            wv.Value = ua.DataValue(StatusCode_=ua.StatusCode(status), ServerTimestamp=datetime.now(timezone.utc))
+            to_write.append(wv)
+        self.cache.put(to_write)
+
+    def publish(self, values, source_timestamp=None):
+        """Queue the values for one write."""
+        source_timestamp = source_timestamp or datetime.now(timezone.utc)
+        server_timestamp = datetime.now(timezone.utc)
+
+        to_write = []
+        for tag in self.tagmap.tags:
+            value = values.get(tag.name)
+            if value is None:
+                continue
+            wv = ua.WriteValue()
+            wv.NodeId = self.nodes[tag.name].nodeid
+            wv.AttributeId = ua.AttributeIds.Value
+            wv.Value = ua.DataValue(
+                ua.Variant(value, tag.variant_type),
+                SourceTimestamp=source_timestamp,
+                ServerTimestamp=server_timestamp,
+            )
+            to_write.append(wv)
+        if to_write:
+            self.cache.put(to_write)
+
+    def take_results(self) -> list[tuple]:
+        """Return the (seconds, failed tag names) of the writes done since the last call."""
+        return [(seconds, [self.names[nodeid] for nodeid in failed]) for seconds, failed in self.cache.take_results()]
+
+    async def run(self):
+        """Write the published values, on the OPC UA server's loop."""
+        await self.cache.run(self.server)
@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+"""
+Flight recorder of the gateway's transactions.
+
+Every Modbus request to a PLC and response from it is recorded as sent / received on the
+wire, together with the client commands (OPC UA and Modbus writes), the PLC connection
+events, online / offline changes and the alerts of the process model. Records go into a
+ring buffer of RECORDER_SIZE bytes allocated at start:
+
+    time (float64, Unix epoch) | device (uint16) | kind (uint8) | length (uint16) | payload
+
+A record costs a struct.pack_into and a copy of its payload, so the recorder runs at the
+full poll rate. When the buffer is full the oldest records are overwritten; at a few
+hundred bytes per poll cycle it holds hours of a single PLC.
+
+The last DUMP_MINUTES minutes are written to recordings/flight-<time>.rec
+- on SIGUSR1 (kill -USR1 <pid of gateway.py>)
+- ALERT_DUMP_DELAY seconds after an alert of the process model, so the dump shows what
+  followed as well, at most every ALERT_DUMP_INTERVAL seconds
+- through the OPC UA method diagnostics/dump_flight_recorder(minutes), which returns the
+  path of the file
+
+A dump holds the device names and the zlib compressed records. This file also decodes
+dumps, with the standard library only:
+
+usage: recorder.py [-h] [--device DEVICE] [--kind KIND] [--last SECONDS] [--summary] dump
+
+Examples:
+    recorder.py recordings/flight-20250101-120000-000.rec
+    recorder.py --device dam --kind alert --kind command recordings/flight-20250101-120000-000.rec
+    recorder.py --summary recordings/flight-20250101-120000-000.rec
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import datetime
+import logging
+import struct
+import sys
+import time
+import zlib
+from collections import Counter
+from pathlib import Path
+
+
+_logger = logging.getLogger(__file__)
+
+RECORDER_SIZE = 16 * 1024 * 1024
+RECORDING_DIR = "recordings"
+DUMP_MINUTES = 10.0
+ALERT_DUMP_DELAY = 10.0
+ALERT_DUMP_INTERVAL = 300.0
+# longest payload recorded, longer texts are cut
+MAX_PAYLOAD = 1024
+
+HEADER = struct.Struct("<dHBH")
+MAGIC = b"GWFR\x01"
+
+# record kinds
+REQUEST = 1
+RESPONSE = 2
+COMMAND = 3
+CONNECTION = 4
+STATUS = 5
+ALERT = 6
+KINDS = {REQUEST: "request", RESPONSE: "response", COMMAND: "command", CONNECTION: "connection", STATUS: "status", ALERT: "alert"}
+
+FUNCTIONS = {
+    1: "read_coils",
+    2: "read_discrete_inputs",
+    3: "read_holding_registers",
+    4: "read_input_registers",
+    5: "write_coil",
+    6: "write_register",
+    15: "write_coils",
+    16: "write_registers",
+}
+
+
+class Channel:
+    """Records of one device."""
+
+    __slots__ = ("recorder", "device")
+
+    def __init__(self, recorder, device: int):
+        self.recorder = recorder
+        self.device = device
+
+    def record(self, kind: int, payload: bytes):
+        self.recorder.append(self.device, kind, payload)
+
+    def text(self, kind: int, *fields):
+        """Record text fields, e.g. the source, tag and value of a command."""
+        self.recorder.append(self.device, kind, "\0".join(str(field) for field in fields).encode()[:MAX_PAYLOAD])
+
+
+class FlightRecorder:
+    """Ring buffer of records, dumped on demand."""
+
+    def __init__(self, devices: list[str], size: int = RECORDER_SIZE, path=RECORDING_DIR):
+        self.devices = list(devices)
+        self.size = size
+        self.buffer = bytearray(size)
+        self.path = Path(path)
+        # records lie in [tail, head), or [tail, end) and then [0, head) once wrapped
+        self.head = 0
+        self.tail = 0
+        self.end = 0
+        self.wrapped = False
+        self.records = 0
+        self.dump_at = 0.0
+        # dumps running in the background
+        self.dumping = set()
+
+    def channel(self, device: str) -> Channel:
+        return Channel(self, self.devices.index(device))
+
+    def append(self, device: int, kind: int, payload: bytes):
+        size = HEADER.size + len(payload)
+        offset = self.reserve(size)
+        HEADER.pack_into(self.buffer, offset, time.time(), device, kind, len(payload))
+        self.buffer[offset + HEADER.size:offset + size] = payload
+        self.records += 1
+
+    def reserve(self, size: int) -> int:
+        """Make room for a record at the head, dropping the oldest records."""
+        while True:
+            if not self.wrapped:
+                if self.head + size <= self.size:
+                    break
+                self.end = self.head
+                self.head = 0
+                self.wrapped = True
+            if self.head + size <= self.tail:
+                break
+            if self.tail >= self.end:
+                # the records before the wrap are all dropped
+                self.tail = 0
+                self.wrapped = False
+                continue
+            self.tail += HEADER.size + HEADER.unpack_from(self.buffer, self.tail)[3]
+        offset = self.head
+        self.head += size
+        return offset
+
+    def snapshot(self) -> bytes:
+        """The records in the buffer, oldest first."""
+        view = memoryview(self.buffer)
+        if self.wrapped:
+            return b"".join((view[self.tail:self.end], view[:self.head]))
+        return view[self.tail:self.head].tobytes()
+
+    async def dump(self, minutes: float = DUMP_MINUTES, reason: str = "request") -> Path:
+        """Write the records of the last minutes to a file, returns its path."""
+        data = self.snapshot()
+        now = datetime.datetime.now()
+        path = self.path / f"flight-{now:%Y%m%d-%H%M%S}-{now.microsecond // 1000:03d}.rec"
+        count = await asyncio.to_thread(write_dump, path, self.devices, data, time.time() - minutes * 60)
+        _logger.warning(f"### Flight recorder: {count} records of the last {minutes:g} minutes written to {path} ({reason})")
+        return path
+
+    def request_dump(self, reason: str, minutes: float = DUMP_MINUTES):
+        """Dump in the background, e.g. from a signal handler."""
+        task = asyncio.ensure_future(self.dump(minutes, reason))
+        self.dumping.add(task)
+        task.add_done_callback(self.dumped)
+
+    def dumped(self, task):
+        self.dumping.discard(task)
+        if not task.cancelled() and task.exception():
+            _logger.error(f"### Flight recorder dump failed: {task.exception()}")
+
+    def on_alert(self, alert):
+        """Dump a while after an alert, at most every ALERT_DUMP_INTERVAL."""
+        now = time.monotonic()
+        if now < self.dump_at:
+            return
+        self.dump_at = now + ALERT_DUMP_INTERVAL
+        asyncio.get_running_loop().call_later(ALERT_DUMP_DELAY, self.request_dump, f"alert {alert.kind}")
+
+
+def records(data, start: int = 0):
+    """(time, device, kind, payload) of the records in data."""
+    view = memoryview(data)
+    offset = start
+    size = len(data)
+    unpack = HEADER.unpack_from
+    while offset < size:
+        timestamp, device, kind, length = unpack(view, offset)
+        offset += HEADER.size
+        yield timestamp, device, kind, view[offset:offset + length]
+        offset += length
+
+
+def write_dump(path: Path, devices: list[str], data: bytes, since: float) -> int:
+    """Write the records of data from the time since, returns how many."""
+    offset = 0
+    count = 0
+    for timestamp, _, _, payload in records(data):
+        if timestamp >= since:
+            break
+        offset += HEADER.size + len(payload)
+    for _ in records(data, offset):
+        count += 1
+    names = "\0".join(devices).encode()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "wb") as file:
+        file.write(MAGIC + struct.pack("<I", len(names)) + names)
+        file.write(zlib.compress(data[offset:], 6))
+    return count
+
+
+def read_dump(path) -> tuple[list[str], bytes]:
+    """Device names and records of a dump."""
+    data = Path(path).read_bytes()
+    if not data.startswith(MAGIC):
+        raise ValueError(f"{path} is not a flight recorder dump")
+    size = struct.unpack_from("<I", data, len(MAGIC))[0]
+    start = len(MAGIC) + 4
+    devices = data[start:start + size].decode().split("\0")
+    return devices, zlib.decompress(data[start + size:])
+
+
+def describe_adu(kind: int, adu) -> str:
+    """One line describing a request or response ADU."""
+    if len(adu) < 8:
+        return f"short frame {bytes(adu).hex(' ')}"
+    tid, _, _, unit = struct.unpack_from(">HHHB", adu)
+    function = adu[7]
+    name = FUNCTIONS.get(function & 0x7F, f"function {function & 0x7F}")
+    data = adu[8:]
+    if kind == REQUEST:
+        if function in (1, 2, 3, 4) and len(data) >= 4:
+            address, count = struct.unpack_from(">HH", data)
+            return f"tid {tid} unit {unit} {name} {address} count {count}"
+        if function in (5, 6) and len(data) >= 4:
+            address, value = struct.unpack_from(">HH", data)
+            return f"tid {tid} unit {unit} {name} {address} = {value:#06x}"
+        if function in (15, 16) and len(data) >= 5:
+            address, count = struct.unpack_from(">HH", data)
+            return f"tid {tid} unit {unit} {name} {address} count {count} = {bytes(data[5:]).hex(' ')}"
+        return f"tid {tid} unit {unit} {name} {bytes(data).hex(' ')}"
+    if function & 0x80:
+        return f"tid {tid} unit {unit} {name} exception {data[0] if data else '?'}"
+    if function in (1, 2) and data:
+        bits = [bool(data[1 + n // 8] >> (n % 8) & 1) for n in range(8 * (len(data) - 1))]
+        return f"tid {tid} unit {unit} {name} bits {''.join('1' if bit else '0' for bit in bits)}"
+    if function in (3, 4) and data:
+        registers = struct.unpack_from(f">{(len(data) - 1) // 2}H", data, 1)
+        return f"tid {tid} unit {unit} {name} registers {list(registers)}"
+    return f"tid {tid} unit {unit} {name} {bytes(data).hex(' ')}"
+
+
+def setup_args(cmdline=None):
+    parser = argparse.ArgumentParser(prog="recorder.py", description="Decode a flight recorder dump of the gateway.")
+    parser.add_argument("dump", help="dump file written by the gateway")
+    parser.add_argument("--device", action="append", default=[], help="only the records of this device")
+    parser.add_argument("--kind", action="append", default=[], choices=list(KINDS.values()), help="only records of this kind")
+    parser.add_argument("--last", type=float, default=None, help="only the last seconds of the dump")
+    parser.add_argument("--summary", action="store_true", help="count the records by device and kind instead")
+    return parser.parse_args(cmdline)
+
+
+def main(cmdline=None):
+    args = setup_args(cmdline)
+    try:
+        devices, data = read_dump(args.dump)
+    except (OSError, ValueError, zlib.error) as exc:
+        print(f"recorder.py: {exc}", file=sys.stderr)
+        return 1
+    wanted_devices = {devices.index(name) for name in args.device if name in devices} if args.device else None
+    wanted_kinds = {code for code, name in KINDS.items() if name in args.kind} if args.kind else None
+    since = None
+    if args.last is not None:
+        last = max((timestamp for timestamp, _, _, _ in records(data)), default=0.0)
+        since = last - args.last
+
+    counts = Counter()
+    # device -> transaction id -> time of the request
+    pending = {}
+    lines = []
+    for timestamp, device, kind, payload in records(data):
+        if since is not None and timestamp < since:
+            continue
+        if wanted_devices is not None and device not in wanted_devices:
+            continue
+        if wanted_kinds is not None and kind not in wanted_kinds:
+            continue
+        name = devices[device] if device < len(devices) else f"device {device}"
+        if args.summary:
+            counts[name, KINDS.get(kind, kind)] += 1
+            continue
+        if kind in (REQUEST, RESPONSE):
+            requests = pending.setdefault(device, {})
+            text = describe_adu(kind, payload)
+            tid = struct.unpack_from(">H", payload)[0] if len(payload) >= 2 else None
+            if kind == REQUEST:
+                requests[tid] = timestamp
+            elif requests.get(tid) is not None:
+                text += f" ({(timestamp - requests.pop(tid)) * 1000:.1f} ms)"
+        else:
+            text = " ".join(bytes(payload).decode(errors="replace").split("\0"))
+        stamp = datetime.datetime.fromtimestamp(timestamp).strftime("%H:%M:%S.%f")[:-3]
+        lines.append(f"{stamp} {name} {KINDS.get(kind, kind)} {text}")
+        if len(lines) >= 10000:
+            print("\n".join(lines))
+            lines.clear()
+    if lines:
+        print("\n".join(lines))
+    if args.summary:
+        for (name, kind), count in sorted(counts.items()):
+            print(f"{name:20} {kind:12} {count}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,70 @@
+"""
+Report-by-exception filter of the values polled from a PLC.
+
+A polled value is passed on to OPC UA, the historian and the Modbus gateway image
+only when it is reported:
+- the first value, and any value after invalidate() (e.g. a client overwrote the point)
+- a value which moved beyond the tag's deadband since the last reported value,
+  where the deadband is the larger of the absolute `deadband` and `deadband_percent`
+  of the last reported value; without deadband any change is reported
+- the current value when nothing was reported for `max_interval` seconds, as a heartbeat
+  so stale points can be told apart from steady ones
+
+A tag is reported at most once per `min_interval` seconds. A change held back by it is
+reported by the first poll after the interval, as it is compared with the last reported value.
+"""
+import time
+
+
+class ReportFilter:
+    """Decides which polled values of one device are reported."""
+
+    def __init__(self, tagmap):
+        self.tags = tagmap.tags
+        # tag name -> (value, monotonic time) of the last report
+        self.reported = {}
+        # reason -> number of values, "suppressed" for values not reported
+        self.counts = {"change": 0, "heartbeat": 0, "suppressed": 0}
+
+    def invalidate(self, name):
+        """Report the next value of a tag whatever it is."""
+        self.reported.pop(name, None)
+
+    def reset(self):
+        """Report all next values, e.g. once an offline PLC answers again."""
+        self.reported.clear()
+
+    def exceeds(self, tag, value, last) -> bool:
+        if tag.is_bit or not (tag.deadband or tag.deadband_percent):
+            return value != last
+        deadband = max(tag.deadband, abs(last) * tag.deadband_percent / 100)
+        return abs(value - last) > deadband
+
+    def filter(self, values: dict, now: float | None = None) -> dict:
+        """Return the values to report."""
+        now = time.monotonic() if now is None else now
+        report = {}
+        for tag in self.tags:
+            value = values.get(tag.name)
+            if value is None:
+                continue
+            last = self.reported.get(tag.name)
+            if last is None:
+                reason = "change"
+            else:
+                elapsed = now - last[1]
+                if elapsed < tag.min_interval:
+                    reason = None
+                elif self.exceeds(tag, value, last[0]):
+                    reason = "change"
+                elif tag.max_interval and elapsed >= tag.max_interval:
+                    reason = "heartbeat"
+                else:
+                    reason = None
+            if reason is None:
+                self.counts["suppressed"] += 1
+                continue
+            self.counts[reason] += 1
+            self.reported[tag.name] = (value, now)
+            report[tag.name] = value
+        return report
@@ -0,0 +1,396 @@
+"""
+Event-driven synchronisation between a PLC, the OPC UA server and the Modbus gateway server.
+
+Instead of polling everything on a fixed period, changes are pushed into the engine:
+- OPC UA client writes arrive through the server's PostWrite callback
+- Modbus gateway client writes are reported by a hooked datablock
+- the PLC is polled on its own adaptive schedule, which speeds up when values change
+  or a command was written, and backs off while the process is idle
+
+Operator commands are queued with the time they arrived, and written to the PLC as soon
+as it is free. Commands to the same tag queued meanwhile are coalesced, the latest one
+wins, and the queued changes are written with one write_coils / write_registers request
+per run of adjacent addresses. Polled values are
+passed on by exception (see report.py), so downstream load follows process activity.
+Every poll is also checked against the device's process model, if it has one (see detector.py).
+One SyncEngine runs per field device, so a slow or offline PLC only delays its own points.
+"""
+import asyncio
+import logging
+import datetime
+import time
+
+from asyncua import ua
+from pymodbus.exceptions import ModbusException
+
+from datablock import ArrayDataBlock
+from detector import Detector
+import recorder
+from report import ReportFilter
+from tagmap import MODEL_POINTS, TABLES, plan_writes
+
+
+_logger = logging.getLogger(__file__)
+
+# seconds between status lines of a device
+LOG_INTERVAL = 5.0
+# writes to a tag from different sources within this many seconds count as a conflict
+CONFLICT_WINDOW = 1.0
+
+
+class HookedDataBlock(ArrayDataBlock):
+    """Array-backed datablock which reports writes made by Modbus clients.
+
+    Writes made through setValues (i.e. by the pymodbus server on behalf of a client)
+    are passed to on_write. The gateway mirrors PLC values with mirror(), which does not notify.
+    Writes made before on_write is set, while the gateway is starting, are held for hook().
+    version counts the changes by both, for the read snapshots of the Modbus server (admission.py).
+    """
+
+    def __init__(self, address, values, bits=False, on_write=None):
+        super().__init__(address, values, bits)
+        self.on_write = on_write
+        self.pending = []
+        self.version = 0
+
+    def setValues(self, address, values):
+        result = super().setValues(address, values)
+        if result is None:
+            self.version += 1
+            values = values if isinstance(values, list) else [values]
+            if self.on_write:
+                self.on_write(address - 1, values)
+            else:
+                self.pending.append((address - 1, values))
+        return result
+
+    def hook(self, on_write):
+        """Pass client writes to on_write, starting with those held until now."""
+        self.on_write = on_write
+        pending, self.pending = self.pending, []
+        for address, values in pending:
+            on_write(address, values)
+
+    def mirror(self, address, values):
+        """Set values at the given protocol address without notifying."""
+        self.version += 1
+        return super().setValues(address + 1, values)
+
+
+class SyncEngine:
+    """Keeps the PLC, OPC UA variables and Modbus gateway image in sync."""
+
+    def __init__(self, client, mb_context, tagmap, publisher, metrics, historian=None, channel=None):
+        self.client = client
+        self.mb_context = mb_context
+        self.device_id = tagmap.server_id
+        self.unit = tagmap.unit
+        self.tagmap = tagmap
+        self.publisher = publisher
+        self.metrics = metrics
+        self.historian = historian
+        # flight recorder channel of the PLC, or None
+        self.channel = channel
+        self.name = tagmap.name
+
+        # health of the PLC connection
+        self.online = False
+        self.failures = 0
+        self.last_poll = None
+
+        # OPC UA node id -> writable tag
+        self.writable_nodes = {publisher.nodes[tag.name].nodeid: tag for tag in tagmap.tags if tag.writable}
+        self.values = {}
+        self.reporter = ReportFilter(tagmap)
+
+        # process model point -> tag name, and the points of every read block
+        self.model_points = {}
+        self.model_blocks = []
+        self.detector = None
+        if tagmap.model:
+            self.detector = Detector.from_config(self.name, tagmap.model)
+            self.model_points = {point: tagmap.model[point] for point in MODEL_POINTS if tagmap.model.get(point)}
+            for block in tagmap.blocks:
+                names = {tag.name for tag in block.tags}
+                points = {point: name for point, name in self.model_points.items() if name in names}
+                if points:
+                    self.model_blocks.append(points)
+        # alert kind -> monotonic time of the next warning logged
+        self.alert_log_at = {}
+
+        # tag name -> (source, value, monotonic time) of the commands waiting to be written
+        self.commands = {}
+        self.commands_ready = asyncio.Event()
+        # tag name -> value written to the PLC, while the polls still show it
+        self.written = {}
+        # commands not written as the PLC holds their value, checked again by the next poll
+        self.parked = {}
+        self.poll_now = asyncio.Event()
+        # incremented on every command written, so polls started before a write are discarded
+        self.write_generation = 0
+        # tag name -> (source, time) of the last client write, to detect conflicting writers
+        self.last_writes = {}
+
+        # sampled status line
+        self.log_at = 0.0
+        self.polls_since_log = 0
+
+    def on_opcua_write(self, event, dispatcher):
+        """PostWrite callback of the OPC UA server."""
+        if not event.is_external:
+            return
+        for wv, status in zip(event.request_params.NodesToWrite, event.response_params):
+            if wv.AttributeId != ua.AttributeIds.Value or not status.is_good():
+                continue
+            tag = self.writable_nodes.get(wv.NodeId)
+            if tag is not None:
+                # the node now holds the client's value, so the PLC value must be republished
+                self.reporter.invalidate(tag.name)
+                self.submit("OPC UA", tag, wv.Value.Value.Value)
+
+    def on_modbus_write(self, table):
+        """Build the write hook of a Modbus gateway server table."""
+        def hook(address, values):
+            store = self.mb_context[self.device_id].store[TABLES[table][1]]
+            for tag in self.tagmap.tags_at(table, address, len(values)):
+                if tag.writable:
+                    # likewise for the gateway image
+                    self.reporter.invalidate(tag.name)
+                    self.submit("Modbus", tag, tag.decode(store.getValues(tag.address + 1, tag.count)))
+        return hook
+
+    def submit(self, source, tag, value):
+        """Queue a client command, replacing a command to the same tag not written yet."""
+        now = time.monotonic()
+        last = self.last_writes.get(tag.name)
+        if last and last[0] != source and now - last[1] < CONFLICT_WINDOW:
+            # the later write wins, whether or not the earlier one reached the PLC yet
+            _logger.warning(f"{source} client wrote {self.name}/{tag.name} {now - last[1]:.2f}s after the {last[0]} client, "
+                            f"{source} wins")
+            self.metrics.inc("gateway_write_conflicts_total", device=self.name, tag=tag.name, winner=source)
+        self.last_writes[tag.name] = (source, now)
+        if self.channel:
+            self.channel.text(recorder.COMMAND, source, tag.name, value)
+        queued = self.commands.get(tag.name)
+        if queued is not None:
+            self.metrics.inc("gateway_commands_total", device=self.name, source=queued[0], result="coalesced")
+        self.commands[tag.name] = (source, value, now)
+        self.commands_ready.set()
+
+    async def command_task(self):
+        """Write the queued commands to the PLC whenever it is free."""
+        while True:
+            await self.commands_ready.wait()
+            self.commands_ready.clear()
+            commands, self.commands = self.commands, {}
+
+            writes = []
+            for name, (source, value, queued) in commands.items():
+                tag = self.tagmap.by_name[name]
+                if name in self.written and self.written[name] == value:
+                    # the PLC holds this value as far as is known, the next poll tells
+                    self.parked[name] = (source, value, queued)
+                    continue
+                writes.append((tag, value))
+                # a poll may see the commanded value before the write returns
+                for point, point_tag in self.model_points.items():
+                    if point_tag == name:
+                        self.detector.command(point, value, time.monotonic())
+            if not writes:
+                self.poll_now.set()
+                continue
+            self.write_generation += 1
+
+            for table, start, tags, raw in plan_writes(writes):
+                await self.write_block(table, start, tags, raw, commands)
+            self.poll_now.set()
+
+    async def write_block(self, table, start, tags, raw, commands):
+        """Write adjacent tags with one request, and account for the commands written."""
+        function = "write_coils" if table == "coil" else "write_registers"
+        error = None
+        try:
+            with self.metrics.time("gateway_modbus_request_seconds", device=self.name, function=function):
+                if table == "coil":
+                    rr = await self.client.write_coils(start, raw, device_id=self.unit)
+                else:
+                    rr = await self.client.write_registers(start, raw, device_id=self.unit)
+            if rr.isError():
+                raise ModbusException(f"PLC rejected write: {rr}")
+        except ModbusException as exc:
+            self.metrics.inc("gateway_modbus_errors_total", device=self.name, function=function)
+            error = exc
+        for tag in tags:
+            source, value, queued = commands[tag.name]
+            if error:
+                _logger.error(f"{source} client change of {self.tagmap.name}/{tag.name} to {value!s} failed: {error}")
+                self.metrics.inc("gateway_commands_total", device=self.name, source=source, result="error")
+                self.written.pop(tag.name, None)
+            else:
+                _logger.info(f"{source} client changed {tag.name} to: {value!s} "
+                             f"({(time.monotonic() - queued) * 1000:.1f} ms after the command)")
+                self.metrics.inc("gateway_commands_total", device=self.name, source=source, result="ok")
+                self.written[tag.name] = value
+
+    async def read_block(self, block):
+        function = f"read_{block.table}"
+        try:
+            with self.metrics.time("gateway_modbus_request_seconds", device=self.name, function=function):
+                if block.table == "coil":
+                    rr = await self.client.read_coils(block.start, count=block.count, device_id=self.unit)
+                elif block.table == "discrete_input":
+                    rr = await self.client.read_discrete_inputs(block.start, count=block.count, device_id=self.unit)
+                elif block.table == "holding_register":
+                    rr = await self.client.read_holding_registers(block.start, count=block.count, device_id=self.unit)
+                else:
+                    rr = await self.client.read_input_registers(block.start, count=block.count, device_id=self.unit)
+        except ModbusException:
+            self.metrics.inc("gateway_modbus_errors_total", device=self.name, function=function)
+            raise
+        if rr.isError():
+            self.metrics.inc("gateway_modbus_errors_total", device=self.name, function=function)
+            raise ModbusException(f"PLC rejected read of {block.table} {block.start}-{block.start + block.count - 1}: {rr}")
+        return rr.bits[:block.count] if block.table in ("coil", "discrete_input") else rr.registers
+
+    async def poll(self):
+        """Read the PLC and propagate its values. Returns True if anything changed."""
+        generation = self.write_generation
+
+        # get values from PLC, all blocks in flight at once
+        raw = await asyncio.gather(*(self.read_block(block) for block in self.tagmap.blocks))
+        read_time = datetime.datetime.now(datetime.timezone.utc)
+
+        if generation != self.write_generation:
+            # a command was written while reading, this result is already stale
+            return True
+
+        values = {}
+        for block, data in zip(self.tagmap.blocks, raw):
+            values.update(block.split(data))
+        changed = values != self.values
+        self.values = values
+        self.check_commands(values)
+        if self.detector:
+            self.check_model(values)
+        report = self.reporter.filter(values)
+
+        # writes reported values to OPC
+        if report:
+            self.publisher.publish(report, read_time)
+        for seconds, failed in self.publisher.take_results():
+            self.metrics.observe("gateway_opcua_write_seconds", seconds, device=self.name)
+            for name in failed:
+                # retried on the next poll
+                self.reporter.invalidate(name)
+
+        if self.historian:
+            self.historian.record(self.name, report, read_time)
+
+        # update modbus gateway server with reported values
+        device = self.mb_context[self.device_id]
+        for block, data in zip(self.tagmap.blocks, raw):
+            for tag in block.tags:
+                if tag.name in report:
+                    offset = tag.address - block.start
+                    device.store[block.store].mirror(tag.address, data[offset : offset + tag.count])
+
+        # print a sampled status line, so console output does not slow down polling
+        self.polls_since_log += 1
+        if time.monotonic() >= self.log_at:
+            self.log_at = time.monotonic() + LOG_INTERVAL
+            cycle = self.metrics.get("gateway_poll_seconds", device=self.name)
+            txt = f"{str(datetime.datetime.now())[:-3]} - {self.tagmap.name} - " + ", ".join(
+                f"{tag.name}: {tag.format(values[tag.name])}" for tag in self.tagmap.tags
+            ) + f" ({self.polls_since_log} polls, last cycle {cycle.last * 1000 if cycle else 0:.1f} ms)"
+            print(txt)
+            self.polls_since_log = 0
+        return changed
+
+    def check_commands(self, values):
+        """Forget written values the PLC no longer holds, and queue the parked commands it does not follow."""
+        for name in [name for name, value in self.written.items() if values.get(name) != value]:
+            del self.written[name]
+        parked, self.parked = self.parked, {}
+        for name, (source, value, queued) in parked.items():
+            if values.get(name) == value:
+                self.metrics.inc("gateway_commands_total", device=self.name, source=source, result="unchanged")
+            elif name in self.commands:
+                self.metrics.inc("gateway_commands_total", device=self.name, source=source, result="coalesced")
+            else:
+                self.commands[name] = (source, value, queued)
+                self.commands_ready.set()
+
+    def check_model(self, values):
+        """Check polled values against the process model, warning at most every LOG_INTERVAL per kind."""
+        now = time.monotonic()
+        # the blocks are read concurrently, but still as separate requests, so a tick of the PLC
+        # may fall between the reads of the coils and the registers
+        alerts = []
+        for points in self.model_blocks:
+            alerts += self.detector.observe(now, **{point: values[name] for point, name in points.items()})
+        for alert in alerts:
+            self.metrics.inc("gateway_anomalies_total", device=self.name, kind=alert.kind)
+            if self.channel:
+                self.channel.text(recorder.ALERT, alert.kind, alert.message)
+                self.channel.recorder.on_alert(alert)
+            if now >= self.alert_log_at.get(alert.kind, 0.0):
+                self.alert_log_at[alert.kind] = now + LOG_INTERVAL
+                _logger.warning(f"### {self.name} {alert.kind.replace('_', ' ')}: {alert.message}")
+
+    async def poll_task(self):
+        """Poll the PLC, faster while values are changing and slower while idle."""
+        interval_min = self.tagmap.poll_interval_min
+        interval_max = self.tagmap.poll_interval_max
+        interval = interval_min
+        while True:
+            try:
+                await asyncio.wait_for(self.poll_now.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+            self.poll_now.clear()
+
+            start = time.perf_counter()
+            try:
+                changed = await self.poll()
+            except ModbusException as exc:
+                self.metrics.inc("gateway_polls_total", device=self.name, result="error")
+                await self.set_offline(exc)
+                interval = interval_max
+                continue
+            self.metrics.observe("gateway_poll_seconds", time.perf_counter() - start, device=self.name)
+            self.metrics.inc("gateway_polls_total", device=self.name, result="ok")
+            if not self.online:
+                _logger.info(f"### PLC {self.tagmap.name} online")
+                self.online = True
+                if self.channel:
+                    self.channel.text(recorder.STATUS, "online")
+            self.failures = 0
+            self.last_poll = datetime.datetime.now()
+
+            interval = interval_min if changed else min(interval * 2, interval_max)
+
+    async def set_offline(self, exc):
+        self.failures += 1
+        if self.online or self.failures == 1:
+            _logger.warning(f"### PLC {self.tagmap.name} offline: {exc}")
+            if self.channel:
+                self.channel.text(recorder.STATUS, "offline", exc)
+            self.publisher.publish_status(ua.StatusCodes.BadNoCommunication)
+            # everything is reported again once the PLC answers
+            self.reporter.reset()
+        self.online = False
+
+    def collect(self):
+        """Metrics collector of the engine state."""
+        labels = {"device": self.name}
+        yield "gateway_plc_online", labels, int(self.online)
+        yield "gateway_command_queue", labels, len(self.commands)
+        yield "gateway_plc_reconnects_total", labels, self.client.reconnects
+        yield "gateway_plc_connect_failures_total", labels, self.client.connect_failures
+        for reason, count in self.reporter.counts.items():
+            yield "gateway_reported_values_total", {**labels, "reason": reason}, count
+        if self.detector:
+            yield "gateway_anomaly_rate", labels, self.detector.alert_rate
+
+    async def run(self):
+        await asyncio.gather(self.poll_task(), self.command_task())
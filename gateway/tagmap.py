@@ -0,0 +1,284 @@
+"""
+Declarative tag map for the gateway.
+
+The tag map is a JSON file declaring every field device and the points polled from it:
+
+    {
+      "devices": [
+        {
+          "name": "dam",
+          "host": "192.168.75.5",              # PLC address
+          "port": 502,
+          "unit": 1,                           # device id used towards the PLC
+          "server_id": 0,                      # device id on the Modbus gateway server
+          "folder": "modbus",                  # OPC UA object holding the variables
+          "folder_node": "ns=2;i=1",           # optional, fixed NodeId of the object
+          "max_gap": 0,                        # unused addresses allowed inside one read
+          "max_inflight": 1,                   # requests pipelined on each connection
+          "connections": 1,                    # connections to the PLC
+          "poll_interval_min": 0.3,            # adaptive poll interval bounds (seconds)
+          "poll_interval_max": 1.2,
+          "tags": [
+            {"name": "pump", "table": "coil", "address": 0, "writable": true, "node": "ns=2;i=2"},
+            {"name": "water_level", "table": "input_register", "address": 0, "type": "uint16",
+             "scale": 1, "offset": 0,
+             "deadband": 5,                    # report moves beyond 5 units or 1% of the value, whichever is larger
+             "deadband_percent": 1,
+             "min_interval": 0,                # report at most every / at least every (seconds)
+             "max_interval": 10}
+          ],
+          "model": {"type": "dam", "tick": 0.5,  # optional process model checked by detector.py
+                    "level": "water_level", "pump": "pump", "gate": "gate"}
+        }
+      ]
+    }
+
+A file without "devices" is read as the tag map of a single device.
+Deadbands and report intervals are applied by report.ReportFilter.
+
+Tags of the same table are merged into as few read requests as possible,
+within the protocol limits of 2000 bits / 125 registers per PDU.
+"""
+from __future__ import annotations
+
+import json
+import struct
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from asyncua import ua
+
+
+# table name -> (read function code, pymodbus datastore key)
+TABLES = {
+    "coil": (0x1, "c"),
+    "discrete_input": (0x2, "d"),
+    "holding_register": (0x3, "h"),
+    "input_register": (0x4, "i"),
+}
+WRITABLE_TABLES = ("coil", "holding_register")
+
+# protocol limits per read request
+MAX_BITS = 2000
+MAX_REGISTERS = 125
+# protocol limits per write request
+MAX_WRITE_BITS = 1968
+MAX_WRITE_REGISTERS = 123
+
+# points of a process model which are mapped to tags
+MODEL_POINTS = ("level", "pump", "gate")
+
+# type -> (struct format, number of registers, OPC UA variant type)
+TYPES = {
+    "bool": ("?", 1, ua.VariantType.Boolean),
+    "uint16": (">H", 1, ua.VariantType.UInt16),
+    "int16": (">h", 1, ua.VariantType.Int16),
+    "uint32": (">I", 2, ua.VariantType.UInt32),
+    "int32": (">i", 2, ua.VariantType.Int32),
+    "float32": (">f", 2, ua.VariantType.Float),
+}
+
+
+@dataclass
+class Tag:
+    """A single point of the PLC."""
+
+    name: str
+    table: str
+    address: int
+    type: str = "uint16"
+    scale: float = 1
+    offset: float = 0
+    writable: bool = False
+    node: str | None = None
+    states: list[str] | None = None
+    deadband: float = 0
+    deadband_percent: float = 0
+    min_interval: float = 0
+    max_interval: float = 0
+
+    def __post_init__(self):
+        if self.table not in TABLES:
+            raise ValueError(f"tag {self.name}: unknown table {self.table!r}")
+        if self.is_bit:
+            self.type = "bool"
+        elif self.type not in TYPES or self.type == "bool":
+            raise ValueError(f"tag {self.name}: unknown register type {self.type!r}")
+        if self.writable and self.table not in WRITABLE_TABLES:
+            raise ValueError(f"tag {self.name}: {self.table} is read only")
+        if self.is_bit and (self.deadband or self.deadband_percent):
+            raise ValueError(f"tag {self.name}: deadbands apply to analog points only")
+        if min(self.deadband, self.deadband_percent, self.min_interval, self.max_interval) < 0:
+            raise ValueError(f"tag {self.name}: deadbands and intervals must not be negative")
+        if self.max_interval and self.max_interval < self.min_interval:
+            raise ValueError(f"tag {self.name}: max_interval is below min_interval")
+
+    @property
+    def is_bit(self) -> bool:
+        return self.table in ("coil", "discrete_input")
+
+    @property
+    def count(self) -> int:
+        return TYPES[self.type][1]
+
+    @property
+    def scaled(self) -> bool:
+        return self.scale != 1 or self.offset != 0
+
+    @property
+    def variant_type(self) -> ua.VariantType:
+        if self.scaled:
+            return ua.VariantType.Double
+        return TYPES[self.type][2]
+
+    @property
+    def initial_value(self):
+        if self.is_bit:
+            return False
+        return 0.0 if self.scaled or self.type == "float32" else 0
+
+    def decode(self, raw: list):
+        """Convert raw bits/registers of this tag into its engineering value."""
+        if self.is_bit:
+            return bool(raw[0])
+        fmt, count, _ = TYPES[self.type]
+        value = struct.unpack(fmt, struct.pack(f">{count}H", *raw))[0]
+        if self.scaled:
+            return value * self.scale + self.offset
+        return value
+
+    def encode(self, value) -> list:
+        """Convert an engineering value into raw bits/registers of this tag."""
+        if self.is_bit:
+            return [bool(value)]
+        fmt, count, _ = TYPES[self.type]
+        if self.scaled:
+            value = (value - self.offset) / self.scale
+        if self.type != "float32":
+            value = int(round(value))
+        return list(struct.unpack(f">{count}H", struct.pack(fmt, value)))
+
+    def format(self, value) -> str:
+        if self.states:
+            return self.states[bool(value)]
+        return str(value)
+
+
+@dataclass
+class ReadBlock:
+    """A contiguous address range read with a single request."""
+
+    table: str
+    start: int
+    count: int
+    tags: list[Tag] = field(default_factory=list)
+
+    @property
+    def function_code(self) -> int:
+        return TABLES[self.table][0]
+
+    @property
+    def store(self) -> str:
+        return TABLES[self.table][1]
+
+    def split(self, raw: list) -> dict[str, object]:
+        """Decode the response of this block into tag values."""
+        return {
+            tag.name: tag.decode(raw[tag.address - self.start : tag.address - self.start + tag.count])
+            for tag in self.tags
+        }
+
+
+@dataclass
+class TagMap:
+    """The tag map of one field device, with its connection settings."""
+
+    tags: list[Tag]
+    name: str = "dam"
+    host: str = "192.168.75.5"
+    port: int = 502
+    unit: int = 1
+    server_id: int = 0
+    folder: str = "modbus"
+    folder_node: str | None = None
+    max_gap: int = 0
+    max_inflight: int = 1
+    connections: int = 1
+    poll_interval_min: float = 0.3
+    poll_interval_max: float = 1.2
+    model: dict | None = None
+
+    def __post_init__(self):
+        self.by_name = {tag.name: tag for tag in self.tags}
+        if len(self.by_name) != len(self.tags):
+            raise ValueError("tag names must be unique")
+        if self.model:
+            for point in MODEL_POINTS:
+                if self.model.get(point) is not None and self.model[point] not in self.by_name:
+                    raise ValueError(f"device {self.name}: model {point} is not a tag")
+        self.blocks = plan_reads(self.tags, self.max_gap)
+
+    def tags_at(self, table: str, address: int, count: int) -> list[Tag]:
+        """Return the tags overlapping an address range of a table."""
+        return [
+            tag for tag in self.tags
+            if tag.table == table and tag.address < address + count and address < tag.address + tag.count
+        ]
+
+
+def plan_reads(tags: list[Tag], max_gap: int = 0) -> list[ReadBlock]:
+    """Merge tags into the fewest read requests.
+
+    Tags of the same table are merged while the gap between them is at most max_gap
+    unused addresses and the request stays within the protocol limit.
+    """
+    blocks: list[ReadBlock] = []
+    for table in TABLES:
+        limit = MAX_BITS if table in ("coil", "discrete_input") else MAX_REGISTERS
+        block = None
+        for tag in sorted((t for t in tags if t.table == table), key=lambda t: t.address):
+            end = tag.address + tag.count
+            if block and tag.address <= block.start + block.count + max_gap and end - block.start <= limit:
+                block.count = max(block.count, end - block.start)
+                block.tags.append(tag)
+            else:
+                block = ReadBlock(table, tag.address, tag.count, [tag])
+                blocks.append(block)
+    return blocks
+
+
+def plan_writes(writes: list[tuple[Tag, object]]) -> list[tuple[str, int, list[Tag], list]]:
+    """Merge tag writes into the fewest write requests.
+
+    Writes to adjacent addresses of the same table are merged within the protocol limit.
+    Returns (table, start address, tags, raw bits / registers) of every request.
+    """
+    requests = []
+    for table in WRITABLE_TABLES:
+        limit = MAX_WRITE_BITS if table == "coil" else MAX_WRITE_REGISTERS
+        request = None
+        for tag, value in sorted((w for w in writes if w[0].table == table), key=lambda w: w[0].address):
+            raw = tag.encode(value)
+            if request and tag.address == request[1] + len(request[3]) and len(request[3]) + len(raw) <= limit:
+                request[2].append(tag)
+                request[3].extend(raw)
+            else:
+                request = (table, tag.address, [tag], raw)
+                requests.append(request)
+    return requests
+
+
+def load_tagmap(path: str | Path) -> list[TagMap]:
+    """Load and validate a tag map file, returns the tag map of every device."""
+    with open(path, encoding="utf-8") as f:
+        config = json.load(f)
+
+    tagmaps = []
+    for device in config.get("devices", [config]):
+        tags = [Tag(**entry) for entry in device.pop("tags")]
+        tagmaps.append(TagMap(tags, **device))
+
+    for attr in ("name", "server_id", "folder"):
+        if len({getattr(tagmap, attr) for tagmap in tagmaps}) != len(tagmaps):
+            raise ValueError(f"device {attr} must be unique")
+    return tagmaps
@@ -0,0 +1,521 @@
+#!/usr/bin/env python3
+"""
+Load generator and latency benchmark for the simulation and the gateway.
+
+Opens many concurrent Modbus sessions (and optionally OPC UA sessions against the
+gateway), drives a mix of reads and writes for a fixed duration and reports throughput
+and latency percentiles / histograms per protocol and operation as JSON.
+
+Each session paces its requests at --rate requests per second. Latency is measured from
+the time a request was due, so a server which falls behind the schedule is not hidden
+by the client waiting for it. --attack flood sends requests back to back instead.
+
+Modbus reads use input registers --address/--count, writes a holding register at --address.
+OPC UA reads --opcua-read-node, and writes the value read at start to --opcua-write-node.
+OPC UA sessions can be encrypted (--opcua-security) and subscribe to --opcua-read-node
+(--opcua-subscribe), reporting the delay of the notifications after the value's source time.
+
+Modbus sessions connect over --comm: TCP, UDP, TLS (not verifying the server's
+certificate) or serial (--port is then the serial device, e.g. /tmp/ttyp0).
+
+--modbus-ramp adds Modbus sessions step by step, e.g. 10,100,1000, holding every step for
+--duration, and reports the connect time and rate of the new sessions and the latency of
+the requests with all sessions connected. This shows how many clients a server takes.
+
+--opcua-ramp adds OPC UA sessions step by step, e.g. 1,10,50,100, holding every step for
+--duration, and reports the gateway's poll cycle time and event loop lag of each step from
+its metrics (--metrics-url). This shows whether more SCADA / HMI sessions slow down the
+synchronisation with the PLCs.
+
+Usage:
+    benchmark.py [-h] [--comm {tcp,udp,serial,tls}] [--framer {ascii,rtu,socket,tls}]
+                 [--log {critical,error,warning,info,debug}] [--port PORT] [--host HOST]
+                 [--timeout TIMEOUT] [--attack {flood}]
+                 [--sessions SESSIONS] [--duration DURATION] [--rate RATE]
+                 [--write-ratio WRITE_RATIO] [--device-ids DEVICE_IDS]
+                 [--address ADDRESS] [--count COUNT] [--seed SEED]
+                 [--opcua-sessions OPCUA_SESSIONS] [--opcua-url OPCUA_URL]
+                 [--opcua-user OPCUA_USER] [--opcua-password OPCUA_PASSWORD]
+                 [--opcua-read-node OPCUA_READ_NODE] [--opcua-write-node OPCUA_WRITE_NODE]
+                 [--opcua-security OPCUA_SECURITY] [--opcua-subscribe OPCUA_SUBSCRIBE]
+                 [--opcua-ramp OPCUA_RAMP] [--modbus-ramp MODBUS_RAMP] [--metrics-url METRICS_URL]
+                 [--output OUTPUT]
+
+Examples:
+    # simulation on port 5020, 50 sessions for 30 s
+    benchmark.py --port 5020 --sessions 50 --duration 30 --output sim.json
+
+    # simulation over TLS, 10 to 2000 sessions reading once a second, 10 s each
+    benchmark.py --comm tls --port 5021 --modbus-ramp 10,100,500,1000,2000 --rate 1 --output tls.json
+
+    # gateway, Modbus and OPC UA at once, as fast as possible
+    benchmark.py --host 127.0.0.1 --port 502 --sessions 20 --opcua-sessions 20 --attack flood
+
+    # on the gateway, 1 to 100 encrypted subscribing sessions, 30 s each
+    benchmark.py --sessions 0 --opcua-ramp 1,10,25,50,100 --opcua-security Basic256Sha256,SignAndEncrypt \
+                 --opcua-subscribe 250 --rate 1 --duration 30
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import random
+import re
+import sys
+import tempfile
+import time
+from pathlib import Path
+from urllib.parse import urlparse
+
+import numpy as np
+
+try:
+    import helper  # type: ignore[import-not-found]
+except ImportError:
+    print("*** ERROR --> THIS EXAMPLE needs the example directory, please see \n\
+          https://pymodbus.readthedocs.io/en/latest/source/examples.html\n\
+          for more information.")
+    sys.exit(-1)
+
+import pymodbus.client as modbusClient
+from pymodbus.exceptions import ModbusException
+
+
+_logger = logging.getLogger(__file__)
+
+# histogram bucket upper bounds in ms, 4 per doubling from 50us to ~105s
+BUCKETS_MS = [0.05 * 2 ** (n / 4) for n in range(85)]
+
+EXTRAS = [
+    ("--sessions", {"help": "set number of Modbus sessions, default is 10", "default": 10, "type": int}),
+    ("--duration", {"help": "set benchmark duration in seconds, default is 10", "default": 10.0, "type": float}),
+    ("--rate", {"help": "set requests per second per session, default is 10", "default": 10.0, "type": float}),
+    ("--write-ratio", {"help": "set fraction of writes, default is 0.1", "default": 0.1, "type": float}),
+    ("--device-ids", {"help": "set device ids to spread requests over, e.g. 1 or 1-100, default is 1", "default": "1", "type": str}),
+    ("--address", {"help": "set register address, default is 0", "default": 0, "type": int}),
+    ("--count", {"help": "set number of registers per read, default is 1", "default": 1, "type": int}),
+    ("--seed", {"help": "set seed of the read/write mix", "default": None, "type": int}),
+    ("--opcua-sessions", {"help": "set number of OPC UA sessions, default is 0", "default": 0, "type": int}),
+    ("--opcua-url", {"help": "set OPC UA endpoint", "default": "opc.tcp://127.0.0.1:4840/", "type": str}),
+    ("--opcua-user", {"help": "set OPC UA user name", "default": "fuxa", "type": str}),
+    ("--opcua-password", {"help": "set OPC UA password", "default": "fuxa", "type": str}),
+    ("--opcua-read-node", {"help": "set OPC UA node to read, default is water_level", "default": "ns=2;i=4", "type": str}),
+    ("--opcua-write-node", {"help": "set OPC UA node to write the value read at start to, default is none (reads only). Writes change the process once the PLC has moved on", "default": None, "type": str}),
+    ("--opcua-security", {"help": "set OPC UA security policy and mode, e.g. Basic256Sha256,SignAndEncrypt, default is none", "default": None, "type": str}),
+    ("--opcua-subscribe", {"help": "subscribe to the read node at this publishing interval in ms, default is no subscription", "default": None, "type": float}),
+    ("--opcua-ramp", {"help": "set OPC UA sessions of each step, e.g. 1,10,50,100, each step lasting --duration", "default": None, "type": str}),
+    ("--modbus-ramp", {"help": "set Modbus sessions of each step, e.g. 10,100,1000, each step lasting --duration", "default": None, "type": str}),
+    ("--metrics-url", {"help": "set gateway metrics to sample during a ramp", "default": "http://127.0.0.1:9108/metrics", "type": str}),
+    ("--output", {"help": "write the JSON report to this file, default is stdout", "default": None, "type": str}),
+]
+
+
+def parse_ids(text: str) -> list[int]:
+    """Parse device ids like "1", "1,3" or "1-100"."""
+    ids = []
+    for part in text.split(","):
+        first, _, last = part.partition("-")
+        ids.extend(range(int(first), int(last or first) + 1))
+    return ids
+
+
+class Recorder:
+    """Latencies and errors of one protocol operation."""
+
+    def __init__(self):
+        self.latencies: list[float] = []
+        self.errors = 0
+
+    def report(self, duration: float) -> dict:
+        latencies = np.array(self.latencies) * 1000
+        report = {
+            "requests": len(latencies) + self.errors,
+            "errors": self.errors,
+            "throughput": round(len(latencies) / duration, 1),
+        }
+        if len(latencies):
+            p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+            counts = np.bincount(np.searchsorted(BUCKETS_MS, latencies), minlength=len(BUCKETS_MS) + 1)
+            report["latency_ms"] = {
+                "min": round(float(latencies.min()), 3),
+                "mean": round(float(latencies.mean()), 3),
+                "p50": round(float(p50), 3),
+                "p95": round(float(p95), 3),
+                "p99": round(float(p99), 3),
+                "max": round(float(latencies.max()), 3),
+            }
+            # upper bucket bound in ms -> count, "inf" for anything beyond the last bound
+            report["histogram"] = {
+                (f"{bound:.3f}" if n < len(BUCKETS_MS) else "inf"): int(count)
+                for n, (bound, count) in enumerate(zip(BUCKETS_MS + [float("inf")], counts))
+                if count
+            }
+        return report
+
+
+def quantile(buckets: list[tuple[float, float]], q: float) -> float | None:
+    """Upper bound of the histogram bucket holding the q quantile, buckets as (bound, cumulative count)."""
+    if not buckets or not buckets[-1][1]:
+        return None
+    for bound, count in buckets:
+        if count >= q * buckets[-1][1]:
+            return bound
+    return buckets[-1][0]
+
+
+async def scrape(url: str) -> dict[str, float]:
+    """Fetch metrics in the Prometheus text format, series -> value."""
+    parts = urlparse(url)
+    reader, writer = await asyncio.open_connection(parts.hostname, parts.port or 80)
+    try:
+        writer.write(f"GET {parts.path or '/'} HTTP/1.0\r\nHost: {parts.hostname}\r\n\r\n".encode())
+        data = (await reader.read()).decode("latin-1")
+    finally:
+        writer.close()
+    series = {}
+    for line in data.partition("\r\n\r\n")[2].splitlines():
+        if line and not line.startswith("#"):
+            name, _, value = line.rpartition(" ")
+            series[name] = float(value)
+    return series
+
+
+def histogram_delta(before: dict, after: dict, name: str) -> dict:
+    """Summary in ms of a histogram between two scrapes, summed over its label sets."""
+    counts = {}
+    for series, value in after.items():
+        if series.startswith(name + "_bucket"):
+            le = re.search(r'le="([^"]+)"', series).group(1)
+            counts[float(le)] = counts.get(float(le), 0) + value - before.get(series, 0)
+    total = sum(value - before.get(series, 0) for series, value in after.items() if series.startswith(name + "_count"))
+    seconds = sum(value - before.get(series, 0) for series, value in after.items() if series.startswith(name + "_sum"))
+    buckets = sorted(counts.items())
+    summary = {"count": int(total)}
+    if total:
+        # percentiles are bucket upper bounds
+        summary["mean"] = round(seconds / total * 1000, 3)
+        for label, q in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99)):
+            bound = quantile(buckets, q)
+            summary[label] = None if bound == float("inf") else round(bound * 1000, 3)
+    return summary
+
+
+async def client_certificate() -> tuple[str, str, str]:
+    """Generate a self-signed client certificate, returns the application uri, cert and key paths."""
+    from asyncua.crypto.cert_gen import setup_self_signed_certificate
+    from cryptography.x509.oid import ExtendedKeyUsageOID
+
+    folder = Path(tempfile.mkdtemp(prefix="benchmark-"))
+    app_uri = "urn:benchmark:client"
+    cert, key = folder / "client-certificate.der", folder / "client-private-key.pem"
+    await setup_self_signed_certificate(
+        key, cert, app_uri, "benchmark", [ExtendedKeyUsageOID.CLIENT_AUTH], {"commonName": "benchmark"}
+    )
+    return app_uri, str(cert), str(key)
+
+
+async def paced(args, rng, op):
+    """Run op(is_write) until the end of the benchmark, at --rate or back to back."""
+    loop = asyncio.get_running_loop()
+    interval = 0 if args.attack == "flood" or not args.rate else 1 / args.rate
+    due = loop.time() + rng.random() * interval
+    while due < args.deadline:
+        if interval:
+            await asyncio.sleep(max(0.0, due - loop.time()))
+        await op(rng.random() < args.write_ratio, due if interval else loop.time())
+        due = due + interval if interval else loop.time()
+
+
+def modbus_client(args) -> modbusClient.ModbusBaseClient:
+    """Client of one Modbus session, over --comm."""
+    if args.comm == "udp":
+        return modbusClient.AsyncModbusUdpClient(
+            args.host, port=args.port, framer=args.framer, timeout=args.timeout, retries=0
+        )
+    if args.comm == "tls":
+        # the simulation's certificate is self-signed
+        return modbusClient.AsyncModbusTlsClient(
+            args.host, port=args.port, framer=args.framer, timeout=args.timeout, retries=0,
+            sslctx=modbusClient.AsyncModbusTlsClient.generate_ssl(),
+        )
+    if args.comm == "serial":
+        return modbusClient.AsyncModbusSerialClient(
+            args.port, framer=args.framer, baudrate=args.baudrate, timeout=args.timeout, retries=0
+        )
+    return modbusClient.AsyncModbusTcpClient(
+        args.host, port=args.port, framer=args.framer, timeout=args.timeout, retries=0
+    )
+
+
+async def modbus_session(args, n, results):
+    """One Modbus session issuing reads and writes."""
+    client = modbus_client(args)
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    if not await client.connect():
+        _logger.error(f"Modbus session {n} failed to connect to {args.host}:{args.port}")
+        results["modbus", "connect"].errors += 1
+        return
+    results["modbus", "connect"].latencies.append(loop.time() - start)
+    rng = random.Random(None if args.seed is None else args.seed + n)
+
+    async def op(is_write, start):
+        device_id = rng.choice(args.ids)
+        recorder = results["modbus", "write" if is_write else "read"]
+        try:
+            if is_write:
+                rr = await client.write_register(args.address, n & 0xFFFF, device_id=device_id)
+            else:
+                rr = await client.read_input_registers(args.address, count=args.count, device_id=device_id)
+        except ModbusException as exc:
+            _logger.debug(f"Modbus session {n}: {exc}")
+            recorder.errors += 1
+            return
+        if rr.isError():
+            recorder.errors += 1
+        else:
+            recorder.latencies.append(loop.time() - start)
+
+    try:
+        await paced(args, rng, op)
+    finally:
+        client.close()
+
+
+async def opcua_session(args, n, results):
+    """One OPC UA session issuing reads and writes."""
+    # only needed for OPC UA sessions, the simulation VM does not install asyncua
+    from asyncua import Client, ua
+
+    client = Client(args.opcua_url, timeout=args.timeout)
+    client.set_user(args.opcua_user)
+    client.set_password(args.opcua_password)
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    try:
+        if args.opcua_security:
+            client.application_uri, cert, key = args.client_certificate
+            await client.set_security_string(f"{args.opcua_security},{cert},{key}")
+        await client.connect()
+    except (OSError, asyncio.TimeoutError, ua.UaError) as exc:
+        _logger.error(f"OPC UA session {n} failed to connect to {args.opcua_url}: {exc}")
+        results["opcua", "connect"].errors += 1
+        return
+    results["opcua", "connect"].latencies.append(loop.time() - start)
+    rng = random.Random(None if args.seed is None else args.seed + 10000 + n)
+    read_node = client.get_node(args.opcua_read_node)
+    if args.opcua_subscribe:
+        class Handler:
+            def datachange_notification(self, node, value, data):
+                # delay after the PLC read, including the wait for the publishing interval
+                source = data.monitored_item.Value.SourceTimestamp
+                if source:
+                    results["opcua", "notify"].latencies.append(time.time() - source.timestamp())
+
+        subscription = await client.create_subscription(args.opcua_subscribe, Handler())
+        await subscription.subscribe_data_change(read_node)
+    write_node = client.get_node(args.opcua_write_node) if args.opcua_write_node else None
+    # the value read at start, which may no longer be the PLC's when it is written
+    write_value = ua.DataValue((await write_node.read_data_value()).Value) if write_node else None
+
+    async def op(is_write, start):
+        is_write = is_write and write_node is not None
+        recorder = results["opcua", "write" if is_write else "read"]
+        try:
+            if is_write:
+                await write_node.write_value(write_value)
+            else:
+                await read_node.read_value()
+        except (ua.UaError, asyncio.TimeoutError) as exc:
+            _logger.debug(f"OPC UA session {n}: {exc}")
+            recorder.errors += 1
+            return
+        recorder.latencies.append(loop.time() - start)
+
+    try:
+        await paced(args, rng, op)
+    finally:
+        await client.disconnect()
+
+
+async def run_ramp(args, results) -> dict:
+    """Add OPC UA sessions step by step, returns the report with the gateway metrics of every step."""
+    loop = asyncio.get_running_loop()
+    args.deadline = float("inf")
+    steps = [int(count) for count in args.opcua_ramp.split(",")]
+    _logger.info(f"### Ramp OPC UA sessions {steps} with {args.sessions} Modbus sessions, {args.duration}s per step")
+    tasks = [asyncio.create_task(modbus_session(args, n, results)) for n in range(args.sessions)]
+    opcua_tasks = []
+    report = {
+        "config": {
+            "host": args.host,
+            "port": args.port,
+            "sessions": args.sessions,
+            "opcua_url": args.opcua_url,
+            "opcua_security": args.opcua_security,
+            "opcua_subscribe": args.opcua_subscribe,
+            "duration": args.duration,
+            "rate": None if args.attack == "flood" else args.rate,
+        },
+        "steps": [],
+    }
+    try:
+        for count in steps:
+            opcua_tasks.extend(
+                asyncio.create_task(opcua_session(args, n, results)) for n in range(len(opcua_tasks), count)
+            )
+            # measure once the new sessions are connected, not their handshakes
+            connect = results["opcua", "connect"]
+            wait_until = loop.time() + args.timeout * 2
+            while len(connect.latencies) + connect.errors < count and loop.time() < wait_until:
+                await asyncio.sleep(0.1)
+            for op in ("read", "write", "notify"):
+                results["opcua", op] = Recorder()
+            before = await scrape(args.metrics_url)
+            started = loop.time()
+            await asyncio.sleep(args.duration)
+            after = await scrape(args.metrics_url)
+            duration = loop.time() - started
+
+            step = {
+                "opcua_sessions": count,
+                "connected": len(connect.latencies),
+                "poll_cycle_ms": histogram_delta(before, after, "gateway_poll_seconds"),
+                "event_loop_lag_ms": histogram_delta(before, after, "gateway_event_loop_lag_seconds"),
+            }
+            for op in ("read", "write", "notify"):
+                if results["opcua", op].latencies or results["opcua", op].errors:
+                    step[op] = results["opcua", op].report(duration)
+                    step[op].pop("histogram", None)
+            report["steps"].append(step)
+            _logger.info(f"### {count} OPC UA sessions: poll cycle {step['poll_cycle_ms']}")
+    finally:
+        args.deadline = loop.time()
+        await asyncio.gather(*tasks, *opcua_tasks, return_exceptions=True)
+    # the time of an OPC UA handshake
+    report["opcua_connect"] = results["opcua", "connect"].report(1.0)
+    report["opcua_connect"].pop("throughput")
+    report["opcua_connect"].pop("histogram", None)
+    return report
+
+
+async def run_modbus_ramp(args, results) -> dict:
+    """Add Modbus sessions step by step, returns the report of the connections and requests of every step."""
+    loop = asyncio.get_running_loop()
+    args.deadline = float("inf")
+    steps = [int(count) for count in args.modbus_ramp.split(",")]
+    _logger.info(f"### Ramp Modbus sessions {steps} over {args.comm}, {args.duration}s per step")
+    tasks = []
+    report = {
+        "config": {
+            "host": args.host,
+            "port": args.port,
+            "comm": args.comm,
+            "duration": args.duration,
+            "rate": None if args.attack == "flood" else args.rate,
+            "write_ratio": args.write_ratio,
+            "open_files_limit": helper.raise_open_files_limit(),
+        },
+        "steps": [],
+    }
+    try:
+        for count in steps:
+            results["modbus", "connect"] = connect = Recorder()
+            started = loop.time()
+            new = count - len(tasks)
+            tasks.extend(asyncio.create_task(modbus_session(args, n, results)) for n in range(len(tasks), count))
+            # measure once the new sessions are connected, not their handshakes
+            wait_until = loop.time() + args.timeout * 2
+            while len(connect.latencies) + connect.errors < new and loop.time() < wait_until:
+                await asyncio.sleep(0.05)
+            connect_time = loop.time() - started
+            for op in ("read", "write"):
+                results["modbus", op] = Recorder()
+            started = loop.time()
+            await asyncio.sleep(args.duration)
+            duration = loop.time() - started
+
+            step = {
+                "sessions": count,
+                "connected": sum(not task.done() for task in tasks),
+                "connect": connect.report(1.0),
+                "connects_per_s": round(len(connect.latencies) / connect_time, 1) if connect_time else None,
+            }
+            step["connect"].pop("throughput")
+            step["connect"].pop("histogram", None)
+            for op in ("read", "write"):
+                if results["modbus", op].latencies or results["modbus", op].errors:
+                    step[op] = results["modbus", op].report(duration)
+                    step[op].pop("histogram", None)
+            report["steps"].append(step)
+            _logger.info(f"### {count} Modbus sessions: {step['connected']} connected, read {step.get('read')}")
+    finally:
+        args.deadline = loop.time()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    return report
+
+
+async def run_benchmark(args) -> dict:
+    """Run all sessions, returns the report."""
+    results = {
+        (protocol, op): Recorder()
+        for protocol in ("modbus", "opcua")
+        for op in ("connect", "read", "write", "notify")
+    }
+    loop = asyncio.get_running_loop()
+    args.ids = parse_ids(args.device_ids)
+    if args.opcua_security:
+        args.client_certificate = await client_certificate()
+    if args.opcua_ramp:
+        return await run_ramp(args, results)
+    if args.modbus_ramp:
+        return await run_modbus_ramp(args, results)
+    helper.raise_open_files_limit()
+    args.deadline = loop.time() + args.duration
+    started = loop.time()
+    _logger.info(f"### Benchmark {args.sessions} Modbus and {args.opcua_sessions} OPC UA sessions for {args.duration}s")
+
+    await asyncio.gather(
+        *(modbus_session(args, n, results) for n in range(args.sessions)),
+        *(opcua_session(args, n, results) for n in range(args.opcua_sessions)),
+    )
+    duration = loop.time() - started
+
+    report = {
+        "config": {
+            "host": args.host,
+            "port": args.port,
+            "comm": args.comm,
+            "sessions": args.sessions,
+            "opcua_sessions": args.opcua_sessions,
+            "opcua_url": args.opcua_url if args.opcua_sessions else None,
+            "duration": round(duration, 3),
+            "rate": None if args.attack == "flood" else args.rate,
+            "write_ratio": args.write_ratio,
+            "device_ids": args.device_ids,
+            "count": args.count,
+        },
+    }
+    for (protocol, op), recorder in results.items():
+        if recorder.latencies or recorder.errors:
+            report.setdefault(protocol, {})[op] = recorder.report(duration)
+    return report
+
+
+async def main(cmdline=None):
+    """Combine setup and run."""
+    args = helper.get_commandline(
+        server=False, description="Benchmark a Modbus/OPC UA server.", extras=EXTRAS, cmdline=cmdline
+    )
+    report = await run_benchmark(args)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
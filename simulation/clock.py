@@ -0,0 +1,58 @@
+"""
+Simulation clock.
+
+The simulation advances in fixed steps of simulated time. The clock decides how
+much wall-clock time passes between steps:
+- realtime: one step every `step` seconds, as on the lab network
+- accelerated: `speed` times faster than real time
+- fixed: as fast as possible, only yielding to the event loop so the
+  Modbus server keeps answering
+
+Simulated time is derived from the step count only, so a run produces the same
+trajectory in every mode.
+"""
+from __future__ import annotations
+
+import asyncio
+import datetime
+
+
+MODES = ("realtime", "accelerated", "fixed")
+
+
+class SimClock:
+    """Fixed-step simulation time, paced against the wall clock depending on the mode."""
+
+    def __init__(self, mode: str = "realtime", step: float = 0.5, speed: float = 1.0, start: datetime.datetime | None = None):
+        if mode not in MODES:
+            raise ValueError(f"unknown clock mode {mode!r}")
+        if step <= 0 or speed <= 0:
+            raise ValueError("clock step and speed must be positive")
+        self.mode = mode
+        self.step = step
+        self.speed = speed if mode == "accelerated" else 1.0
+        self.start = start or datetime.datetime.now()
+        self.tick = 0
+        self.deadline: float | None = None
+
+    @property
+    def elapsed(self) -> float:
+        """Simulated seconds since the start."""
+        return self.tick * self.step
+
+    def now(self) -> datetime.datetime:
+        """Simulated time of the current tick."""
+        return self.start + datetime.timedelta(seconds=self.elapsed)
+
+    async def wait(self):
+        """Wait until the next tick is due, then advance to it."""
+        if self.mode == "fixed":
+            await asyncio.sleep(0)
+        else:
+            # sleep to absolute deadlines, so time spent stepping does not add up to drift
+            loop = asyncio.get_running_loop()
+            if self.deadline is None:
+                self.deadline = loop.time()
+            self.deadline += self.step / self.speed
+            await asyncio.sleep(max(0.0, self.deadline - loop.time()))
+        self.tick += 1
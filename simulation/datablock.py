@@ -0,0 +1,115 @@
+"""
+Array-backed Modbus datablock.
+
+ModbusSequentialDataBlock keeps one Python object per address and builds new lists
+on every request. ArrayDataBlock keeps the values in flat memory instead:
+- registers in an array('H'), 2 bytes per address
+- bits in a bytearray, 1 byte per address (0 or 1), so NumPy can view them as bool
+  without unpacking
+
+Reads copy a slice of the memory, writes copy into it. Bulk updates accept any
+contiguous buffer of the same item size, e.g. NumPy uint16 / bool arrays, and
+view() exposes the memory itself, e.g. for np.frombuffer(block.view(), np.uint16).
+
+The memory can also be supplied by the caller (a memoryview, bytearray or array),
+so several datablocks can share one buffer.
+"""
+from __future__ import annotations
+
+from array import array
+
+from pymodbus.constants import ExcCodes
+from pymodbus.datastore.store import BaseModbusDataBlock
+
+
+class ArrayDataBlock(BaseModbusDataBlock):
+    """Sequential datablock of registers or bits backed by flat memory."""
+
+    def __init__(self, address: int, values, bits: bool = False):
+        """Initialize the datastore.
+
+        :param address: The starting address of the datastore
+        :param values: Initial values, or a writable buffer to use in place
+        :param bits: True for coils / discrete inputs, False for registers
+        """
+        self.address = address
+        self.bits = bits
+        self.itemsize = 1 if bits else 2
+        if isinstance(values, (memoryview, bytearray, array)):
+            buffer = memoryview(values).cast("B")
+        elif bits:
+            buffer = memoryview(bytearray(bool(v) for v in values))
+        else:
+            buffer = memoryview(array("H", values)).cast("B")
+        if buffer.readonly:
+            raise TypeError("datablock buffer must be writable")
+        self.raw = buffer
+        self.values = buffer.cast("?" if bits else "H")
+        self.default_value = self.values[0] if len(self.values) else (False if bits else 0)
+
+    @classmethod
+    def create(cls, bits: bool = False):
+        """Create a datastore with the full address space initialized to 0x00."""
+        return cls(0x00, [0x00] * 65536, bits=bits)
+
+    def default(self, count, value=False):
+        """Use to initialize a store to one value."""
+        self.__init__(0x00, [value] * count, bits=self.bits)
+
+    def reset(self):
+        """Reset the datastore to the initialized default value."""
+        self.setValues(self.address, [self.default_value] * len(self.values))
+
+    def _encode(self, values):
+        """Convert values into a buffer of the datablock's item size."""
+        if isinstance(values, (int, bool)):
+            values = [values]
+        try:
+            buffer = memoryview(values)
+        except TypeError:
+            buffer = None
+        # contiguous buffers of the same item size are copied as they are
+        if buffer is not None and buffer.itemsize == self.itemsize and buffer.c_contiguous:
+            return buffer.cast("B")
+        if self.bits:
+            return memoryview(bytes(bool(v) for v in values))
+        return memoryview(array("H", values)).cast("B")
+
+    def getValues(self, address, count=1) -> list[int] | list[bool] | ExcCodes:
+        """Return the requested values of the datastore.
+
+        Bits are returned as a list of bools, registers as an array('H').
+        """
+        start = address - self.address
+        if start < 0 or len(self.values) < start + count:
+            return ExcCodes.ILLEGAL_ADDRESS
+        if self.bits:
+            return self.values[start : start + count].tolist()
+        registers = array("H")
+        registers.frombytes(self.raw[2 * start : 2 * (start + count)])
+        return registers
+
+    def setValues(self, address, values) -> None | ExcCodes:
+        """Set the requested values of the datastore.
+
+        :param values: A value, a list of values or a contiguous buffer, e.g. a NumPy array
+        """
+        buffer = self._encode(values)
+        start = address - self.address
+        count = buffer.nbytes // self.itemsize
+        if start < 0 or len(self.values) < start + count:
+            return ExcCodes.ILLEGAL_ADDRESS
+        self.raw[self.itemsize * start : self.itemsize * (start + count)] = buffer
+        return None
+
+    def view(self, address=None, count=None) -> memoryview:
+        """Return the memory of an address range, without copying.
+
+        :param address: The starting address, defaults to the start of the datastore
+        :param count: The number of values, defaults to the rest of the datastore
+        """
+        start = 0 if address is None else address - self.address
+        stop = len(self.values) if count is None else start + count
+        if start < 0 or stop > len(self.values):
+            raise IndexError(f"address range {address}+{count} outside of datastore")
+        return self.values[start:stop]
@@ -0,0 +1,145 @@
+"""
+Vectorised dam simulation engine.
+
+Keeps the state of many reservoirs in NumPy arrays and steps all of them at once,
+with the same dynamics as the single dam of simulation.py:
+- pump on: water level +10 (0.10cm) per tick
+- gate open: water level -25 (0.25cm) per tick
+- water level > 2100: gate opens, pump turns off
+- water level < 1700: gate closes, pump turns on
+
+Each reservoir is served on its own Modbus device id. Modbus only has 247 unicast
+device ids, so with more reservoirs than that, several reservoirs share a device:
+reservoir k of a device uses coils 2k (pump) and 2k+1 (gate) and input register k.
+"""
+from __future__ import annotations
+
+import contextlib
+import math
+
+import numpy as np
+
+from pymodbus.datastore import ModbusDeviceContext, ModbusServerContext
+
+from datablock import ArrayDataBlock
+
+
+PUMP_RATE = 10
+GATE_RATE = 25
+LEVEL_HIGH = 2100
+LEVEL_LOW = 1700
+LEVEL_MAX = 65535
+
+MAX_DEVICES = 247
+
+
+class DamEngine:
+    """State and dynamics of a set of reservoirs."""
+
+    def __init__(self, count: int = 1, level: int = 1500, seed: int | None = None):
+        self.count = count
+        if seed is None:
+            # set waterlevel to 15cm, pump on, gate closed
+            self.level = np.full(count, level, dtype=np.int32)
+            self.pump = np.ones(count, dtype=bool)
+            self.gate = np.zeros(count, dtype=bool)
+        else:
+            # reproducible spread of levels within the control band, filling or draining
+            rng = np.random.default_rng(seed)
+            self.level = rng.integers(LEVEL_LOW, LEVEL_HIGH + 1, count, dtype=np.int32)
+            self.pump = rng.random(count) < 0.5
+            self.gate = ~self.pump
+
+    def step(self):
+        """Advance every reservoir by one tick."""
+        level = self.level + PUMP_RATE * self.pump - GATE_RATE * self.gate
+
+        high = level > LEVEL_HIGH
+        low = level < LEVEL_LOW
+        self.pump = (self.pump & ~high) | low
+        self.gate = (self.gate | high) & ~low
+
+        # ensure waterlevel fits within the modbus register range
+        np.clip(level, 0, LEVEL_MAX, out=level)
+        self.level = level
+
+
+def layout(count: int) -> tuple[int, int, int, int]:
+    """Datastore layout for a number of reservoirs.
+
+    Returns reservoirs per device, number of devices, and the coil and register
+    datablock sizes per device (datablock index = protocol address + 1).
+    """
+    per_device = max(1, math.ceil(count / MAX_DEVICES))
+    devices = math.ceil(count / per_device)
+    return per_device, devices, max(100, 2 * per_device + 1), max(100, per_device + 1)
+
+
+def server_context(coils, registers, datablock=ArrayDataBlock, **kwargs) -> ModbusServerContext:
+    """Build the server context serving the rows of the coil and register arrays in place."""
+    contexts = {}
+    for n in range(len(coils)):
+        contexts[n + 1] = ModbusDeviceContext(
+            di=ArrayDataBlock(0x00, [0] * 100, bits=True),
+            co=datablock(0x00, memoryview(coils[n]), bits=True, **kwargs),
+            hr=ArrayDataBlock(0x00, [0] * 100),
+            ir=datablock(0x00, memoryview(registers[n]), **kwargs))
+    if len(contexts) == 1:
+        # a single dam answers on every device id, like the original simulation
+        return ModbusServerContext(devices=contexts[1], single=True)
+    return ModbusServerContext(devices=contexts, single=False)
+
+
+class DamContext:
+    """Maps the reservoirs of a DamEngine onto Modbus device contexts.
+
+    The coils and input registers of all devices are rows of two shared NumPy arrays,
+    served in place by array-backed datablocks, so the engine state is exchanged with
+    the datastore in a few array operations per tick.
+
+    With a SharedImage, the arrays live in shared memory and are served by other
+    processes: load/step/store then run under the image lock, and store() publishes
+    the new state to readers in one seqlock write section.
+    """
+
+    def __init__(self, engine: DamEngine, image=None):
+        self.engine = engine
+        self.image = image
+        self.per_device, devices, coil_size, register_size = layout(engine.count)
+
+        if image:
+            self.coils, self.registers = image.coils, image.registers
+        else:
+            self.coils = np.zeros((devices, coil_size), dtype=bool)
+            self.registers = np.zeros((devices, register_size), dtype=np.uint16)
+        per = self.per_device
+        self.pump = self.coils[:, 1 : 1 + 2 * per : 2]
+        self.gate = self.coils[:, 2 : 2 + 2 * per : 2]
+        self.level = self.registers[:, 1 : 1 + per]
+
+        self.context = None if image else server_context(self.coils, self.registers)
+
+    @property
+    def lock(self):
+        """Lock against client writes from other processes, while the engine is stepped."""
+        return self.image.lock if self.image else contextlib.nullcontext()
+
+    def _put(self, view, values):
+        """Scatter reservoir values into a (devices, per_device) view."""
+        full, rest = divmod(len(values), self.per_device)
+        view[:full] = values[: full * self.per_device].reshape(full, self.per_device)
+        if rest:
+            view[full, :rest] = values[full * self.per_device :]
+
+    def load(self):
+        """Read the pump/gate coils, which clients may have written, into the engine."""
+        count = self.engine.count
+        self.engine.pump[:] = self.pump.reshape(-1)[:count]
+        self.engine.gate[:] = self.gate.reshape(-1)[:count]
+
+    def store(self):
+        """Write the engine state to the Modbus datastore."""
+        with self.image.publish() if self.image else contextlib.nullcontext():
+            self._put(self.pump, self.engine.pump)
+            self._put(self.gate, self.engine.gate)
+            self._put(self.level, self.engine.level)
@@ -85,6 +85,25 @@ def get_commandline(server: bool = False, description: str | None = None, extras
             help="ADVANCED USAGE: set datastore context object",
             default=None,
         )
+        parser.add_argument(
+            "--listen",
+            help="also serve COMM[:PORT[:FRAMER]] from the same datastore, e.g. udp:5020, tls:5021 or serial:pty, repeatable. The port is --port by default, 802 for tls",
+            action="append",
+            default=[],
+            type=str,
+        )
+        parser.add_argument(
+            "--reuse-port",
+            help="listen with SO_REUSEPORT, so several server processes accept on the same port",
+            action="store_true",
+        )
+        parser.add_argument(
+            "--loop",
+            choices=["asyncio", "uvloop"],
+            help="set event loop, default is asyncio",
+            default="asyncio",
+            type=str,
+        )
     else:
         parser.add_argument(
             "--timeout",
@@ -123,6 +142,20 @@ def get_commandline(server: bool = False, description: str | None = None, extras
     return args
 
 
+def raise_open_files_limit() -> int:
+    """Raise the soft limit of open files to the hard limit, for thousands of connections."""
+    try:
+        import resource  # pylint: disable=import-outside-toplevel
+    except ImportError:
+        return 0
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    try:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ValueError, OSError):
+        return soft
+    return hard
+
+
 def get_certificate(suffix: str):
     """Get example certificate."""
     delimiter = "\\" if os.name == "nt" else "/"
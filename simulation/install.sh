@@ -6,4 +6,6 @@ source .venv/bin/activate
 git clone https://github.com/pymodbus-dev/pymodbus.git
 cd pymodbus
 git checkout e73e28c1eb7d42949e03ded7f634d5438ddd9c35
-pip install "."
\ No newline at end of file
+pip install "."
+pip install numpy
+pip install pyserial uvloop
\ No newline at end of file
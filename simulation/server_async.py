@@ -3,13 +3,17 @@
 
 An example of a multi threaded asynchronous server.
 
+With --listen, the server answers on several transports at once (e.g. TCP, UDP,
+TLS and a serial line on a pseudo terminal), all from the same datastore.
+
 usage::
 
     server_async.py [-h] [--comm {tcp,udp,serial,tls}]
                     [--framer {ascii,rtu,socket,tls}]
                     [--log {critical,error,warning,info,debug}]
                     [--port PORT] [--store {sequential,sparse,factory,none}]
-                    [--device_ids DEVICE_IDS]
+                    [--device_ids DEVICE_IDS] [--listen LISTEN]
+                    [--reuse-port] [--loop {asyncio,uvloop}]
 
     -h, --help
         show this help message and exit
@@ -26,16 +30,32 @@ usage::
         set datastore type
     --device_ids DEVICE IDs
         set list of devices to respond to
+    --listen COMM[:PORT[:FRAMER]]
+        also serve on this transport, e.g. udp:5020, tls:5021 or serial:pty
+        (clients open /tmp/ttyp0), repeatable
+    --reuse-port
+        listen with SO_REUSEPORT, so several processes accept on one port
+    --loop {asyncio,uvloop}
+        set event loop, uvloop is faster if installed
 
 The corresponding client can be started as:
 
     python3 client_sync.py
 
+Example, the same registers over TCP, UDP, TLS and serial RTU::
+
+    server_async.py --port 5020 --listen udp:5020 --listen tls:5021 --listen serial:pty
+
 """
 import asyncio
 import logging
+import os
+import subprocess
 import sys
+import tty
 from collections.abc import Callable
+from functools import partial
+from pathlib import Path
 from typing import Any
 
 
@@ -56,20 +76,30 @@ from pymodbus.datastore import (
     ModbusSparseDataBlock,
 )
 from pymodbus.server import (
-    StartAsyncSerialServer,
-    StartAsyncTcpServer,
-    StartAsyncTlsServer,
-    StartAsyncUdpServer,
+    ModbusSerialServer,
+    ModbusTcpServer,
+    ModbusTlsServer,
+    ModbusUdpServer,
 )
 
 
 _logger = logging.getLogger(__file__)
 _logger.setLevel(logging.INFO)
 
+# default framer of the listeners
+FRAMERS = {"tcp": "socket", "udp": "socket", "serial": "rtu", "tls": "tls"}
+# port of a tls listener without one, the registered Modbus/TCP security port,
+# as the TCP server already listens on --port
+TLS_PORT = 802
+# clients of a serial:pty listener open this end of the pseudo terminals
+PTY_LINK = "/tmp/ttyp0"
+# self-signed certificate of the TLS listeners, created on first use
+CERTIFICATES_DIR = Path("certificates")
+
 
-def setup_server(description=None, context=None, cmdline=None):
+def setup_server(description=None, context=None, cmdline=None, extras=None):
     """Run server setup."""
-    args = helper.get_commandline(server=True, description=description, cmdline=cmdline)
+    args = helper.get_commandline(server=True, description=description, extras=extras, cmdline=cmdline)
     if context:
         args.context = context
     datablock: Callable[[], Any]
@@ -136,76 +166,160 @@ def setup_server(description=None, context=None, cmdline=None):
     return args
 
 
-async def run_async_server(args) -> None:
-    """Run server."""
-    txt = f"### start ASYNC server, listening on {args.port} - {args.comm}"
-    _logger.info(txt)
-    if args.comm == "tcp":
-        address = (args.host if args.host else "", args.port if args.port else None)
-        await StartAsyncTcpServer(
-            context=args.context,  # Data storage
-            identity=args.identity,  # server identify
-            address=address,  # listen address
-            # custom_functions=[],  # allow custom handling
-            framer=args.framer,  # The framer strategy to use
-            # ignore_missing_devices=True,  # ignore request to a missing device
-            # broadcast_enable=False,  # treat device 0 as broadcast address,
-            # timeout=1,  # waiting time for request to complete
-        )
-    elif args.comm == "udp":
-        address = (
-            args.host if args.host else "127.0.0.1",
-            args.port if args.port else None,
+class PtyBridge:
+    """Two pseudo terminals joined like a null modem cable, as socat does.
+
+    The server opens one end (port), clients the other (link), e.g. with
+    client_async.py --comm serial --port /tmp/ttyp0.
+    """
+
+    def __init__(self, link: str = PTY_LINK):
+        self.masters = []
+        self.slaves = []
+        for _ in range(2):
+            master, slave = os.openpty()
+            # the slaves stay open, so nothing is echoed before a client opens its end
+            tty.setraw(slave)
+            os.set_blocking(master, False)
+            self.masters.append(master)
+            self.slaves.append(slave)
+        self.port = os.ttyname(self.slaves[0])
+        self.link = Path(link)
+        self.link.unlink(missing_ok=True)
+        self.link.symlink_to(os.ttyname(self.slaves[1]))
+        loop = asyncio.get_running_loop()
+        loop.add_reader(self.masters[0], self.forward, self.masters[0], self.masters[1])
+        loop.add_reader(self.masters[1], self.forward, self.masters[1], self.masters[0])
+
+    @staticmethod
+    def forward(source: int, target: int):
+        try:
+            data = os.read(source, 4096)
+            os.write(target, data)
+        except (BlockingIOError, OSError) as exc:
+            # a full line loses the bytes, like a serial line nobody reads
+            _logger.debug(f"pty bridge: {exc}")
+
+    def close(self):
+        loop = asyncio.get_running_loop()
+        for master in self.masters:
+            loop.remove_reader(master)
+        for fd in self.masters + self.slaves:
+            os.close(fd)
+        self.link.unlink(missing_ok=True)
+
+
+def tls_certificate() -> tuple[str, str]:
+    """Certificate and key of the TLS listeners, self-signed with openssl when missing."""
+    cert, key = CERTIFICATES_DIR / "simulation.crt", CERTIFICATES_DIR / "simulation.key"
+    if not (cert.exists() and key.exists()):
+        _logger.info(f"### Create self-signed TLS certificate {cert}")
+        CERTIFICATES_DIR.mkdir(exist_ok=True)
+        subprocess.run(
+            ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "3650",
+             "-subj", "/CN=simulation", "-keyout", str(key), "-out", str(cert)],
+            check=True, capture_output=True,
         )
-        await StartAsyncUdpServer(
-            context=args.context,  # Data storage
+    return str(cert), str(key)
+
+
+def listeners(args) -> list[tuple[str, Any, str]]:
+    """(comm, port, framer) of --comm/--port and of every --listen COMM[:PORT[:FRAMER]]."""
+    result = [(args.comm, args.port, args.framer)]
+    for spec in getattr(args, "listen", None) or []:
+        comm, _, rest = spec.partition(":")
+        port, _, framer = rest.partition(":")
+        if comm not in FRAMERS:
+            raise ValueError(f"--listen {spec}: communication must be one of {', '.join(FRAMERS)}")
+        if comm == "serial":
+            port = port or "pty"
+        elif comm == "tls":
+            port = int(port) if port else TLS_PORT
+        else:
+            port = int(port) if port else (args.port if args.comm != "serial" else 5020)
+        result.append((comm, port, framer or FRAMERS[comm]))
+    return result
+
+
+def create_server(args, comm: str, port, framer: str):
+    """Server of one listener, returns it and the pty bridge it serves, if any."""
+    bridge = None
+    if comm == "tcp":
+        server = ModbusTcpServer(
+            args.context,  # Data storage
             identity=args.identity,  # server identify
-            address=address,  # listen address
-            # custom_functions=[],  # allow custom handling
-            framer=args.framer,  # The framer strategy to use
-            # ignore_missing_devices=True,  # ignore request to a missing device
-            # broadcast_enable=False,  # treat device id 0 as broadcast address,
-            # timeout=1,  # waiting time for request to complete
+            address=(args.host if args.host else "", port),  # listen address
+            framer=framer,  # The framer strategy to use
         )
-    elif args.comm == "serial":
-        # socat -d -d PTY,link=/tmp/ptyp0,raw,echo=0,ispeed=9600
-        #             PTY,link=/tmp/ttyp0,raw,echo=0,ospeed=9600
-        await StartAsyncSerialServer(
-            context=args.context,  # Data storage
-            identity=args.identity,  # server identify
-            # timeout=1,  # waiting time for request to complete
-            port=args.port,  # serial port
-            # custom_functions=[],  # allow custom handling
-            framer=args.framer,  # The framer strategy to use
-            # stopbits=1,  # The number of stop bits to use
-            # bytesize=8,  # The bytesize of the serial messages
-            # parity="N",  # Which kind of parity to use
+    elif comm == "udp":
+        server = ModbusUdpServer(
+            args.context,
+            identity=args.identity,
+            address=(args.host if args.host else "127.0.0.1", port),
+            framer=framer,
+        )
+    elif comm == "serial":
+        if port == "pty":
+            # pseudo terminals joined in process, instead of
+            # socat -d -d PTY,link=/tmp/ptyp0,raw,echo=0,ispeed=9600
+            #             PTY,link=/tmp/ttyp0,raw,echo=0,ospeed=9600
+            bridge = PtyBridge()
+            port = bridge.port
+        server = ModbusSerialServer(
+            args.context,
+            identity=args.identity,
+            port=port,  # serial port
+            framer=framer,
             baudrate=args.baudrate,  # The baud rate to use for the serial device
-            # handle_local_echo=False,  # Handle local echo of the USB-to-RS485 adaptor
-            # ignore_missing_devices=True,  # ignore request to a missing device
-            # broadcast_enable=False,  # treat device_id 0 as broadcast address,
         )
-    elif args.comm == "tls":
-        address = (args.host if args.host else "", args.port if args.port else None)
-        await StartAsyncTlsServer(
-            context=args.context,  # Data storage
-            # port=port,  # on which port
-            identity=args.identity,  # server identify
-            # custom_functions=[],  # allow custom handling
-            address=address,  # listen address
-            framer=args.framer,  # The framer strategy to use
-            certfile=helper.get_certificate(
-                "crt"
-            ),  # The cert file path for TLS (used if sslctx is None)
-            # sslctx=sslctx,  # The SSLContext to use for TLS (default None and auto create)
-            keyfile=helper.get_certificate(
-                "key"
-            ),  # The key file path for TLS (used if sslctx is None)
-            # password="none",  # The password for for decrypting the private key file
-            # ignore_missing_devices=True,  # ignore request to a missing device
-            # broadcast_enable=False,  # treat device_id 0 as broadcast address,
-            # timeout=1,  # waiting time for request to complete
+    else:
+        certfile, keyfile = tls_certificate()
+        server = ModbusTlsServer(
+            args.context,
+            identity=args.identity,
+            address=(args.host if args.host else "", port),
+            framer=framer,
+            certfile=certfile,  # The cert file path for TLS (used if sslctx is None)
+            keyfile=keyfile,  # The key file path for TLS (used if sslctx is None)
         )
+    if comm != "serial" and getattr(args, "reuse_port", False):
+        # several processes listen on the port, the kernel spreads the connections over them
+        server.call_create = partial(server.call_create, reuse_port=True)
+    return server, bridge
+
+
+async def run_async_server(args) -> None:
+    """Run server, on every listener at once, sharing args.context."""
+    helper.raise_open_files_limit()
+    servers = []
+    bridges = []
+    try:
+        for comm, port, framer in listeners(args):
+            txt = f"### start ASYNC server, listening on {port} - {comm}"
+            _logger.info(txt)
+            server, bridge = create_server(args, comm, port, framer)
+            servers.append(server)
+            if bridge:
+                bridges.append(bridge)
+                _logger.info(f"### serial clients connect to {bridge.link}")
+        await asyncio.gather(*(server.serve_forever() for server in servers))
+    finally:
+        for server in servers:
+            await server.shutdown()
+        for bridge in bridges:
+            bridge.close()
+
+
+def set_event_loop_policy(name: str) -> None:
+    """Use uvloop's faster event loop for --loop uvloop, if it is installed."""
+    if name != "uvloop":
+        return
+    try:
+        import uvloop  # pylint: disable=import-outside-toplevel
+    except ImportError:
+        _logger.warning("uvloop is not installed (pip install uvloop), using the asyncio event loop")
+        return
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
 
 
 async def async_helper() -> None:
@@ -216,4 +330,6 @@ async def async_helper() -> None:
 
 
 if __name__ == "__main__":
-    asyncio.run(async_helper(), debug=True)
+    main_args = setup_server(description="Run asynchronous server.")
+    set_event_loop_policy(main_args.loop)
+    asyncio.run(run_async_server(main_args), debug=True)
@@ -0,0 +1,109 @@
+"""
+Shared-memory register image of the simulation.
+
+The coils and input registers of all simulated devices live in one
+multiprocessing.shared_memory segment, so the physics and the Modbus servers can
+run in separate processes:
+
+    [ header: seq ][ coils: devices x coil_size bool ][ registers: devices x register_size uint16 ]
+
+Consistency uses a seqlock. Writers hold image.lock and publish their changes inside
+image.publish(), which makes seq odd while the memory is being changed. Readers never
+block: they copy the values and retry if seq was odd or changed meanwhile, so every
+response is a consistent snapshot of one tick.
+
+Writers are the physics process (once per tick) and the servers when a client writes
+a coil. Readers are the servers answering requests.
+"""
+from __future__ import annotations
+
+import contextlib
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from datablock import ArrayDataBlock
+
+
+HEADER_SIZE = 64
+
+
+class SharedImage:
+    """Coils and input registers of all devices in a shared memory segment."""
+
+    def __init__(self, devices: int, coil_size: int, register_size: int, name: str | None = None, lock=None):
+        """Create a new segment, or attach to an existing one by name."""
+        self.devices = devices
+        self.coil_size = coil_size
+        self.register_size = register_size
+        coil_bytes = devices * coil_size
+        coil_bytes += coil_bytes % 2
+        size = HEADER_SIZE + coil_bytes + 2 * devices * register_size
+
+        self.owner = name is None
+        self.shm = shared_memory.SharedMemory(name=name, create=self.owner, size=size)
+        self.lock = lock or multiprocessing.get_context("spawn").Lock()
+
+        buf = self.shm.buf
+        self.seq = np.ndarray((1,), dtype=np.uint64, buffer=buf)
+        self.coils = np.ndarray((devices, coil_size), dtype=bool, buffer=buf, offset=HEADER_SIZE)
+        self.registers = np.ndarray(
+            (devices, register_size), dtype=np.uint16, buffer=buf, offset=HEADER_SIZE + coil_bytes
+        )
+        if self.owner:
+            self.seq[0] = 0
+            self.coils[:] = False
+            self.registers[:] = 0
+
+    @property
+    def spec(self) -> dict:
+        """Arguments to attach to this image from another process."""
+        return {
+            "devices": self.devices,
+            "coil_size": self.coil_size,
+            "register_size": self.register_size,
+            "name": self.shm.name,
+            "lock": self.lock,
+        }
+
+    @contextlib.contextmanager
+    def publish(self):
+        """Write section, the caller must hold the lock. Readers retry until it ends."""
+        self.seq[0] += 1
+        try:
+            yield
+        finally:
+            self.seq[0] += 1
+
+    def read(self, copy):
+        """Call copy() until it ran without a concurrent write, returns its result."""
+        while True:
+            start = int(self.seq[0])
+            if start & 1:
+                continue
+            result = copy()
+            if int(self.seq[0]) == start:
+                return result
+
+    def close(self):
+        # drop the views before releasing the mapping
+        del self.seq, self.coils, self.registers
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class SharedDataBlock(ArrayDataBlock):
+    """Array-backed datablock on a SharedImage, with seqlock reads and locked writes."""
+
+    def __init__(self, address, values, image: SharedImage, bits=False):
+        super().__init__(address, values, bits)
+        self.image = image
+
+    def getValues(self, address, count=1):
+        return self.image.read(lambda: super(SharedDataBlock, self).getValues(address, count))
+
+    def setValues(self, address, values):
+        with self.image.lock, self.image.publish():
+            return super().setValues(address, values)
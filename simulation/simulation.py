@@ -13,6 +13,20 @@ Controls the gate & pump based on the water level.
 
 Water level changes based on the status of the gate and the pump.
 
+With --reservoirs, many dams are simulated at once (see engine.py), each
+served on its own Modbus device id starting at 1.
+
+With --clock accelerated or fixed, simulated time runs faster than real time
+(see clock.py), e.g. to replay a day of operation in seconds. --seed and
+--record make reproducible runs whose trajectories can be compared exactly.
+
+With --servers, the physics runs in this process and Modbus requests are served
+by separate processes from a shared memory image of the registers (see shm.py).
+With --reuse-port, those processes all accept connections on --port.
+
+With --listen, the dam is also served over other transports, e.g. UDP, TLS and a
+serial line on a pseudo terminal, from the same registers (see server_async.py).
+
 Based on Pymodbus asynchronous Server with updating task example.
 
 
@@ -21,7 +35,11 @@ Usage:
                        [--framer {ascii,rtu,socket,tls}]
                        [--log {critical,error,warning,info,debug}]
                        [--port PORT] [--store {sequential,sparse,factory,none}]
-                       [--device_ids DEVICE_IDS]
+                       [--device_ids DEVICE_IDS] [--reservoirs RESERVOIRS]
+                       [--clock {realtime,accelerated,fixed}] [--speed SPEED]
+                       [--step STEP] [--steps STEPS] [--seed SEED]
+                       [--record RECORD] [--servers SERVERS]
+                       [--listen LISTEN] [--reuse-port] [--loop {asyncio,uvloop}]
 
     -h, --help
         show this help message and exit
@@ -38,13 +56,39 @@ Usage:
         set datastore type
     --device_ids DEVICE_IDS
         set number of devices to respond to
+    --reservoirs RESERVOIRS
+        set number of simulated reservoirs, default is 1
+    --clock {realtime,accelerated,fixed}
+        set simulation clock, default is realtime
+    --speed SPEED
+        set speed factor of the accelerated clock, default is 10
+    --step STEP
+        set simulated seconds per tick, default is 0.5
+    --steps STEPS
+        stop after this many ticks, default is 0 (run forever)
+    --seed SEED
+        randomise the initial reservoir states with this seed
+    --record RECORD
+        record the trajectory of all reservoirs to this file
+    --servers SERVERS
+        serve from this many processes on consecutive ports, sharing memory
+        with the physics, default is 0 (in process)
+    --listen COMM[:PORT[:FRAMER]]
+        also serve on this transport, e.g. udp:5020, tls:5021 or serial:pty,
+        repeatable
+    --reuse-port
+        listen with SO_REUSEPORT, with --servers all processes listen on --port
+    --loop {asyncio,uvloop}
+        set event loop, uvloop is faster if installed
 """
 import asyncio
 import logging
+import multiprocessing
+import multiprocessing.connection
 import sys
-import datetime
 
 try:
+    import helper  # type: ignore[import-not-found]
     import server_async  # type: ignore[import-not-found]
 except ImportError:
     print("*** ERROR --> THIS EXAMPLE needs the example directory, please see \n\
@@ -52,20 +96,62 @@ except ImportError:
           for more information.")
     sys.exit(-1)
 
-from pymodbus.datastore import (
-    ModbusDeviceContext,
-    ModbusSequentialDataBlock,
-    ModbusServerContext,
-)
+from clock import MODES, SimClock
+from engine import DamContext, DamEngine, layout, server_context
+from shm import SharedDataBlock, SharedImage
+from trajectory import TrajectoryRecorder
 
 
 _logger = logging.getLogger(__name__)
 
-async def updating_task(context):
+EXTRAS = [
+    ("--reservoirs", {
+        "help": "set number of simulated reservoirs, default is 1",
+        "default": 1,
+        "type": int,
+    }),
+    ("--clock", {
+        "help": "set simulation clock, default is realtime",
+        "choices": MODES,
+        "default": "realtime",
+    }),
+    ("--speed", {
+        "help": "set speed factor of the accelerated clock, default is 10",
+        "default": 10.0,
+        "type": float,
+    }),
+    ("--step", {
+        "help": "set simulated seconds per tick, default is 0.5",
+        "default": 0.5,
+        "type": float,
+    }),
+    ("--steps", {
+        "help": "stop after this many ticks, default is 0 (run forever)",
+        "default": 0,
+        "type": int,
+    }),
+    ("--seed", {
+        "help": "randomise the initial reservoir states with this seed",
+        "default": None,
+        "type": int,
+    }),
+    ("--record", {
+        "help": "record the trajectory of all reservoirs to this file",
+        "default": None,
+        "type": str,
+    }),
+    ("--servers", {
+        "help": "serve from this many processes on consecutive ports (or all on --port with --reuse-port), sharing memory with the physics, default is 0 (in process)",
+        "default": 0,
+        "type": int,
+    }),
+]
+
+async def updating_task(dam, clock, steps=0, recorder=None):
     """Update values in server.
 
-    This task runs continuously beside the server
-    It will increment some values each two seconds.
+    This task runs continuously beside the server, or for steps ticks.
+    It will step every reservoir each tick of the simulation clock.
 
     It should be noted that getValues and setValues are not safe
     against concurrent use.
@@ -73,58 +159,48 @@ async def updating_task(context):
     coil (0) - water pump open/close state
     coil (1) - gate open/close state
     ir (0) - reservoir water level
-    """
-    r_coil = 0x1
-    w_coil = 0xf
-    rw_ir = 0x4
 
-    device_id = 0x00
-    address = 0
+    With several reservoirs, see engine.py for the layout of each device.
+    """
+    engine = dam.engine
+    loop = asyncio.get_running_loop()
+    next_print = 0.0
 
     # initialise values
-    # set waterlevel to 15cm, pump on, gate closed
-    context[device_id].setValues(rw_ir, address, [1500])
-    context[device_id].setValues(w_coil, address, [1,0])
+    with dam.lock:
+        dam.store()
 
     # incrementing loop
-    while True:
-        await asyncio.sleep(0.5)
-
-        pump, gate = context[device_id].getValues(r_coil, address, 2)
-        waterlevel = context[device_id].getValues(rw_ir, address, 1)[0]
-        txt = f"{str(datetime.datetime.now())[:-3]} - updating_task: pump: {"on" if pump else "off"}, gate: {"open" if gate else "closed"}, water level: {waterlevel!s}"
-        print(txt)
-        _logger.debug(txt)
-        
-        # if pump is on, increase water level by 0.10cm
-        if pump: waterlevel += 10
-
-        # if gate is open, decrease water level by 0.25cm
-        if gate: waterlevel -= 25
-
-        # if waterlevel > 21cm, open the gate and turn off the pump
-        if waterlevel > 2100:
-            pump = 0
-            gate = 1
-        
-        # if waterlevel < 17cm, close the gate and turn on the pump
-        if waterlevel < 1700:
-            pump = 1
-            gate = 0
-
-        # ensure waterlevel fits within the modbus register range
-        if waterlevel < 0: waterlevel = 0
-        if waterlevel > 65535: waterlevel = 65535
-
-        # # print flooding alert if water level is too high
-        # if waterlevel > 2250:
-        #     txt = f"[ALERT] dam is flooding"
-        #     print(txt)
-        #     _logger.debug(txt)
-
-        # update values
-        context[device_id].setValues(w_coil, address, [pump,gate])
-        context[device_id].setValues(rw_ir, address, [waterlevel])
+    while not steps or clock.tick < steps:
+        await clock.wait()
+
+        # client writes from other server processes wait until the tick is stored
+        with dam.lock:
+            # pick up pump/gate changes written by clients
+            dam.load()
+            if recorder:
+                recorder.record(clock.tick)
+
+            # print every tick, or at most once per step of wall-clock time when running faster
+            if clock.mode == "realtime" or loop.time() >= next_print:
+                next_print = loop.time() + clock.step
+                if engine.count == 1:
+                    pump, gate, waterlevel = engine.pump[0], engine.gate[0], engine.level[0]
+                    txt = f"{str(clock.now())[:-3]} - updating_task: pump: {"on" if pump else "off"}, gate: {"open" if gate else "closed"}, water level: {waterlevel!s}"
+                else:
+                    txt = f"{str(clock.now())[:-3]} - updating_task: reservoirs: {engine.count}, pumps on: {engine.pump.sum()}, gates open: {engine.gate.sum()}, mean water level: {engine.level.mean():.0f}"
+                print(txt)
+                _logger.debug(txt)
+
+            # # print flooding alert if water level is too high
+            # if (engine.level > 2250).any():
+            #     txt = f"[ALERT] dam is flooding"
+            #     print(txt)
+            #     _logger.debug(txt)
+
+            # apply pump/gate dynamics and control to all reservoirs, then update values
+            engine.step()
+            dam.store()
 
 
 def setup_updating_server(cmdline=None):
@@ -134,24 +210,95 @@ def setup_updating_server(cmdline=None):
     # 0x100 will respond with an invalid address exception.
     # This is because many devices exhibit this kind of behavior (but not all)
 
-    # Continuing, use a sequential block without gaps.
-    device_context = ModbusDeviceContext(
-        di=ModbusSequentialDataBlock(0x00, [0] * 100),
-        co=ModbusSequentialDataBlock(0x00, [0] * 100),
-        hr=ModbusSequentialDataBlock(0x00, [0] * 100),
-        ir=ModbusSequentialDataBlock(0x00, [0] * 100))
-    context = ModbusServerContext(devices=device_context, single=True)
-    return server_async.setup_server(
-        description="Run asynchronous server.", context=context, cmdline=cmdline
+    # Continuing, use array-backed blocks without gaps, one device per reservoir.
+    args = helper.get_commandline(server=True, description="Run asynchronous server.", extras=EXTRAS, cmdline=cmdline)
+    engine = DamEngine(args.reservoirs, seed=args.seed)
+    if args.servers:
+        # physics in this process, the register image in shared memory for the server processes
+        _, devices, coil_size, register_size = layout(args.reservoirs)
+        dam = DamContext(engine, SharedImage(devices, coil_size, register_size))
+        run_args = args
+        run_args.cmdline = sys.argv[1:] if cmdline is None else cmdline
+    else:
+        dam = DamContext(engine)
+        run_args = server_async.setup_server(
+            description="Run asynchronous server.", context=dam.context, cmdline=cmdline, extras=EXTRAS
+        )
+    run_args.dam = dam
+    run_args.sim_clock = SimClock(args.clock, step=args.step, speed=args.speed)
+    return run_args
+
+
+def serve_image(spec, cmdline, port, first=True):
+    """Serve the shared register image of the physics process, in a server process."""
+    image = SharedImage(**spec)
+    context = server_context(image.coils, image.registers, SharedDataBlock, image=image)
+    args = server_async.setup_server(
+        description="Run asynchronous server.", context=context, cmdline=cmdline, extras=EXTRAS
     )
+    args.port = port
+    if not first:
+        # the serial line has a single server, other listeners are shared with SO_REUSEPORT
+        args.listen = [listener for listener in args.listen if args.reuse_port and not listener.startswith("serial")]
+    server_async.set_event_loop_policy(args.loop)
+    try:
+        asyncio.run(server_async.run_async_server(args))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        del context
+        image.close()
+
+
+async def run_server_processes(args):
+    """Run the Modbus servers in separate processes, returns when one of them exits."""
+    spawn = multiprocessing.get_context("spawn")
+    if any(comm == "tls" for comm, _, _ in server_async.listeners(args)):
+        # created once, before the server processes look for it
+        server_async.tls_certificate()
+    ports = [args.port if args.reuse_port else args.port + n for n in range(args.servers)]
+    processes = [
+        spawn.Process(target=serve_image, args=(args.dam.image.spec, args.cmdline, port, n == 0), daemon=True)
+        for n, port in enumerate(ports)
+    ]
+    for process in processes:
+        process.start()
+    _logger.info(f"### started {args.servers} server processes on ports {ports[0]}-{ports[-1]}")
+    try:
+        await asyncio.get_running_loop().run_in_executor(
+            None, multiprocessing.connection.wait, [process.sentinel for process in processes]
+        )
+    finally:
+        for process in processes:
+            process.terminate()
+            process.join()
 
 
 async def run_updating_server(args):
     """Start updating_task concurrently with the current task."""
-    task = asyncio.create_task(updating_task(args.context))
+    recorder = None
+    if args.record:
+        meta = {"step": args.sim_clock.step, "seed": args.seed}
+        recorder = TrajectoryRecorder(args.record, args.dam.engine, meta)
+    task = asyncio.create_task(updating_task(args.dam, args.sim_clock, args.steps, recorder))
     # task.set_name("example updating task")
-    await server_async.run_async_server(args)  # start the server
-    task.cancel()
+    if args.servers:
+        server = asyncio.create_task(run_server_processes(args))
+    else:
+        server = asyncio.create_task(server_async.run_async_server(args))  # start the server
+    try:
+        # runs until the server stops, or the updating task has done its --steps ticks
+        done, _ = await asyncio.wait((task, server), return_when=asyncio.FIRST_COMPLETED)
+        for finished in done:
+            finished.result()
+    finally:
+        server.cancel()
+        task.cancel()
+        await asyncio.gather(server, task, return_exceptions=True)
+        if recorder:
+            recorder.close()
+        if args.dam.image:
+            args.dam.image.close()
 
 
 async def main(cmdline=None):
@@ -161,4 +308,6 @@ async def main(cmdline=None):
 
 
 if __name__ == "__main__":
-    asyncio.run(main(), debug=True)
+    main_args = setup_updating_server()
+    server_async.set_event_loop_policy(main_args.loop)
+    asyncio.run(run_updating_server(main_args), debug=True)